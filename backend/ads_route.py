@@ -1,22 +1,14 @@
 from flask import Blueprint, jsonify, request
 
-from auth_route import decode_session_token
+from auth_middleware import current_user_id, require_auth
 from billing_repo import FREE_AD_COINS, grant_ad_coins
 
 ads_bp = Blueprint("ads", __name__, url_prefix="/ads")
 
 
 @ads_bp.route("/complete", methods=["POST"])
+@require_auth
 def ads_complete():
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return jsonify({"error": "invalid_ad_proof"}), 401
-
-    token = auth_header.split(" ", 1)[1].strip()
-    payload = decode_session_token(token)
-    if not payload:
-        return jsonify({"error": "invalid_ad_proof"}), 401
-
     data = request.get_json(silent=True) or {}
     provider = data.get("provider")
     ad_proof = data.get("ad_proof")
@@ -27,7 +19,7 @@ def ads_complete():
     if not isinstance(ad_proof, str) or not ad_proof.strip():
         return jsonify({"error": "invalid_request"}), 400
 
-    ok, result = grant_ad_coins(payload["sub"], provider)
+    ok, result = grant_ad_coins(current_user_id(), provider)
     if not ok:
         if result == "daily_ad_limit_reached":
             return jsonify({"error": "rate_limited"}), 429
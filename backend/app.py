@@ -5,12 +5,18 @@ from flask_cors import CORS
 from dotenv import load_dotenv
 import time
 import jwt
-from billing_repo import init_billing_schema, grant_ad_coins, can_consume_ask
-from users_repo import init_users_schema,get_user_by_id
+from billing_repo import grant_ad_coins, can_consume_ask
+from users_repo import get_user_by_id
 from history_repo import (
-    init_history_schema, record_reading, list_history,
+    record_reading, list_history,
     get_history_detail, set_pin
 )
+from migrations import check_schema_version
+from auth_middleware import load_request_principal
+from db_router import REPLICA_STICKY_SECONDS, STICKY_COOKIE_NAME, start_replica_health_checker
+from retention_worker import start_retention_worker
+from services.google_auth_service import start_google_cert_refresher
+from token_revocation import start_revocation_refresher
 
 load_dotenv()
 
@@ -31,19 +37,33 @@ app.register_blueprint(ads_bp, url_prefix="/api/ads")
 app.register_blueprint(store_bp, url_prefix="/api/store")
 app.register_blueprint(history_bp, url_prefix="/api/history")
 
+# Verify the bearer token once per request; routes read it via auth_middleware.
+app.before_request(load_request_principal)
 
+
+@app.after_request
+def _set_db_sticky_cookie(response):
+    # Keep the next few reads of a client that just wrote on the primary,
+    # whichever worker serves them.
+    from flask import g
+    if g.get("db_sticky"):
+        response.set_cookie(
+            STICKY_COOKIE_NAME, "1", max_age=REPLICA_STICKY_SECONDS, httponly=True, samesite="Lax"
+        )
+    return response
+
+
+# Schema changes run once per deploy (`python migrations.py`, the release
+# step); workers only confirm the version here.
 try:
-    init_history_schema()
-except Exception as e:
-    print("DB init skipped:", e)
-try:
-    init_billing_schema()
-except Exception as e:
-    print("DB init skipped:", e)
-try:
-    init_users_schema()
+    check_schema_version()
 except Exception as e:
-    print("DB init skipped:", e)
+    print("Schema version check skipped:", e)
+
+start_retention_worker()
+start_google_cert_refresher()
+start_revocation_refresher()
+start_replica_health_checker()
 
 load_dotenv() 
 
@@ -1,17 +1,29 @@
 import json
 import os
 import sqlite3
+import threading
 import traceback
-from datetime import datetime, timezone
 
 from flask import Blueprint, Response, jsonify, request
 
-from auth_route import decode_session_token
+from ask_streams import (
+    ASK_STREAM_PENDING_SECONDS,
+    get_stream,
+    iter_pending_stream_events,
+    iter_saved_stream_events,
+    open_stream,
+    parse_last_event_id,
+    stream_age_seconds,
+    stream_sync_key,
+)
+from auth_middleware import current_user_id, require_auth
 from billing_repo import can_consume_ask, refund_consumed_ask
-from history_repo import record_reading
+from history_repo import get_reading_by_sync_key, record_reading
 from services.imagen_service import ImagenServiceError, generate_ad_image
 from services.llm_service import LLMServiceError, generate_divination
-from users_repo import get_user_by_id, increment_user_ask_count
+from services.prompt_log_service import PromptLogSink
+from stream_coalescer import coalesce_chunks
+from users_repo import get_user_by_id, increment_user_ask_count, queue_user_ask_count_increment
 
 ask_bp = Blueprint("ask", __name__)
 
@@ -133,23 +145,8 @@ def _get_prompt_final_instructions():
             return cached_value
         return DEFAULT_PROMPT_FINAL_INSTRUCTIONS
 
-for debug_dir in (DEBUG_PROMPT_DIR, DEBUG_IMAGE_PROMPT_DIR):
-    try:
-        os.makedirs(debug_dir, exist_ok=True)
-    except Exception:
-        traceback.print_exc()
-
-
-def _get_user_id_from_bearer():
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return None
-
-    token = auth_header.split(" ", 1)[1].strip()
-    payload = decode_session_token(token)
-    if not payload:
-        return None
-    return payload.get("sub")
+ASK_PROMPT_LOG = PromptLogSink(DEBUG_PROMPT_DIR, "ask")
+IMAGE_PROMPT_LOG = PromptLogSink(DEBUG_IMAGE_PROMPT_DIR, "image")
 
 
 def _parse_request_payload(data):
@@ -451,54 +448,24 @@ def _build_imagen_prompt(question, reading_text, context):
     )
 
 
-def _safe_filename_component(value, default):
-    raw = str(value or "").strip()
-    if not raw:
-        return default
-    sanitized = "".join(ch if (ch.isalnum() or ch in {"-", "_"}) else "_" for ch in raw)
-    sanitized = sanitized.strip("_")
-    if not sanitized:
-        return default
-    return sanitized[:60]
-
-
-def _debug_log_prompt_markdown(user_id, question, hexagram_code, changing_lines, system_prompt, user_prompt):
+def _debug_log_prompt(user_id, question, hexagram_code, changing_lines, system_prompt, user_prompt):
     try:
-        os.makedirs(DEBUG_PROMPT_DIR, exist_ok=True)
-
-        timestamp = datetime.now(timezone.utc)
-        ts_for_file = timestamp.strftime("%Y%m%d_%H%M%S_%f")
-        ts_iso = timestamp.isoformat().replace("+00:00", "Z")
-        safe_user = _safe_filename_component(user_id, "anonymous")
-        safe_hex = _safe_filename_component(hexagram_code, "unknown_hex")
-        filename = f"{ts_for_file}_{safe_user}_{safe_hex}.md"
-        path = os.path.join(DEBUG_PROMPT_DIR, filename)
-
-        question_text = (question or "").strip()
-        changing_lines_json = json.dumps(changing_lines or [], ensure_ascii=False)
-
-        with open(path, "w", encoding="utf-8") as file:
-            file.write("# Ask Prompt Debug Log\n\n")
-            file.write(f"- created_at_utc: `{ts_iso}`\n")
-            file.write(f"- user_id: `{user_id or ''}`\n")
-            file.write(f"- hexagram_code: `{hexagram_code or ''}`\n")
-            file.write(f"- changing_lines: `{changing_lines_json}`\n")
-            file.write(f"- question: `{question_text}`\n\n")
-
-            file.write("## System Prompt\n\n")
-            file.write("```text\n")
-            file.write(f"{system_prompt or ''}\n")
-            file.write("```\n\n")
-
-            file.write("## User Prompt\n\n")
-            file.write("```text\n")
-            file.write(f"{user_prompt or ''}\n")
-            file.write("```\n")
+        ASK_PROMPT_LOG.log(
+            {
+                "kind": "ask",
+                "user_id": user_id or "",
+                "hexagram_code": hexagram_code or "",
+                "changing_lines": changing_lines or [],
+                "question": (question or "").strip(),
+                "system_prompt": system_prompt or "",
+                "user_prompt": user_prompt or "",
+            }
+        )
     except Exception:
         traceback.print_exc()
 
 
-def _debug_log_image_prompt_markdown(
+def _debug_log_image_prompt(
     user_id,
     question,
     hexagram_code,
@@ -507,38 +474,22 @@ def _debug_log_image_prompt_markdown(
     image_prompt,
 ):
     try:
-        os.makedirs(DEBUG_IMAGE_PROMPT_DIR, exist_ok=True)
-
-        timestamp = datetime.now(timezone.utc)
-        ts_for_file = timestamp.strftime("%Y%m%d_%H%M%S_%f")
-        ts_iso = timestamp.isoformat().replace("+00:00", "Z")
-        safe_user = _safe_filename_component(user_id, "anonymous")
-        safe_hex = _safe_filename_component(hexagram_code, "unknown_hex")
-        safe_model = _safe_filename_component(image_model, "unknown_model")
-        filename = f"{ts_for_file}_{safe_user}_{safe_hex}_{safe_model}.md"
-        path = os.path.join(DEBUG_IMAGE_PROMPT_DIR, filename)
-
-        question_text = (question or "").strip()
-        changing_lines_json = json.dumps(changing_lines or [], ensure_ascii=False)
-
-        with open(path, "w", encoding="utf-8") as file:
-            file.write("# Ad Card Image Prompt Debug Log\n\n")
-            file.write(f"- created_at_utc: `{ts_iso}`\n")
-            file.write(f"- user_id: `{user_id or ''}`\n")
-            file.write(f"- hexagram_code: `{hexagram_code or ''}`\n")
-            file.write(f"- changing_lines: `{changing_lines_json}`\n")
-            file.write(f"- image_model: `{image_model or ''}`\n")
-            file.write(f"- question: `{question_text}`\n\n")
-
-            file.write("## Image Prompt\n\n")
-            file.write("```text\n")
-            file.write(f"{image_prompt or ''}\n")
-            file.write("```\n")
+        IMAGE_PROMPT_LOG.log(
+            {
+                "kind": "image",
+                "user_id": user_id or "",
+                "hexagram_code": hexagram_code or "",
+                "changing_lines": changing_lines or [],
+                "image_model": image_model or "",
+                "question": (question or "").strip(),
+                "image_prompt": image_prompt or "",
+            }
+        )
     except Exception:
         traceback.print_exc()
 
 
-def _save_reading(user_id, question, hexagram_code, changing_lines, content):
+def _save_reading(user_id, question, hexagram_code, changing_lines, content, sync_key=None):
     try:
         return record_reading(
             user_id=user_id,
@@ -548,6 +499,7 @@ def _save_reading(user_id, question, hexagram_code, changing_lines, content):
             full_text=content,
             derived_from=None,
             is_pinned=False,
+            sync_key=sync_key,
         )
     except Exception:
         traceback.print_exc()
@@ -562,6 +514,13 @@ def _increase_ask_count(user_id):
         return None
 
 
+def _queue_ask_count_increase(user_id):
+    try:
+        queue_user_ask_count_increment(user_id, 1)
+    except Exception:
+        traceback.print_exc()
+
+
 def _refund_if_needed(user_id, consume_result):
     try:
         if isinstance(consume_result, dict):
@@ -571,6 +530,61 @@ def _refund_if_needed(user_id, consume_result):
     return False
 
 
+def _generate_into_stream(stream, user_id, consume_result, question, hexagram_code, changing_lines, user_prompt):
+    """Run one generation into an SSE stream buffer; billing and saving match the text/plain stream.
+
+    Runs on its own thread so a client that drops the connection can
+    reconnect and resume instead of losing (or regenerating) the reading.
+    """
+    refunded = False
+    try:
+        for chunk in generate_divination(
+            SYSTEM_PROMPT,
+            user_prompt,
+            usage_callback=lambda usage: stream.add_event("usage", usage),
+        ):
+            if not stream.text:
+                # The saved reading is stripped; keep event ids valid against it.
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+            stream.append_text(chunk)
+    except LLMServiceError as exc:
+        traceback.print_exc()
+        if not stream.text:
+            refunded = _refund_if_needed(user_id, consume_result)
+        stream.add_event("error", {"error": "llm_unavailable", "details": str(exc)})
+    except Exception:
+        traceback.print_exc()
+        if not stream.text:
+            refunded = _refund_if_needed(user_id, consume_result)
+        stream.add_event("error", {"error": "server_error"})
+    finally:
+        reading_id = None
+        content = stream.text.strip()
+        if content:
+            reading_id = _save_reading(
+                user_id,
+                question,
+                hexagram_code,
+                changing_lines,
+                content,
+                sync_key=stream_sync_key(stream.stream_id),
+            )
+            _queue_ask_count_increase(user_id)
+        elif not refunded:
+            _refund_if_needed(user_id, consume_result)
+        stream.finish({"reading_id": reading_id, "saved_to_history": reading_id is not None})
+
+
+def _sse_response(events):
+    return Response(
+        events,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 def _format_context_response(context):
     raw_name = (context.get("hexagram_name") or "").strip()
     name_parts = raw_name.split()
@@ -599,10 +613,9 @@ def _format_context_response(context):
 
 
 @ask_bp.route("/context", methods=["POST"])
+@require_auth
 def ask_context():
-    user_id = _get_user_id_from_bearer()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     user = get_user_by_id(user_id)
     if not user:
@@ -621,13 +634,12 @@ def ask_context():
 
 
 @ask_bp.route("/ad-card", methods=["POST"])
+@require_auth
 def ask_ad_card():
     if not GEN_PIC:
         return jsonify({"error": "feature_disabled", "details": "gen_pic_disabled"}), 503
 
-    user_id = _get_user_id_from_bearer()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     user = get_user_by_id(user_id)
     if not user:
@@ -648,7 +660,7 @@ def ask_ad_card():
         reading_text=payload["reading_text"],
         context=context,
     )
-    _debug_log_image_prompt_markdown(
+    _debug_log_image_prompt(
         user_id=user_id,
         question=payload["question"],
         hexagram_code=context["hexagram_code"],
@@ -692,10 +704,9 @@ def ask_ad_card():
 
 
 @ask_bp.route("", methods=["POST"])
+@require_auth
 def ask_main():
-    user_id = _get_user_id_from_bearer()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     payload = _parse_request_payload(request.get_json(silent=True) or {})
     if not payload:
@@ -737,7 +748,7 @@ def ask_main():
         user_name,
         client_context,
     )
-    _debug_log_prompt_markdown(
+    _debug_log_prompt(
         user_id=user_id,
         question=question,
         hexagram_code=hexagram_code,
@@ -749,6 +760,16 @@ def ask_main():
     accept_header = (request.headers.get("Accept") or "").lower()
     wants_json = "application/json" in accept_header and "text/plain" not in accept_header
 
+    if "text/event-stream" in accept_header:
+        stream = open_stream(user_id, {"hexagram_code": hexagram_code, "changing_lines": changing_lines})
+        threading.Thread(
+            target=_generate_into_stream,
+            args=(stream, user_id, consume_result, question, hexagram_code, changing_lines, llm_user_prompt),
+            name=f"ask-stream-{stream.stream_id}",
+            daemon=True,
+        ).start()
+        return _sse_response(stream.iter_events())
+
     if wants_json:
         try:
             content = "".join(generate_divination(SYSTEM_PROMPT, llm_user_prompt)).strip()
@@ -801,9 +822,38 @@ def ask_main():
             content = "".join(chunks).strip()
             if content:
                 _save_reading(user_id, question, hexagram_code, changing_lines, content)
-                _increase_ask_count(user_id)
+                _queue_ask_count_increase(user_id)
             elif not refunded:
                 _refund_if_needed(user_id, consume_result)
 
-    return Response(stream_response(), mimetype="text/plain")
+    return Response(coalesce_chunks(stream_response()), mimetype="text/plain")
+
+
+@ask_bp.route("/stream/<stream_id>", methods=["GET"])
+@require_auth
+def ask_stream_resume(stream_id):
+    user_id = current_user_id()
+    offset = parse_last_event_id(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+
+    stream = get_stream(stream_id)
+    if stream is not None:
+        if stream.user_id != user_id:
+            return jsonify({"error": "stream_not_found"}), 404
+        return _sse_response(stream.iter_events(offset))
+
+    # Generated by another worker (or before a restart): replay the saved reading.
+    try:
+        saved = get_reading_by_sync_key(user_id, stream_sync_key(stream_id))
+    except Exception as exc:
+        traceback.print_exc()
+        return jsonify({"error": "server_error", "details": str(exc)}), 500
+    if saved:
+        meta = {"hexagram_code": saved["hexagram_code"], "changing_lines": saved["changing_lines"]}
+        return _sse_response(
+            iter_saved_stream_events(stream_id, meta, saved["content"], saved["reading_id"], offset)
+        )
 
+    age = stream_age_seconds(stream_id)
+    if age is not None and 0 <= age < ASK_STREAM_PENDING_SECONDS:
+        return _sse_response(iter_pending_stream_events(stream_id))
+    return jsonify({"error": "stream_not_found"}), 404
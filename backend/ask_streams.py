@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from stream_coalescer import STREAM_COALESCE_BYTES, STREAM_COALESCE_MS, coalescing_enabled
+
+# Server-Sent Events for /api/divination.
+#
+# Generation runs on its own thread and appends to a StreamBuffer; any
+# number of responses (the first one and later resumes) read from it.
+# Chunk events are numbered by character offset into the generated text,
+# so `Last-Event-ID` says exactly where a reconnecting client stopped, and
+# a worker that only has the saved reading can resume from the same id.
+# usage/error/done come after all text and carry no id; a resumed stream
+# repeats them.
+
+SSE_RETRY_MS = 2000
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+ASK_STREAM_HEARTBEAT_SECONDS = _parse_int_env("ASK_STREAM_HEARTBEAT_SECONDS", 15)
+ASK_STREAM_REPLAY_SECONDS = _parse_int_env("ASK_STREAM_REPLAY_SECONDS", 300)
+ASK_STREAM_MAX_BUFFERS = _parse_int_env("ASK_STREAM_MAX_BUFFERS", 1000)
+# A stream younger than this that no worker knows about may still be
+# generating elsewhere (Gemini read timeout is 300s plus retries).
+ASK_STREAM_PENDING_SECONDS = 360
+
+
+def new_stream_id() -> str:
+    return f"{int(time.time())}-{uuid.uuid4().hex}"
+
+
+def stream_age_seconds(stream_id: str):
+    try:
+        return time.time() - int(stream_id.split("-", 1)[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+def stream_sync_key(stream_id: str) -> str:
+    """reading_sync_keys entry that maps a stream to its saved reading."""
+    return f"stream:{stream_id}"
+
+
+def parse_last_event_id(value) -> int:
+    try:
+        return max(0, int(str(value).strip()))
+    except (TypeError, ValueError):
+        return 0
+
+
+def format_sse(event: str, data: dict, event_id=None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class StreamBuffer:
+    def __init__(self, stream_id: str, user_id: str, meta: dict):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.meta = meta
+        self.text = ""
+        self.tail_events = []
+        self.finished = False
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def append_text(self, text: str):
+        with self._cond:
+            self.text += text
+            self._cond.notify_all()
+
+    def add_event(self, event: str, data: dict):
+        with self._cond:
+            self.tail_events.append((event, data))
+            self._cond.notify_all()
+
+    def finish(self, done: dict):
+        with self._cond:
+            self.tail_events.append(("done", done))
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def iter_events(
+        self,
+        offset: int = 0,
+        heartbeat_seconds: int = ASK_STREAM_HEARTBEAT_SECONDS,
+        max_bytes: int = STREAM_COALESCE_BYTES,
+        max_delay_ms: int = STREAM_COALESCE_MS,
+    ):
+        """SSE frames from `offset` on: text as it arrives, heartbeats while idle.
+
+        After the first chunk, text is held back until `max_bytes` are
+        pending or `max_delay_ms` passed since the previous chunk
+        (see stream_coalescer).
+        """
+        coalesce = coalescing_enabled(max_bytes, max_delay_ms)
+        last_flush = None
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        yield format_sse("stream", {"stream_id": self.stream_id, **self.meta})
+        while True:
+            with self._cond:
+                if len(self.text) <= offset and not self.finished:
+                    self._cond.wait(heartbeat_seconds)
+                if coalesce and last_flush is not None and len(self.text) > offset:
+                    deadline = last_flush + max_delay_ms / 1000.0
+                    while not self.finished and (
+                        max_bytes <= 0 or len(self.text[offset:].encode("utf-8")) < max_bytes
+                    ):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                text = self.text[offset:]
+                finished = self.finished
+                tail_events = list(self.tail_events) if finished else []
+            if text:
+                offset += len(text)
+                yield format_sse("chunk", {"text": text}, event_id=offset)
+                last_flush = time.monotonic()
+            elif not finished:
+                yield ": ping\n\n"
+            if finished:
+                for event, data in tail_events:
+                    yield format_sse(event, data)
+                return
+
+
+class _StreamRegistry:
+    def __init__(self):
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, user_id: str, meta: dict) -> StreamBuffer:
+        stream = StreamBuffer(new_stream_id(), str(user_id), meta)
+        with self._lock:
+            self._prune()
+            self._streams[stream.stream_id] = stream
+        return stream
+
+    def get(self, stream_id: str):
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def _prune(self):
+        now = time.monotonic()
+        for stream_id, stream in list(self._streams.items()):
+            expired = stream.finished and now - stream.finished_at >= ASK_STREAM_REPLAY_SECONDS
+            over_limit = len(self._streams) >= ASK_STREAM_MAX_BUFFERS and stream.finished
+            if expired or over_limit:
+                del self._streams[stream_id]
+
+
+_REGISTRY = _StreamRegistry()
+
+
+def open_stream(user_id: str, meta: dict) -> StreamBuffer:
+    return _REGISTRY.open(user_id, meta)
+
+
+def get_stream(stream_id: str):
+    return _REGISTRY.get(stream_id)
+
+
+def iter_saved_stream_events(stream_id: str, meta: dict, text: str, reading_id, offset: int = 0):
+    """Resume from a reading another worker already generated and saved."""
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    yield format_sse("stream", {"stream_id": stream_id, **meta})
+    if len(text) > offset:
+        yield format_sse("chunk", {"text": text[offset:]}, event_id=len(text))
+    yield format_sse("done", {"reading_id": reading_id, "saved_to_history": True})
+
+
+def iter_pending_stream_events(stream_id: str):
+    """The stream is unknown here but may still be generating on another worker."""
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    yield format_sse("pending", {"stream_id": stream_id, "retry_ms": SSE_RETRY_MS})
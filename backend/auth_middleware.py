@@ -0,0 +1,162 @@
+import datetime
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+import jwt
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+
+from token_revocation import is_token_revoked, revoke_token, revoke_user_tokens
+
+load_dotenv()
+
+JWT_SECRET = (os.getenv("JWT_SECRET") or "").strip()
+if not JWT_SECRET:
+    raise RuntimeError("Missing JWT_SECRET in environment. Set a value with at least 32 bytes.")
+if len(JWT_SECRET.encode("utf-8")) < 32:
+    raise RuntimeError("JWT_SECRET must be at least 32 bytes for HS256.")
+JWT_ALGORITHM = "HS256"
+AUTH_ERROR = "invalid_or_expired_token"
+SESSION_TOKEN_TTL = datetime.timedelta(days=7)
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+AUTH_TOKEN_CACHE_SIZE = _parse_int_env("AUTH_TOKEN_CACHE_SIZE", 10000)
+
+
+def create_session_token(user_id: str):
+    now = datetime.datetime.utcnow()
+    exp = now + SESSION_TOKEN_TTL
+    # iat is whole seconds; iat_ms lets a user-wide revocation tell apart
+    # sessions issued just before and just after it within that second.
+    issued_ms = int(now.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    payload = {"sub": user_id, "iat": now, "iat_ms": issued_ms, "exp": exp, "jti": uuid.uuid4().hex}
+    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return token, exp
+
+
+def decode_session_token(token: str):
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None
+
+
+class _VerifiedTokenCache:
+    """Bounded LRU of session tokens whose signature was already checked.
+
+    Each entry is dropped at the token's own `exp`, so a cached token is
+    never accepted longer than jwt.decode would accept it.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        with self._lock:
+            entry = self._items.get(token)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._items[token]
+                return None
+            self._items.move_to_end(token)
+            return payload
+
+    def put(self, token: str, payload: dict):
+        if self.max_entries <= 0:
+            return
+        try:
+            expires_at = float(payload["exp"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._items[token] = (payload, expires_at)
+            self._items.move_to_end(token)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+_TOKEN_CACHE = _VerifiedTokenCache(AUTH_TOKEN_CACHE_SIZE)
+
+
+def verify_session_token(token: str):
+    """Payload of a valid session token, from the cache when possible."""
+    if not token:
+        return None
+    payload = _TOKEN_CACHE.get(token)
+    if payload is None:
+        payload = decode_session_token(token)
+        if not payload or not payload.get("sub"):
+            return None
+        _TOKEN_CACHE.put(token, payload)
+    # Checked on cache hits too: the cache only remembers the signature.
+    if is_token_revoked(payload):
+        return None
+    return payload
+
+
+def revoke_session(payload: dict):
+    """Log out one session. Tokens issued before jtis existed fall back to all sessions."""
+    expires_at = datetime.datetime.utcfromtimestamp(float(payload["exp"]))
+    if payload.get("jti"):
+        revoke_token(payload["sub"], payload["jti"], expires_at)
+    else:
+        revoke_user_tokens(payload["sub"], expires_at)
+
+
+def revoke_all_sessions(user_id: str):
+    revoke_user_tokens(user_id, datetime.datetime.utcnow() + SESSION_TOKEN_TTL)
+
+
+def _bearer_token():
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return auth_header.split(" ", 1)[1].strip() or None
+
+
+def load_request_principal():
+    """before_request hook: verify the bearer token once and keep the result on `g`."""
+    g.auth_payload = verify_session_token(_bearer_token())
+
+
+def current_auth_payload():
+    if "auth_payload" not in g:
+        load_request_principal()
+    return g.auth_payload
+
+
+def current_user_id():
+    payload = current_auth_payload()
+    return payload.get("sub") if payload else None
+
+
+def auth_error_response():
+    return jsonify({"error": AUTH_ERROR}), 401
+
+
+def require_auth(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user_id():
+            return auth_error_response()
+        return view(*args, **kwargs)
+
+    return wrapper
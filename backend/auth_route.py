@@ -1,24 +1,23 @@
 import os
 import datetime
 
-import jwt
 from dotenv import load_dotenv
 from flask import Blueprint, jsonify, request
-from google.auth.transport import requests as google_requests
-from google.oauth2 import id_token
 
+from auth_middleware import (
+    create_session_token,
+    current_auth_payload,
+    current_user_id,
+    require_auth,
+    revoke_all_sessions,
+    revoke_session,
+)
+from services.google_auth_service import verify_google_id_token
 from users_repo import get_or_create_user_by_provider, get_user_by_id
 
 load_dotenv()
 
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
-JWT_SECRET = (os.getenv("JWT_SECRET") or "").strip()
-if not JWT_SECRET:
-    raise RuntimeError("Missing JWT_SECRET in environment. Set a value with at least 32 bytes.")
-if len(JWT_SECRET.encode("utf-8")) < 32:
-    raise RuntimeError("JWT_SECRET must be at least 32 bytes for HS256.")
-JWT_ALGORITHM = "HS256"
-
 PRO_PLAN_VALUES = {"pro", "pro_monthly", "pro_yearly", "subscriber"}
 DEFAULT_PRO_QUOTA = 1000
 DEFAULT_HISTORY_LIMIT = 200
@@ -28,30 +27,11 @@ auth_bp = Blueprint("auth", __name__, url_prefix="/auth")
 
 def verify_google_token(id_token_str: str):
     try:
-        return id_token.verify_oauth2_token(
-            id_token_str,
-            google_requests.Request(),
-            GOOGLE_CLIENT_ID,
-        )
+        return verify_google_id_token(id_token_str, GOOGLE_CLIENT_ID)
     except Exception:
         return None
 
 
-def create_session_token(user_id: str):
-    now = datetime.datetime.utcnow()
-    exp = now + datetime.timedelta(days=7)
-    payload = {"sub": user_id, "iat": now, "exp": exp}
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
-    return token, exp
-
-
-def decode_session_token(token: str):
-    try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-        return None
-
-
 def _iso_or_none(dt_value):
     if not dt_value:
         return None
@@ -95,13 +75,6 @@ def _to_user_profile(user: dict) -> dict:
     }
 
 
-def _get_token_from_auth_header():
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return None
-    return auth_header.split(" ", 1)[1].strip()
-
-
 @auth_bp.route("/login", methods=["POST"])
 def auth_login():
     data = request.get_json(silent=True) or {}
@@ -150,30 +123,30 @@ def fake_login():
 
 @auth_bp.route("/verify", methods=["POST"])
 def verify_token():
-    token = _get_token_from_auth_header()
-    if not token:
+    if not current_auth_payload():
         return jsonify({"valid": False, "error": "invalid_or_expired_token"}), 401
+    return jsonify({"valid": True})
 
-    payload = decode_session_token(token)
-    if not payload:
-        return jsonify({"valid": False, "error": "invalid_or_expired_token"}), 401
 
-    return jsonify({"valid": True})
+@auth_bp.route("/logout", methods=["POST"])
+@require_auth
+def logout():
+    data = request.get_json(silent=True) or {}
+    try:
+        if data.get("all_devices"):
+            revoke_all_sessions(current_user_id())
+        else:
+            revoke_session(current_auth_payload())
+    except Exception as exc:
+        return jsonify({"error": "server_error", "details": str(exc)}), 500
+    return jsonify({"ok": True})
 
 
 @auth_bp.route("/me", methods=["GET"])
+@require_auth
 def get_me():
-    token = _get_token_from_auth_header()
-    if not token:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
-
-    payload = decode_session_token(token)
-    if not payload:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
-
-    user = get_user_by_id(payload["sub"])
+    user = get_user_by_id(current_user_id())
     if not user:
         return jsonify({"error": "invalid_or_expired_token"}), 401
 
     return jsonify(_to_user_profile(user))
-
@@ -5,48 +5,17 @@ import psycopg2
 import psycopg2.extras
 from dotenv import load_dotenv
 
+from db_router import mark_user_write
+from event_queue import WriteBehindQueue
+from pg_connections import connect as pg_connect
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 
 def get_pg():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
-
-
-def init_billing_schema():
-    ddl = """
-    CREATE TABLE IF NOT EXISTS ad_events (
-      id SERIAL PRIMARY KEY,
-      user_id TEXT NOT NULL,
-      ad_network TEXT,
-      earned_coins INTEGER NOT NULL,
-      created_at TIMESTAMP NOT NULL DEFAULT NOW()
-    );
-
-    CREATE TABLE IF NOT EXISTS usage_quotas (
-      id SERIAL PRIMARY KEY,
-      user_id TEXT NOT NULL,
-      usage_date DATE NOT NULL,
-      used_count INTEGER NOT NULL DEFAULT 0,
-      UNIQUE(user_id, usage_date)
-    );
-
-    CREATE TABLE IF NOT EXISTS billing_events (
-      id SERIAL PRIMARY KEY,
-      user_id TEXT NOT NULL,
-      platform TEXT,
-      product_id TEXT,
-      purchase_token TEXT,
-      event_type TEXT,
-      amount INTEGER,
-      created_at TIMESTAMP NOT NULL DEFAULT NOW()
-    );
-    """
-    with get_pg() as conn, conn.cursor() as cur:
-        cur.execute(ddl)
-        conn.commit()
-    print("billing tables ready.")
+    return pg_connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
 
 
 FREE_AD_COINS = 100
@@ -58,41 +27,40 @@ DAILY_SUBSCRIBER_LIMIT = SUBSCRIBER_MONTHLY_QUOTA // 30
 def grant_ad_coins(user_id: str, ad_network: str = "admob"):
     today = datetime.now(timezone.utc).date()
     with get_pg() as conn, conn.cursor() as cur:
+        # Claim a daily slot and credit the wallet in one statement. The conditional
+        # upsert locks the counter row, so concurrent calls cannot both pass the limit.
         cur.execute(
             """
-            SELECT COUNT(*) AS cnt FROM ad_events
-            WHERE user_id=%s AND DATE(created_at)=%s
+            WITH slot AS (
+              INSERT INTO ad_daily_counters (user_id, reward_date, granted_count)
+              VALUES (%s, %s, 1)
+              ON CONFLICT (user_id, reward_date)
+              DO UPDATE SET granted_count = ad_daily_counters.granted_count + 1
+              WHERE ad_daily_counters.granted_count < %s
+              RETURNING granted_count
+            ),
+            wallet AS (
+              UPDATE users
+              SET silver_coins = silver_coins + %s,
+                  updated_at = NOW()
+              WHERE id=%s AND EXISTS (SELECT 1 FROM slot)
+              RETURNING silver_coins
+            )
+            SELECT
+              (SELECT granted_count FROM slot) AS granted_count,
+              (SELECT silver_coins FROM wallet) AS silver_coins
             """,
-            (user_id, today),
+            (user_id, today, DAILY_AD_LIMIT, FREE_AD_COINS, user_id),
         )
-        cnt_row = cur.fetchone()
-        cnt = cnt_row["cnt"] if cnt_row else 0
-
-        if cnt >= DAILY_AD_LIMIT:
+        row = cur.fetchone() or {}
+        if row.get("granted_count") is None:
+            conn.rollback()
             return False, "daily_ad_limit_reached"
-
-        cur.execute(
-            """
-            INSERT INTO ad_events (user_id, ad_network, earned_coins)
-            VALUES (%s, %s, %s)
-            """,
-            (user_id, ad_network, FREE_AD_COINS),
-        )
-
-        cur.execute(
-            """
-            UPDATE users
-            SET silver_coins = silver_coins + %s,
-                updated_at = NOW()
-            WHERE id=%s
-            RETURNING silver_coins;
-            """,
-            (FREE_AD_COINS, user_id),
-        )
-        row = cur.fetchone()
-        coins = row["silver_coins"] if row else 0
         conn.commit()
-        return True, coins
+    mark_user_write(user_id)
+
+    _ad_event_queue.submit((user_id, ad_network, FREE_AD_COINS, datetime.now(timezone.utc)))
+    return True, int(row.get("silver_coins") or 0)
 
 
 def can_consume_ask(user_row: dict):
@@ -166,6 +134,7 @@ def can_consume_ask(user_row: dict):
             )
             updated = cur.fetchone() or {}
             conn.commit()
+            mark_user_write(user_id)
             return True, {
                 "consumed": "gold",
                 "remaining_gold": int(updated.get("gold") or 0),
@@ -185,6 +154,7 @@ def can_consume_ask(user_row: dict):
             )
             updated = cur.fetchone() or {}
             conn.commit()
+            mark_user_write(user_id)
             return True, {
                 "consumed": "silver",
                 "remaining_gold": int(updated.get("gold") or 0),
@@ -216,16 +186,41 @@ def refund_consumed_ask(user_id: str, consume_result):
         )
         row = cur.fetchone()
         conn.commit()
-        return bool(row)
+    mark_user_write(user_id)
+    return bool(row)
 
 
-def record_billing_event(user_id, platform, product_id, purchase_token, event_type, amount=None):
+def _insert_ad_events(rows):
     with get_pg() as conn, conn.cursor() as cur:
-        cur.execute(
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO ad_events (user_id, ad_network, earned_coins, created_at)
+            VALUES %s
+            """,
+            rows,
+        )
+        conn.commit()
+
+
+def _insert_billing_events(rows):
+    with get_pg() as conn, conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
             """
             INSERT INTO billing_events (user_id, platform, product_id, purchase_token, event_type, amount, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, NOW())
+            VALUES %s
             """,
-            (user_id, platform, product_id, purchase_token, event_type, amount),
+            rows,
         )
         conn.commit()
+
+
+_ad_event_queue = WriteBehindQueue("ad_events", _insert_ad_events)
+_billing_event_queue = WriteBehindQueue("billing_events", _insert_billing_events)
+
+
+def record_billing_event(user_id, platform, product_id, purchase_token, event_type, amount=None):
+    _billing_event_queue.submit(
+        (user_id, platform, product_id, purchase_token, event_type, amount, datetime.now(timezone.utc))
+    )
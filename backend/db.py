@@ -1,7 +1,7 @@
 import os
 import datetime
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Date
+    create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Date
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
@@ -34,19 +34,6 @@ class User(Base):
     created_at = Column(DateTime, server_default=func.now())
 
     readings = relationship("Reading", back_populates="user", cascade="all, delete-orphan")
-    tokens = relationship("JWTToken", back_populates="user", cascade="all, delete-orphan")
-
-
-class JWTToken(Base):
-    __tablename__ = "jwt_tokens"
-
-    id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
-    token = Column(Text, nullable=False)
-    exp = Column(DateTime)
-    is_valid = Column(Boolean, default=True)
-
-    user = relationship("User", back_populates="tokens")
 
 
 class Reading(Base):
@@ -106,28 +93,8 @@ def update_user_info(db, user_id, **kwargs):
 
 
 # ---------- JWT ----------
-def store_jwt(db, user_id, token, exp):
-    jwt = JWTToken(user_id=user_id, token=token, exp=exp, is_valid=True)
-    db.add(jwt)
-    db.commit()
-
-
-def invalidate_jwt(db, token):
-    jwt = db.query(JWTToken).filter_by(token=token).first()
-    if jwt:
-        jwt.is_valid = False
-        db.commit()
-
-
-def is_jwt_valid(db, token):
-    jwt = db.query(JWTToken).filter_by(token=token, is_valid=True).first()
-    if not jwt:
-        return False
-    if jwt.exp and jwt.exp < datetime.datetime.utcnow():
-        jwt.is_valid = False
-        db.commit()
-        return False
-    return True
+# jwt_tokens now holds session revocations only (migrations.py 005);
+# use auth_middleware.revoke_session / token_revocation instead.
 
 
 # ---------- Coin / 廣告 ----------
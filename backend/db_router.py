@@ -0,0 +1,251 @@
+import os
+import random
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+from pg_connections import ConnectionLimitError, connect as pg_connect
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+STICKY_COOKIE_NAME = "db_sticky"
+REPLICA_CONNECT_TIMEOUT_SECONDS = 2
+MAX_TRACKED_WRITERS = 10000
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_float_env(var_name: str, default_value: float) -> float:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return float(raw)
+    except ValueError:
+        return default_value
+
+
+DATABASE_REPLICA_URLS = [u.strip() for u in (os.getenv("DATABASE_REPLICA_URLS") or "").split(",") if u.strip()]
+REPLICA_MAX_LAG_SECONDS = _parse_float_env("REPLICA_MAX_LAG_SECONDS", 5.0)
+REPLICA_HEALTH_CHECK_SECONDS = _parse_int_env("REPLICA_HEALTH_CHECK_SECONDS", 5)
+REPLICA_STICKY_SECONDS = _parse_int_env("REPLICA_STICKY_SECONDS", 10)
+
+
+def get_primary_pg():
+    return pg_connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+class _Replica:
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.healthy = False
+        self.lag_seconds = None
+
+
+class _ReplicaSet:
+    """Replica DSNs with a lag probe run every REPLICA_HEALTH_CHECK_SECONDS.
+
+    Probes run on a daemon thread per process, so a replica that hangs
+    never delays a request; until the first probe finishes every read goes
+    to the primary.
+    """
+
+    def __init__(self, dsns: list):
+        self.replicas = [_Replica(dsn) for dsn in dsns]
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._owner_pid = None
+
+    def pick(self):
+        if not self.replicas:
+            return None
+        self.start_checker()
+        healthy = [r for r in self.replicas if r.healthy]
+        return random.choice(healthy) if healthy else None
+
+    def mark_down(self, replica: _Replica):
+        replica.healthy = False
+
+    def start_checker(self):
+        if not self.replicas:
+            return
+        pid = os.getpid()
+        if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+                return
+            # Threads do not survive a fork (gunicorn pre-fork), so start one per process.
+            self._owner_pid = pid
+            self._thread = threading.Thread(target=self._run, name="replica-health-check", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(max(1, REPLICA_HEALTH_CHECK_SECONDS))
+
+    def check(self):
+        primary_lsn = self._primary_lsn()
+        for replica in self.replicas:
+            self._probe(replica, primary_lsn)
+
+    @staticmethod
+    def _primary_lsn():
+        try:
+            conn = get_primary_pg()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+                    row = cur.fetchone() or {}
+            finally:
+                conn.close()
+            return row.get("lsn")
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def _probe(self, replica: _Replica, primary_lsn):
+        """Measure how far `replica` is behind.
+
+        A replica that has replayed up to the primary's current LSN (read
+        just before) is not behind at all, however long ago its last replayed
+        transaction was. Otherwise the lag is the age of that transaction,
+        which also grows while the WAL receiver is stalled or disconnected.
+        A receiver that is visibly not streaming (pg_stat_wal_receiver shows
+        the status only to roles with pg_read_all_stats) is unhealthy.
+        """
+        try:
+            conn = pg_connect(
+                replica.dsn,
+                cursor_factory=psycopg2.extras.RealDictCursor,
+                connect_timeout=REPLICA_CONNECT_TIMEOUT_SECONDS,
+            )
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT pg_is_in_recovery() AS in_recovery,
+                               (SELECT status FROM pg_stat_wal_receiver LIMIT 1) AS receiver_status,
+                               pg_wal_lsn_diff(%s::pg_lsn, pg_last_wal_replay_lsn()) AS behind_bytes,
+                               EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS replay_age
+                        """,
+                        (primary_lsn,),
+                    )
+                    row = cur.fetchone() or {}
+            finally:
+                conn.close()
+        except Exception:
+            traceback.print_exc()
+            replica.healthy = False
+            replica.lag_seconds = None
+            return
+
+        status = row.get("receiver_status")
+        if not row.get("in_recovery"):
+            lag = 0.0
+        elif status is not None and status != "streaming":
+            lag = None
+        elif row.get("behind_bytes") is not None and row["behind_bytes"] <= 0:
+            lag = 0.0
+        else:
+            lag = row.get("replay_age")
+        replica.lag_seconds = float(lag) if lag is not None else None
+        healthy = replica.lag_seconds is not None and replica.lag_seconds <= REPLICA_MAX_LAG_SECONDS
+        if replica.healthy != healthy:
+            print(
+                f"db_router: replica {_redact(replica.dsn)} healthy={healthy} "
+                f"lag={replica.lag_seconds} receiver={status}"
+            )
+        replica.healthy = healthy
+
+
+def _redact(dsn: str) -> str:
+    return dsn.split("@", 1)[-1]
+
+
+_REPLICAS = _ReplicaSet(DATABASE_REPLICA_URLS)
+_recent_writers: dict = {}
+_recent_writers_lock = threading.Lock()
+
+
+def _request_is_sticky() -> bool:
+    try:
+        from flask import has_request_context, request
+    except ImportError:
+        return False
+    return has_request_context() and bool(request.cookies.get(STICKY_COOKIE_NAME))
+
+
+def mark_user_write(user_id):
+    """Pin this user's reads to the primary for REPLICA_STICKY_SECONDS."""
+    if not DATABASE_REPLICA_URLS or not user_id:
+        return
+    now = time.monotonic()
+    with _recent_writers_lock:
+        if len(_recent_writers) >= MAX_TRACKED_WRITERS:
+            for key in [k for k, until in _recent_writers.items() if until <= now]:
+                del _recent_writers[key]
+        _recent_writers[str(user_id)] = now + REPLICA_STICKY_SECONDS
+
+    # Other gunicorn workers cannot see the map above; the cookie set in
+    # app.after_request carries the stickiness to them.
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return
+    if has_request_context():
+        g.db_sticky = True
+
+
+def _user_is_sticky(user_id) -> bool:
+    if user_id:
+        until = _recent_writers.get(str(user_id))
+        if until and until > time.monotonic():
+            return True
+    return _request_is_sticky()
+
+
+def get_read_pg(user_id=None):
+    """Connection for a read-only query: a healthy replica, or the primary.
+
+    Falls back to the primary when no replica is configured or healthy, when
+    `user_id` wrote recently, or when the replica refuses the connection.
+    """
+    if not DATABASE_REPLICA_URLS or _user_is_sticky(user_id):
+        return get_primary_pg()
+    replica = _REPLICAS.pick()
+    if replica is None:
+        return get_primary_pg()
+    try:
+        return pg_connect(
+            replica.dsn,
+            cursor_factory=psycopg2.extras.RealDictCursor,
+            connect_timeout=REPLICA_CONNECT_TIMEOUT_SECONDS,
+        )
+    except ConnectionLimitError:
+        raise
+    except psycopg2.OperationalError:
+        traceback.print_exc()
+        _REPLICAS.mark_down(replica)
+        return get_primary_pg()
+
+
+def start_replica_health_checker():
+    _REPLICAS.start_checker()
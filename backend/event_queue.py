@@ -0,0 +1,169 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Callable
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_bool_env(var_name: str, default_value: bool) -> bool:
+    raw = (os.getenv(var_name) or "").strip().lower()
+    if not raw:
+        return default_value
+    return raw in {"1", "true", "yes", "on"}
+
+
+EVENT_QUEUE_ENABLED = _parse_bool_env("EVENT_QUEUE_ENABLED", True)
+EVENT_QUEUE_MAX_SIZE = _parse_int_env("EVENT_QUEUE_MAX_SIZE", 10000)
+EVENT_QUEUE_BATCH_SIZE = _parse_int_env("EVENT_QUEUE_BATCH_SIZE", 200)
+EVENT_QUEUE_FLUSH_INTERVAL_MS = _parse_int_env("EVENT_QUEUE_FLUSH_INTERVAL_MS", 500)
+EVENT_QUEUE_SHUTDOWN_TIMEOUT_SECONDS = 10
+
+_QUEUES: list["WriteBehindQueue"] = []
+_QUEUES_LOCK = threading.Lock()
+
+
+class WriteBehindQueue:
+    """Bounded in-process queue that hands items to `flush_fn` in batches.
+
+    `flush_fn` receives a list of items and must write them in one go
+    (multi-row insert). When the queue is full the item is written
+    synchronously by default, or dropped when `overflow="drop"`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        flush_fn: Callable[[list], None],
+        max_size: int = EVENT_QUEUE_MAX_SIZE,
+        batch_size: int = EVENT_QUEUE_BATCH_SIZE,
+        flush_interval_ms: int = EVENT_QUEUE_FLUSH_INTERVAL_MS,
+        enabled: bool = EVENT_QUEUE_ENABLED,
+        overflow: str = "sync",
+    ):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, flush_interval_ms / 1000.0)
+        self.enabled = enabled
+        self.overflow = overflow
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, int(max_size)))
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._owner_pid = None
+        self._closed = False
+
+        with _QUEUES_LOCK:
+            _QUEUES.append(self)
+
+    def submit(self, item) -> bool:
+        """Queue one item. Returns False only when the item was dropped."""
+        if not self.enabled or self._closed:
+            return self._write_now([item])
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if self.overflow == "drop":
+                return False
+            return self._write_now([item])
+
+    def flush(self):
+        """Write everything currently queued on the calling thread."""
+        while True:
+            batch = self._take_batch(block=False)
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def close(self, timeout: float = EVENT_QUEUE_SHUTDOWN_TIMEOUT_SECONDS):
+        self._closed = True
+        thread = self._thread
+        if thread and thread.is_alive() and self._owner_pid == os.getpid():
+            thread.join(timeout)
+        self.flush()
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+                return
+            # Threads do not survive a fork (gunicorn pre-fork), so start one per process.
+            self._owner_pid = pid
+            self._thread = threading.Thread(
+                target=self._run,
+                name=f"write-behind-{self.name}",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            batch = self._take_batch(block=True)
+            if batch:
+                self._write_batch(batch)
+
+    def _take_batch(self, block: bool) -> list:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch: list):
+        try:
+            self.flush_fn(batch)
+            return
+        except Exception:
+            traceback.print_exc()
+
+        if len(batch) == 1:
+            return
+        # One bad row should not lose the whole batch.
+        for item in batch:
+            self._write_now([item])
+
+    def _write_now(self, items: list) -> bool:
+        try:
+            self.flush_fn(items)
+            return True
+        except Exception:
+            traceback.print_exc()
+            return False
+
+
+def drain_all_queues():
+    with _QUEUES_LOCK:
+        queues = list(_QUEUES)
+    for q in queues:
+        try:
+            q.close()
+        except Exception:
+            traceback.print_exc()
+
+
+atexit.register(drain_all_queues)
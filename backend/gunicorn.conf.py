@@ -0,0 +1,38 @@
+import os
+
+# Serving modes:
+#   sync   - one request per worker process (default). A streaming
+#            /api/divination response holds its worker for the whole
+#            Gemini generation, so concurrent streams = WEB_CONCURRENCY.
+#   gevent - green-thread workers: up to WEB_WORKER_CONNECTIONS requests
+#            per process. Sockets (requests -> Gemini) are monkey-patched
+#            by the worker and psycopg2 waits cooperatively through
+#            psycogreen, so a stream only costs a greenlet while it
+#            waits for the next chunk. Database connections stay capped at
+#            DB_MAX_CONNECTIONS per worker (pg_connections.py).
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+worker_class = (os.getenv("WEB_WORKER_CLASS") or "sync").strip().lower()
+workers = _parse_int_env("WEB_CONCURRENCY", 1)
+worker_connections = _parse_int_env("WEB_WORKER_CONNECTIONS", 500)
+timeout = 240
+# The gevent worker patches the standard library before it imports the
+# app; preloading would import it (and start its threads) unpatched.
+preload_app = False
+
+
+def post_fork(server, worker):
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
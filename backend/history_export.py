@@ -0,0 +1,100 @@
+import json
+import sys
+import zlib
+from datetime import datetime, timezone
+
+from db_router import get_read_pg
+from history_repo import _decompress, _normalize_changing_lines
+
+EXPORT_FETCH_SIZE = 200
+# Gzip output is flushed once this much NDJSON has accumulated, so the
+# client sees progress without paying for a flush per row.
+EXPORT_GZIP_FLUSH_BYTES = 64 * 1024
+
+
+def _iso(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    return value
+
+
+def iter_export_records(user_id, fetch_size: int = EXPORT_FETCH_SIZE):
+    """Yield every visible reading of a user, oldest first, with its full text.
+
+    Rows come from a named (server-side) cursor `fetch_size` at a time and
+    are decompressed one by one, so memory does not grow with the history.
+    """
+    now = datetime.now(timezone.utc)
+    conn = get_read_pg(user_id)
+    try:
+        with conn.cursor(name="history_export") as cur:
+            cur.itersize = fetch_size
+            cur.execute(
+                """
+                SELECT id, question, hexagram_code, changing_lines, result_summary,
+                       result_full, derived_from, is_pinned, expires_at, created_at
+                FROM readings
+                WHERE user_id=%s
+                  AND (is_pinned = TRUE OR expires_at IS NULL OR expires_at >= %s)
+                ORDER BY created_at, id
+                """,
+                (user_id, now),
+            )
+            for row in cur:
+                try:
+                    changing_lines = _normalize_changing_lines(row.get("changing_lines"))
+                except Exception:
+                    changing_lines = []
+                yield {
+                    "reading_id": int(row["id"]),
+                    "question": row.get("question", ""),
+                    "hexagram_code": row.get("hexagram_code", ""),
+                    "changing_lines": changing_lines,
+                    "summary": row.get("result_summary") or "",
+                    "content": _decompress(row.get("result_full"), conn),
+                    "derived_from": row.get("derived_from"),
+                    "is_pinned": bool(row.get("is_pinned", False)),
+                    "expires_at": _iso(row.get("expires_at")),
+                    "created_at": _iso(row.get("created_at")),
+                }
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def iter_export_chunks(user_id, compress: bool = False):
+    """NDJSON export as byte chunks, optionally as one gzip stream."""
+    if not compress:
+        for record in iter_export_records(user_id):
+            yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        return
+
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = 0
+    for record in iter_export_records(user_id):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        pending += len(line)
+        out = gzip.compress(line)
+        if pending >= EXPORT_GZIP_FLUSH_BYTES:
+            out += gzip.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if out:
+            yield out
+    yield gzip.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python history_export.py <user_id> [output.ndjson|output.ndjson.gz]")
+        sys.exit(1)
+    target = sys.argv[2] if len(sys.argv) > 2 else None
+    if target is None:
+        for chunk in iter_export_chunks(sys.argv[1]):
+            sys.stdout.buffer.write(chunk)
+    else:
+        with open(target, "wb") as file:
+            for chunk in iter_export_chunks(sys.argv[1], compress=target.endswith(".gz")):
+                file.write(chunk)
+        print(f"exported history of {sys.argv[1]} to {target}")
@@ -1,32 +1,74 @@
 import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
 import psycopg2
 import psycopg2.extras
 from datetime import datetime, timedelta, timezone
 import json
-import zlib
+import re
+from db_router import get_read_pg, mark_user_write
+from pg_connections import connect as pg_connect
+from reading_codec import ZstdUnavailableError, decode_text, encode_text
 from users_repo import get_user_by_id, is_subscriber
 from dotenv import load_dotenv
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+TOMBSTONE_RETENTION_DAYS = 90
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_bool_env(var_name: str, default_value: bool) -> bool:
+    raw = (os.getenv(var_name) or "").strip().lower()
+    if not raw:
+        return default_value
+    return raw in {"1", "true", "yes", "on"}
+
+
+HISTORY_TEXT_CACHE_SIZE = _parse_int_env("HISTORY_TEXT_CACHE_SIZE", 256)
+# Index the full reading text as well (lowest weight). Off by default: it
+# multiplies the vector size for a field users rarely search on.
+HISTORY_SEARCH_FULL_TEXT = _parse_bool_env("HISTORY_SEARCH_FULL_TEXT", False)
+# How long a client may retry a sync (or resume a stream) and still get the
+# original reading back instead of a new one.
+SYNC_KEY_RETENTION_DAYS = _parse_int_env("SYNC_KEY_RETENTION_DAYS", 30)
+
+
+class ChangesCursorExpired(Exception):
+    """The change cursor is older than the tombstone retention window."""
 
 def get_pg():
-    return psycopg2.connect(
+    return pg_connect(
         DATABASE_URL,
         cursor_factory=psycopg2.extras.RealDictCursor
     )
 
 # ---- 壓縮 / 解壓 ----
-def _compress(s: str) -> bytes:
+# `conn`: pass the connection the caller holds, if any (see reading_codec).
+def _compress(s: str, conn=None) -> bytes:
     if not s:
         return None
-    return zlib.compress(s.encode("utf-8"))
+    return encode_text(s, conn=conn)
 
-def _decompress(b: bytes) -> str:
+def _decompress(b: bytes, conn=None) -> str:
     if not b:
         return ""
     try:
-        return zlib.decompress(b).decode("utf-8")
+        return decode_text(b, conn=conn)
+    except ZstdUnavailableError:
+        # A host problem, not a bad row: fail loudly instead of serving "".
+        raise
     except Exception:
         return ""
 
@@ -37,34 +79,80 @@ def _make_summary(text: str, max_len: int = 220) -> str:
     return t if len(t) <= max_len else t[:max_len] + "…"
 
 # =====================
-# 初始化建表
-# =====================
-def init_history_schema():
-    ddl = """
-    CREATE TABLE IF NOT EXISTS readings (
-      id SERIAL PRIMARY KEY,
-      user_id TEXT,
-      question TEXT NOT NULL,
-      hexagram_code TEXT NOT NULL,
-      changing_lines JSONB,
-      result_summary TEXT,
-      result_full BYTEA,
-      derived_from INTEGER,
-      is_pinned BOOLEAN NOT NULL DEFAULT FALSE,
-      expires_at TIMESTAMP NULL,
-      created_at TIMESTAMP NOT NULL DEFAULT NOW()
-    );
-
-    CREATE INDEX IF NOT EXISTS idx_readings_user_created
-      ON readings (user_id, created_at DESC);
-
-    CREATE INDEX IF NOT EXISTS idx_readings_user_expires
-      ON readings (user_id, expires_at);
-    """
-    with get_pg() as conn, conn.cursor() as cur:
-        cur.execute(ddl)
-        conn.commit()
-    print("✅ readings table ready.")
+# 搜尋索引（中文單字＋雙字）
+# =====================
+# Postgres has no Chinese parser, so text is pre-split here: every CJK
+# character and every adjacent pair becomes a space-separated term, other
+# letters/digits become lowercase words. The 'simple' config then stores
+# the terms as-is.
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('simple', %s), 'A')"
+    " || setweight(to_tsvector('simple', %s), 'B')"
+    " || setweight(to_tsvector('simple', %s), 'C')"
+)
+
+
+def _is_cjk(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x3400 <= code <= 0x4DBF
+        or 0x4E00 <= code <= 0x9FFF
+        or 0xF900 <= code <= 0xFAFF
+        or 0x20000 <= code <= 0x2FA1F
+    )
+
+
+def _split_runs(text: str):
+    """Yield (is_cjk, run) for maximal runs of CJK characters or other letters/digits."""
+    run, run_cjk = [], False
+    for ch in text or "":
+        if _is_cjk(ch):
+            kind = True
+        elif ch.isalnum():
+            kind = False
+        else:
+            if run:
+                yield run_cjk, "".join(run)
+            run = []
+            continue
+        if run and kind != run_cjk:
+            yield run_cjk, "".join(run)
+            run = []
+        run_cjk = kind
+        run.append(ch)
+    if run:
+        yield run_cjk, "".join(run)
+
+
+def search_terms(text: str) -> list:
+    """Terms stored in the index for `text`."""
+    terms = []
+    for cjk, run in _split_runs(text):
+        if not cjk:
+            terms.append(run.lower())
+            continue
+        terms.extend(run)
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def search_query_terms(query: str) -> list:
+    """Terms that must all match: bigrams for CJK runs (a lone character stays as is), words otherwise."""
+    terms = []
+    for cjk, run in _split_runs(query):
+        if not cjk:
+            terms.append(run.lower())
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return list(dict.fromkeys(terms))
+
+
+def search_documents(question, summary, full_text) -> tuple:
+    """The three weighted documents fed to SEARCH_VECTOR_SQL."""
+    full_doc = " ".join(search_terms(full_text)) if HISTORY_SEARCH_FULL_TEXT else ""
+    return " ".join(search_terms(question)), " ".join(search_terms(summary)), full_doc
 
 # =====================
 # 寫入占卜紀錄
@@ -91,8 +179,19 @@ def _normalize_changing_lines(value):
     return []
 
 
+# reading_counts keeps each user's number of stored readings, changed in the
+# same transaction as every insert and delete, so the history total is one
+# primary-key lookup instead of a count over the user's rows.
+BUMP_READING_COUNT_SQL = """
+    INSERT INTO reading_counts (user_id, total, updated_at)
+    VALUES (%s, %s, NOW())
+    ON CONFLICT (user_id) DO UPDATE
+    SET total = GREATEST(reading_counts.total + EXCLUDED.total, 0), updated_at = NOW()
+"""
+
+
 def record_reading(user_id, question, hex_code, changing_lines_list,
-                   full_text, derived_from=None, is_pinned=False):
+                   full_text, derived_from=None, is_pinned=False, sync_key=None):
     now = datetime.now(timezone.utc)
     user = get_user_by_id(user_id) if user_id else None
     subscriber = is_subscriber(user) if user else False
@@ -102,11 +201,11 @@ def record_reading(user_id, question, hex_code, changing_lines_list,
     compressed = _compress(full_text)
     changing_lines_json = psycopg2.extras.Json(_normalize_changing_lines(changing_lines_list))
 
-    sql = """
+    sql = f"""
     INSERT INTO readings (user_id, question, hexagram_code, changing_lines,
                           result_summary, result_full, derived_from,
-                          is_pinned, expires_at)
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                          is_pinned, expires_at, search_vector)
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,{SEARCH_VECTOR_SQL})
     RETURNING id;
     """
     with get_pg() as conn, conn.cursor() as cur:
@@ -122,39 +221,307 @@ def record_reading(user_id, question, hex_code, changing_lines_list,
                 derived_from,
                 is_pinned,
                 expires_at,
+                *search_documents(question, summary, full_text),
             ),
         )
         row = cur.fetchone()
+        if row and user_id:
+            cur.execute(BUMP_READING_COUNT_SQL, (user_id, 1))
+        if row and sync_key:
+            cur.execute(
+                """
+                INSERT INTO reading_sync_keys (user_id, sync_key, reading_id)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, sync_key) DO NOTHING
+                """,
+                (user_id, sync_key, row["id"]),
+            )
+        conn.commit()
+    mark_user_write(user_id)
+    return row["id"] if row else None
+
+
+def get_reading_by_sync_key(user_id, sync_key):
+    """Reading stored under a sync key, with its full text; None if absent or deleted."""
+    # Primary on purpose: the key is usually looked up right after it was written.
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT r.id, r.hexagram_code, r.changing_lines, r.result_full
+            FROM reading_sync_keys k
+            JOIN readings r ON r.id = k.reading_id AND r.user_id = k.user_id
+            WHERE k.user_id=%s AND k.sync_key=%s
+            """,
+            (user_id, sync_key),
+        )
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "reading_id": int(row["id"]),
+        "hexagram_code": row.get("hexagram_code", ""),
+        "changing_lines": _normalize_changing_lines(row.get("changing_lines")),
+        "content": _decompress(row.get("result_full")),
+    }
+
+# =====================
+# 批次同步（離線紀錄）
+# =====================
+def make_sync_key(client_record_id, question, hex_code, changing_lines_list, full_text) -> str:
+    """Dedupe key for a synced record: the client id when given, else a content hash."""
+    if client_record_id is not None and str(client_record_id).strip():
+        return f"client:{str(client_record_id).strip()}"
+    content = json.dumps(
+        [question, hex_code, _normalize_changing_lines(changing_lines_list), full_text],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return "sha256:" + hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def record_readings_bulk(user_id, records):
+    """Insert many readings in one transaction, skipping sync keys already stored.
+
+    `records` are dicts with sync_key, question, hex_code, changing_lines and
+    full_text. Returns {sync_key: (status, reading_id)} where status is
+    "created" or "duplicate".
+    """
+    if not records:
+        return {}
+
+    now = datetime.now(timezone.utc)
+    user = get_user_by_id(user_id) if user_id else None
+    subscriber = is_subscriber(user) if user else False
+    expires_at = now + timedelta(days=30) if subscriber else None
+
+    with get_pg() as conn, conn.cursor() as cur:
+        # Ids are drawn up front so each sync key can point at its reading
+        # before the readings themselves are inserted.
+        cur.execute(
+            """
+            SELECT nextval(pg_get_serial_sequence('readings', 'id')) AS id
+            FROM generate_series(1, %s)
+            """,
+            (len(records),),
+        )
+        new_ids = [int(r["id"]) for r in cur.fetchall()]
+
+        claimed_rows = psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO reading_sync_keys (user_id, sync_key, reading_id)
+            VALUES %s
+            ON CONFLICT (user_id, sync_key) DO NOTHING
+            RETURNING sync_key, reading_id
+            """,
+            [(user_id, rec["sync_key"], rid) for rec, rid in zip(records, new_ids)],
+            page_size=len(records),
+            fetch=True,
+        )
+        results = {row["sync_key"]: ("created", int(row["reading_id"])) for row in claimed_rows}
+
+        duplicate_keys = [rec["sync_key"] for rec in records if rec["sync_key"] not in results]
+        if duplicate_keys:
+            cur.execute(
+                """
+                SELECT sync_key, reading_id FROM reading_sync_keys
+                WHERE user_id=%s AND sync_key = ANY(%s)
+                """,
+                (user_id, duplicate_keys),
+            )
+            for row in cur.fetchall():
+                results[row["sync_key"]] = ("duplicate", int(row["reading_id"]))
+
+        values = []
+        for rec in records:
+            status, reading_id = results.get(rec["sync_key"], (None, None))
+            if status != "created":
+                continue
+            compressed = _compress(rec["full_text"], conn)
+            summary = _make_summary(rec["full_text"])
+            values.append(
+                (
+                    reading_id,
+                    user_id,
+                    rec["question"],
+                    rec["hex_code"],
+                    psycopg2.extras.Json(_normalize_changing_lines(rec["changing_lines"])),
+                    summary,
+                    psycopg2.Binary(compressed) if compressed is not None else None,
+                    None,
+                    False,
+                    expires_at,
+                    *search_documents(rec["question"], summary, rec["full_text"]),
+                )
+            )
+        if values:
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO readings (id, user_id, question, hexagram_code, changing_lines,
+                                      result_summary, result_full, derived_from,
+                                      is_pinned, expires_at, search_vector)
+                VALUES %s
+                """,
+                values,
+                template=f"(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,{SEARCH_VECTOR_SQL})",
+                page_size=len(values),
+            )
+            cur.execute(BUMP_READING_COUNT_SQL, (user_id, len(values)))
         conn.commit()
-        return row["id"] if row else None
+    mark_user_write(user_id)
+    return results
+
+# =====================
+# 分頁游標（keyset）
+# =====================
+def _encode_cursor(payload) -> str:
+    raw = json.dumps(payload, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+
+
+def _iso_or_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode_history_cursor(row: dict) -> str:
+    return _encode_cursor([bool(row["is_pinned"]), _iso_or_value(row["created_at"]), int(row["id"])])
+
+
+def decode_history_cursor(cursor: str):
+    """Return (is_pinned, created_at, id); raises ValueError on a malformed cursor."""
+    try:
+        is_pinned, created_at, reading_id = _decode_cursor(cursor)
+        return bool(is_pinned), datetime.fromisoformat(created_at), int(reading_id)
+    except Exception as exc:
+        raise ValueError("invalid_cursor") from exc
+
 
 # =====================
 # 列出歷史（摘要列表）
 # =====================
-def list_history(user_id, limit=100, offset=0, include_expired=False):
+def list_history(user_id, limit=100, offset=0, include_expired=False, cursor=None):
+    """List summaries newest first, pinned on top.
+
+    With `cursor` (from `encode_history_cursor` of the last row of the previous
+    page) the page is located by keyset on (is_pinned, created_at, id) and
+    `offset` is ignored. The total comes from `get_history_total`.
+    """
     now = datetime.now(timezone.utc)
+    where = ["user_id=%s"]
+    params = [user_id]
+    if not include_expired:
+        where.append("(is_pinned = TRUE OR expires_at IS NULL OR expires_at >= %s)")
+        params.append(now)
+
+    if cursor:
+        where.append("(is_pinned, created_at, id) < (%s, %s, %s)")
+        params.extend(decode_history_cursor(cursor))
+        offset = 0
+
+    sql = f"""
+        SELECT id, question, hexagram_code, changing_lines,
+               result_summary, derived_from, is_pinned,
+               expires_at, created_at
+        FROM readings
+        WHERE {" AND ".join(where)}
+        ORDER BY is_pinned DESC, created_at DESC, id DESC
+        LIMIT %s OFFSET %s
+    """
+    params.extend([limit, offset])
+    with get_read_pg(user_id) as conn, conn.cursor() as cur:
+        cur.execute(sql, tuple(params))
+        rows = cur.fetchall()
+
+    out = []
+    for r in rows:
+        item = dict(r)
+        try:
+            item["changing_lines"] = _normalize_changing_lines(item.get("changing_lines"))
+        except Exception:
+            item["changing_lines"] = []
+        out.append(item)
+    return out
+
+
+def get_history_total(user_id) -> int:
+    """Stored readings of the user, from reading_counts.
+
+    Readings past their expiry still count until the retention worker
+    deletes them (within RETENTION_INTERVAL_SECONDS).
+    """
+    with get_read_pg(user_id) as conn, conn.cursor() as cur:
+        cur.execute("SELECT total FROM reading_counts WHERE user_id=%s", (user_id,))
+        row = cur.fetchone() or {}
+        return int(row.get("total") or 0)
+
+
+def recount_history_total(user_id) -> int:
+    """Rebuild one user's reading_counts row from the readings table."""
     with get_pg() as conn, conn.cursor() as cur:
-        if include_expired:
-            cur.execute("""
-                SELECT id, question, hexagram_code, changing_lines,
-                       result_summary, derived_from, is_pinned,
-                       expires_at, created_at
-                FROM readings
-                WHERE user_id=%s
-                ORDER BY is_pinned DESC, created_at DESC
-                LIMIT %s OFFSET %s
-            """, (user_id, limit, offset))
-        else:
-            cur.execute("""
-                SELECT id, question, hexagram_code, changing_lines,
-                       result_summary, derived_from, is_pinned,
-                       expires_at, created_at
-                FROM readings
-                WHERE user_id=%s
-                  AND (is_pinned = TRUE OR expires_at IS NULL OR expires_at >= %s)
-                ORDER BY is_pinned DESC, created_at DESC
-                LIMIT %s OFFSET %s
-            """, (user_id, now, limit, offset))
+        cur.execute(
+            "INSERT INTO reading_counts (user_id, total) VALUES (%s, 0) ON CONFLICT (user_id) DO NOTHING",
+            (user_id,),
+        )
+        conn.commit()
+        # Writers bump the row after their insert/delete, so holding it
+        # makes them wait, and the count below (a fresh snapshot) already
+        # sees everything committed before the lock was granted.
+        cur.execute("SELECT total FROM reading_counts WHERE user_id=%s FOR UPDATE", (user_id,))
+        cur.execute("SELECT COUNT(*) AS total FROM readings WHERE user_id=%s", (user_id,))
+        total = int((cur.fetchone() or {}).get("total") or 0)
+        cur.execute(
+            "UPDATE reading_counts SET total=%s, updated_at=NOW() WHERE user_id=%s",
+            (total, user_id),
+        )
+        conn.commit()
+        return total
+
+
+def list_counted_user_ids() -> list:
+    """User ids that have readings or a reading_counts row, for a full recount."""
+    with get_read_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT user_id FROM reading_counts
+            UNION
+            SELECT DISTINCT user_id FROM readings WHERE user_id IS NOT NULL
+            """
+        )
+        return [r["user_id"] for r in cur.fetchall() or []]
+
+
+# =====================
+# 搜尋歷史
+# =====================
+def search_history(user_id, query, limit=20, offset=0):
+    """Rank a user's visible readings against `query`; every query term must match.
+
+    Matches in the question weigh more than in the summary, which weigh more
+    than in the full text (when indexed). Returns up to `limit` rows, each
+    with a `rank`.
+    """
+    terms = search_query_terms(query)
+    if not terms:
+        return []
+    now = datetime.now(timezone.utc)
+    sql = """
+    SELECT id, question, hexagram_code, changing_lines, result_summary,
+           is_pinned, created_at, ts_rank(search_vector, q) AS rank
+    FROM readings, plainto_tsquery('simple', %s) AS q
+    WHERE user_id=%s
+      AND search_vector @@ q
+      AND (is_pinned = TRUE OR expires_at IS NULL OR expires_at >= %s)
+    ORDER BY rank DESC, created_at DESC, id DESC
+    LIMIT %s OFFSET %s
+    """
+    with get_read_pg(user_id) as conn, conn.cursor() as cur:
+        cur.execute(sql, (" ".join(terms), user_id, now, limit, offset))
         rows = cur.fetchall()
 
     out = []
@@ -170,23 +537,113 @@ def list_history(user_id, limit=100, offset=0, include_expired=False):
 # =====================
 # 讀取單筆全文
 # =====================
+class _TextLRU:
+    """Small thread-safe LRU of decompressed reading texts, keyed by reading id."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+# result_full never changes after insert, so cached texts never go stale.
+_DETAIL_TEXT_CACHE = _TextLRU(HISTORY_TEXT_CACHE_SIZE)
+
+DETAIL_COLUMNS = """id, user_id, question, hexagram_code, changing_lines,
+                    result_summary, derived_from, is_pinned, expires_at,
+                    created_at, updated_at"""
+
+
+def history_detail_etag(row: dict) -> str:
+    """Strong validator for a detail response: the text is immutable, only the pin can change."""
+    created_at = _iso_or_value(row.get("created_at"))
+    raw = f"{int(row['id'])}|{created_at}|{int(bool(row.get('is_pinned')))}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def get_history_detail_meta(user_id, reading_id):
+    """Fields needed for the ETag, without touching the compressed text."""
+    with get_read_pg(user_id) as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT id, created_at, is_pinned FROM readings WHERE id=%s AND user_id=%s",
+            (reading_id, user_id),
+        )
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
+def _detail_from_row(row, cached_text=None) -> dict:
+    d = dict(row)
+    try:
+        d["changing_lines"] = _normalize_changing_lines(d.get("changing_lines"))
+    except Exception:
+        d["changing_lines"] = []
+    if cached_text is None:
+        cached_text = _decompress(d.get("result_full"))
+        _DETAIL_TEXT_CACHE.put(d["id"], cached_text)
+    d["result_full_text"] = cached_text
+    d.pop("result_full", None)
+    return d
+
+
 def get_history_detail(user_id, reading_id):
-    sql = """
-    SELECT * FROM readings WHERE id=%s AND user_id=%s
+    # Skip fetching the blob when its text is already cached.
+    cached_text = _DETAIL_TEXT_CACHE.get(reading_id)
+    blob_column = "NULL::bytea" if cached_text is not None else "result_full"
+    sql = f"""
+    SELECT {DETAIL_COLUMNS}, {blob_column} AS result_full
+    FROM readings WHERE id=%s AND user_id=%s
     """
-    with get_pg() as conn, conn.cursor() as cur:
+    with get_read_pg(user_id) as conn, conn.cursor() as cur:
         cur.execute(sql, (reading_id, user_id))
         row = cur.fetchone()
-        if not row:
-            return None
-        d = dict(row)
-        try:
-            d["changing_lines"] = _normalize_changing_lines(d.get("changing_lines"))
-        except Exception:
-            d["changing_lines"] = []
-        d["result_full_text"] = _decompress(d.get("result_full"))
-        d.pop("result_full", None)
-        return d
+    if not row:
+        return None
+    return _detail_from_row(row, cached_text)
+
+def iter_history_details(user_id, reading_ids):
+    """Fetch several readings of one user in a single query, yielding them in request order.
+
+    Texts are decompressed lazily as the caller iterates; ids that are
+    missing or belong to someone else are skipped.
+    """
+    ids = list(dict.fromkeys(int(rid) for rid in reading_ids))
+    if not ids:
+        return
+    cached = {}
+    for rid in ids:
+        text = _DETAIL_TEXT_CACHE.get(rid)
+        if text is not None:
+            cached[rid] = text
+    sql = f"""
+    SELECT {DETAIL_COLUMNS},
+           CASE WHEN id = ANY(%s) THEN NULL ELSE result_full END AS result_full
+    FROM readings
+    WHERE user_id=%s AND id = ANY(%s)
+    """
+    with get_read_pg(user_id) as conn, conn.cursor() as cur:
+        cur.execute(sql, (list(cached), user_id, ids))
+        rows = {int(row["id"]): row for row in cur.fetchall() or []}
+    for rid in ids:
+        row = rows.get(rid)
+        if row is not None:
+            yield _detail_from_row(row, cached.get(rid))
 
 # =====================
 # Pin / Unpin
@@ -200,7 +657,7 @@ def set_pin(user_id, reading_id, pin):
         if pin:
             cur.execute("""
                 UPDATE readings
-                SET is_pinned=TRUE, expires_at=NULL
+                SET is_pinned=TRUE, expires_at=NULL, updated_at=NOW()
                 WHERE id=%s AND user_id=%s
                 RETURNING id
             """, (reading_id, user_id))
@@ -208,43 +665,281 @@ def set_pin(user_id, reading_id, pin):
             new_exp = (now + timedelta(days=30)) if subscriber else None
             cur.execute("""
                 UPDATE readings
-                SET is_pinned=FALSE, expires_at=%s
+                SET is_pinned=FALSE, expires_at=%s, updated_at=NOW()
                 WHERE id=%s AND user_id=%s
                 RETURNING id
             """, (new_exp, reading_id, user_id))
         row = cur.fetchone()
         conn.commit()
-        return bool(row)
+    mark_user_write(user_id)
+    return bool(row)
 
 
 def delete_reading(user_id, reading_id):
     with get_pg() as conn, conn.cursor() as cur:
         cur.execute(
             """
-            DELETE FROM readings
-            WHERE id=%s AND user_id=%s
-            RETURNING id
+            WITH deleted AS (
+                DELETE FROM readings
+                WHERE id=%s AND user_id=%s
+                RETURNING id, user_id
+            )
+            -- The reading's sync keys stay until prune_sync_keys ages them
+            -- out, so a client retrying the sync gets a duplicate instead
+            -- of bringing the reading back.
+            INSERT INTO reading_tombstones (reading_id, user_id)
+            SELECT id, user_id FROM deleted
+            ON CONFLICT (reading_id) DO UPDATE SET deleted_at = NOW(), change_xid = pg_current_xact_id()
+            RETURNING reading_id
             """,
             (reading_id, user_id),
         )
         row = cur.fetchone()
+        if row:
+            cur.execute(BUMP_READING_COUNT_SQL, (user_id, -1))
         conn.commit()
-        return bool(row)
+    mark_user_write(user_id)
+    return bool(row)
 
 # =====================
 # 清理過期紀錄
 # =====================
 def delete_expired(limit=1000):
+    """Delete at most `limit` expired, unpinned readings in one short transaction."""
     now = datetime.now(timezone.utc)
     with get_pg() as conn, conn.cursor() as cur:
         cur.execute("""
-            DELETE FROM readings
-            WHERE is_pinned = FALSE
-              AND expires_at IS NOT NULL
-              AND expires_at < %s
-            RETURNING id
-        """, (now,))
-        rows = cur.fetchall() or []
+            WITH deleted AS (
+                DELETE FROM readings
+                WHERE id IN (
+                    SELECT id FROM readings
+                    WHERE is_pinned = FALSE
+                      AND expires_at IS NOT NULL
+                      AND expires_at < %s
+                    ORDER BY expires_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, user_id
+            ),
+            tombstones AS (
+                INSERT INTO reading_tombstones (reading_id, user_id)
+                SELECT id, user_id FROM deleted WHERE user_id IS NOT NULL
+                ON CONFLICT (reading_id) DO NOTHING
+            ),
+            counts AS (
+                INSERT INTO reading_counts (user_id, total, updated_at)
+                SELECT user_id, -COUNT(*), NOW() FROM deleted
+                WHERE user_id IS NOT NULL
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE
+                SET total = GREATEST(reading_counts.total + EXCLUDED.total, 0), updated_at = NOW()
+            )
+            SELECT COUNT(*) AS deleted FROM deleted
+        """, (now, limit))
+        deleted = int((cur.fetchone() or {}).get("deleted", 0))
+        conn.commit()
+        return deleted
+
+
+def prune_tombstones(retention_days=TOMBSTONE_RETENTION_DAYS):
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM reading_tombstones WHERE deleted_at < NOW() - make_interval(days => %s)",
+            (retention_days,),
+        )
+        pruned = cur.rowcount
+        conn.commit()
+        return pruned
+
+
+def prune_sync_keys(retention_days=SYNC_KEY_RETENTION_DAYS):
+    """Forget sync keys older than the client retry window."""
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM reading_sync_keys WHERE created_at < NOW() - make_interval(days => %s)",
+            (retention_days,),
+        )
+        pruned = cur.rowcount
         conn.commit()
-        return len(rows)
+        return pruned
+
+# =====================
+# 增量同步（change feed）
+# =====================
+# pg_snapshot text: xmin:xmax:xip_list
+_SNAPSHOT_RE = re.compile(r"^\d+:\d+:(\d+(,\d+)*)?$")
+
+
+def encode_changes_cursor(position: dict) -> str:
+    return _encode_cursor(
+        {
+            "s": position["since"],
+            "a": _iso_or_value(position["since_at"]),
+            "w": position["window"],
+            "wa": _iso_or_value(position["window_at"]),
+            "u": position["changed_after"],
+            "d": position["deleted_after"],
+        }
+    )
+
+
+def decode_changes_cursor(cursor: str) -> dict:
+    """Return the cursor position; raises ValueError when malformed.
+
+    Cursors of the earlier timestamp-keyed feed raise ChangesCursorExpired,
+    so those clients resync once.
+    """
+    try:
+        payload = _decode_cursor(cursor)
+    except Exception as exc:
+        raise ValueError("invalid_cursor") from exc
+    if isinstance(payload, dict) and isinstance(payload.get("u"), list):
+        raise ChangesCursorExpired()
+    try:
+        position = {
+            "since": payload["s"],
+            "since_at": datetime.fromisoformat(payload["a"]) if payload["s"] else None,
+            "window": payload["w"],
+            "window_at": datetime.fromisoformat(payload["wa"]) if payload["w"] else None,
+            "changed_after": None if payload["u"] is None else int(payload["u"]),
+            "deleted_after": None if payload["d"] is None else int(payload["d"]),
+        }
+    except Exception as exc:
+        raise ValueError("invalid_cursor") from exc
+    for key in ("since", "window"):
+        if position[key] is not None and not _SNAPSHOT_RE.match(str(position[key])):
+            raise ValueError("invalid_cursor")
+    return position
+
+
+def list_history_changes(user_id, cursor=None, limit=200):
+    """Readings inserted/updated and tombstones written since `cursor`.
+
+    Every reading and tombstone carries change_xid, the id of the
+    transaction that last wrote it. A cursor holds the database snapshot
+    its previous window was read under; the next window returns the rows
+    that snapshot could not see, so a write is delivered once it commits,
+    whatever its order, and an open transaction elsewhere holds nothing
+    back. A window is paged by id under a snapshot fixed at its first page;
+    a row written meanwhile may be delivered again by the next window.
+    Returns a dict with `changed` rows, `deleted` ids, `next_cursor` and
+    `has_more`. Raises ChangesCursorExpired when tombstones since the
+    cursor were already pruned.
+    """
+    if cursor:
+        position = decode_changes_cursor(cursor)
+    else:
+        position = {
+            "since": None,
+            "since_at": None,
+            "window": None,
+            "window_at": None,
+            "changed_after": 0,
+            "deleted_after": 0,
+        }
+
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT pg_current_snapshot()::text AS snapshot,
+                   LOCALTIMESTAMP AS taken_at,
+                   LOCALTIMESTAMP - make_interval(days => %s) AS horizon
+            """,
+            (TOMBSTONE_RETENTION_DAYS,),
+        )
+        bounds = cur.fetchone()
+        if position["since_at"] is not None and position["since_at"] < bounds["horizon"]:
+            raise ChangesCursorExpired()
+        if position["window"] is None:
+            # Taken before the reads below, so anything this window misses
+            # is invisible to it and falls into the next one.
+            position["window"] = bounds["snapshot"]
+            position["window_at"] = bounds["taken_at"]
+
+        changed = []
+        if position["changed_after"] is not None:
+            cur.execute(
+                """
+                SELECT id, question, hexagram_code, changing_lines,
+                       result_summary, is_pinned, expires_at, created_at, updated_at
+                FROM readings
+                WHERE user_id=%s
+                  AND id > %s
+                  AND (%s::pg_snapshot IS NULL
+                       OR (change_xid >= pg_snapshot_xmin(%s::pg_snapshot)
+                           AND NOT pg_visible_in_snapshot(change_xid, %s::pg_snapshot)))
+                ORDER BY id
+                LIMIT %s
+                """,
+                (
+                    user_id,
+                    position["changed_after"],
+                    position["since"],
+                    position["since"],
+                    position["since"],
+                    limit + 1,
+                ),
+            )
+            changed = [dict(r) for r in cur.fetchall()]
+
+        deleted = []
+        if position["deleted_after"] is not None:
+            cur.execute(
+                """
+                SELECT reading_id
+                FROM reading_tombstones
+                WHERE user_id=%s
+                  AND reading_id > %s
+                  AND (%s::pg_snapshot IS NULL
+                       OR (change_xid >= pg_snapshot_xmin(%s::pg_snapshot)
+                           AND NOT pg_visible_in_snapshot(change_xid, %s::pg_snapshot)))
+                ORDER BY reading_id
+                LIMIT %s
+                """,
+                (
+                    user_id,
+                    position["deleted_after"],
+                    position["since"],
+                    position["since"],
+                    position["since"],
+                    limit + 1,
+                ),
+            )
+            deleted = [dict(r) for r in cur.fetchall()]
+
+    # A stream that hit the limit resumes after its last id; one that was
+    # read to the end is done for this window.
+    has_more = len(changed) > limit or len(deleted) > limit
+    if len(changed) > limit:
+        changed = changed[:limit]
+        position["changed_after"] = int(changed[-1]["id"])
+    else:
+        position["changed_after"] = None
+    if len(deleted) > limit:
+        deleted = deleted[:limit]
+        position["deleted_after"] = int(deleted[-1]["reading_id"])
+    else:
+        position["deleted_after"] = None
+    if not has_more:
+        position = {
+            "since": position["window"],
+            "since_at": position["window_at"],
+            "window": None,
+            "window_at": None,
+            "changed_after": 0,
+            "deleted_after": 0,
+        }
+
+    for item in changed:
+        try:
+            item["changing_lines"] = _normalize_changing_lines(item.get("changing_lines"))
+        except Exception:
+            item["changing_lines"] = []
 
+    return {
+        "changed": changed,
+        "deleted": [int(r["reading_id"]) for r in deleted],
+        "next_cursor": encode_changes_cursor(position),
+        "has_more": has_more,
+    }
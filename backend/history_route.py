@@ -1,20 +1,42 @@
 import datetime
+import json
 import traceback
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 
-from auth_route import decode_session_token
+from auth_middleware import current_user_id, require_auth
+from history_export import iter_export_chunks
 from history_repo import (
+    ChangesCursorExpired,
+    decode_history_cursor,
     delete_reading,
+    encode_history_cursor,
     get_history_detail,
-    get_pg,
+    get_history_detail_meta,
+    get_history_total,
+    history_detail_etag,
+    iter_history_details,
     list_history,
-    record_reading,
+    list_history_changes,
+    make_sync_key,
+    record_readings_bulk,
+    search_history,
+    search_query_terms,
     set_pin,
 )
 
 history_bp = Blueprint("history", __name__, url_prefix="/history")
 
+MAX_SYNC_RECORDS = 500
+MAX_SYNC_QUESTION_LENGTH = 1000
+MAX_CLIENT_RECORD_ID_LENGTH = 128
+# Pins can change, so clients must revalidate; the ETag makes that a 304.
+DETAIL_CACHE_CONTROL = "private, no-cache"
+MAX_DETAIL_BATCH = 100
+MAX_SEARCH_QUERY_LENGTH = 200
+# Larger batches are streamed as NDJSON so the first items arrive before the last is decompressed.
+DETAIL_BATCH_STREAM_THRESHOLD = 20
+
 
 def _to_iso_or_now(value):
     if isinstance(value, datetime.datetime):
@@ -24,35 +46,6 @@ def _to_iso_or_now(value):
     return datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
 
 
-def _get_user_from_auth():
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return None, jsonify({"error": "invalid_or_expired_token"}), 401
-
-    token = auth_header.split(" ", 1)[1].strip()
-    payload = decode_session_token(token)
-    if not payload:
-        return None, jsonify({"error": "invalid_or_expired_token"}), 401
-
-    return payload["sub"], None, None
-
-
-def _count_visible_history(user_id: str) -> int:
-    now = datetime.datetime.now(datetime.timezone.utc)
-    with get_pg() as conn, conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT COUNT(*) AS total
-            FROM readings
-            WHERE user_id=%s
-              AND (is_pinned = TRUE OR expires_at IS NULL OR expires_at >= %s)
-            """,
-            (user_id, now),
-        )
-        row = cur.fetchone() or {}
-        return int(row.get("total", 0))
-
-
 def _to_detail_response(item: dict) -> dict:
     return {
         "reading_id": int(item["id"]),
@@ -66,10 +59,9 @@ def _to_detail_response(item: dict) -> dict:
 
 
 @history_bp.route("/list", methods=["GET"])
+@require_auth
 def list_user_history():
-    user_id, err_resp, code = _get_user_from_auth()
-    if not user_id:
-        return err_resp, code
+    user_id = current_user_id()
 
     try:
         limit = int(request.args.get("limit", 100))
@@ -80,8 +72,27 @@ def list_user_history():
     if limit < 1 or limit > 200 or offset < 0:
         return jsonify({"error": "missing_or_invalid_fields"}), 400
 
+    cursor = (request.args.get("cursor") or "").strip() or None
+    if cursor:
+        try:
+            decode_history_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "missing_or_invalid_fields"}), 400
+
+    include_total = (request.args.get("include_total") or "true").strip().lower() not in {"0", "false", "no"}
+
     try:
-        rows = list_history(user_id, limit=limit, offset=offset, include_expired=False)
+        # Fetch one extra row to know whether another page exists.
+        rows = list_history(
+            user_id,
+            limit=limit + 1,
+            offset=offset,
+            include_expired=False,
+            cursor=cursor,
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_history_cursor(rows[-1]) if has_more and rows else None
         items = [
             {
                 "reading_id": int(row["id"]),
@@ -93,34 +104,203 @@ def list_user_history():
             }
             for row in rows
         ]
-        total = _count_visible_history(user_id)
-        return jsonify({"items": items, "total": total})
+        total = None
+        if include_total:
+            # A first page that holds everything is exact; otherwise the
+            # maintained counter (one row lookup, no scan).
+            total = len(rows) if offset == 0 and not cursor and not has_more else get_history_total(user_id)
+        return jsonify({"items": items, "total": total, "next_cursor": next_cursor})
+    except Exception:
+        traceback.print_exc()
+        return jsonify({"error": "server_error"}), 500
+
+
+@history_bp.route("/search", methods=["GET"])
+@require_auth
+def history_search():
+    user_id = current_user_id()
+
+    query = (request.args.get("q") or "").strip()
+    try:
+        limit = int(request.args.get("limit", 20))
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+    if limit < 1 or limit > 50 or offset < 0 or len(query) > MAX_SEARCH_QUERY_LENGTH:
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+    if not search_query_terms(query):
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+
+    try:
+        rows = search_history(user_id, query, limit=limit + 1, offset=offset)
     except Exception:
         traceback.print_exc()
         return jsonify({"error": "server_error"}), 500
 
+    has_more = len(rows) > limit
+    items = [
+        {
+            "reading_id": int(row["id"]),
+            "question": row.get("question", ""),
+            "summary": row.get("result_summary") or "",
+            "created_at": _to_iso_or_now(row.get("created_at")),
+            "is_pinned": bool(row.get("is_pinned", False)),
+            "hexagram_code": row.get("hexagram_code", ""),
+            "changing_lines": row.get("changing_lines") or [],
+            "rank": round(float(row.get("rank") or 0), 6),
+        }
+        for row in rows[:limit]
+    ]
+    return jsonify({"items": items, "next_offset": offset + limit if has_more else None})
+
+
+@history_bp.route("/changes", methods=["GET"])
+@require_auth
+def history_changes():
+    user_id = current_user_id()
+
+    try:
+        limit = int(request.args.get("limit", 200))
+    except ValueError:
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+    if limit < 1 or limit > 500:
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+
+    since = (request.args.get("since") or "").strip() or None
+    try:
+        result = list_history_changes(user_id, cursor=since, limit=limit)
+    except ValueError:
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+    except ChangesCursorExpired:
+        return jsonify({"error": "cursor_expired"}), 410
+    except Exception:
+        traceback.print_exc()
+        return jsonify({"error": "server_error"}), 500
+
+    changed = [
+        {
+            "reading_id": int(row["id"]),
+            "question": row.get("question", ""),
+            "created_at": _to_iso_or_now(row.get("created_at")),
+            "updated_at": _to_iso_or_now(row.get("updated_at")),
+            "is_pinned": bool(row.get("is_pinned", False)),
+            "hexagram_code": row.get("hexagram_code", ""),
+            "changing_lines": row.get("changing_lines") or [],
+        }
+        for row in result["changed"]
+    ]
+    return jsonify(
+        {
+            "changed": changed,
+            "deleted": result["deleted"],
+            "next_cursor": result["next_cursor"],
+            "has_more": result["has_more"],
+        }
+    )
+
 
 @history_bp.route("/detail/<int:reading_id>", methods=["GET"])
+@require_auth
 def history_detail(reading_id):
-    user_id, err_resp, code = _get_user_from_auth()
-    if not user_id:
-        return err_resp, code
+    user_id = current_user_id()
 
     try:
+        if request.if_none_match:
+            meta = get_history_detail_meta(user_id, reading_id)
+            if not meta:
+                return jsonify({"error": "not_found"}), 404
+            etag = history_detail_etag(meta)
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                resp.headers["Cache-Control"] = DETAIL_CACHE_CONTROL
+                return resp
+
         item = get_history_detail(user_id, reading_id)
         if not item:
             return jsonify({"error": "not_found"}), 404
-        return jsonify(_to_detail_response(item))
+        resp = jsonify(_to_detail_response(item))
+        resp.set_etag(history_detail_etag(item))
+        resp.headers["Cache-Control"] = DETAIL_CACHE_CONTROL
+        return resp
     except Exception:
         traceback.print_exc()
         return jsonify({"error": "server_error"}), 500
 
 
+@history_bp.route("/detail/batch", methods=["POST"])
+@require_auth
+def history_detail_batch():
+    user_id = current_user_id()
+
+    data = request.get_json(silent=True) or {}
+    raw_ids = data.get("reading_ids")
+    if not isinstance(raw_ids, list) or not raw_ids:
+        return jsonify({"error": "missing_or_invalid_fields"}), 400
+    if len(raw_ids) > MAX_DETAIL_BATCH:
+        return jsonify({"error": "too_many_ids", "max_ids": MAX_DETAIL_BATCH}), 400
+    reading_ids = []
+    for raw in raw_ids:
+        if isinstance(raw, bool) or not isinstance(raw, int) or raw < 1:
+            return jsonify({"error": "missing_or_invalid_fields"}), 400
+        reading_ids.append(raw)
+
+    wants_stream = "application/x-ndjson" in (request.headers.get("Accept") or "")
+    if wants_stream or len(reading_ids) > DETAIL_BATCH_STREAM_THRESHOLD:
+
+        def generate():
+            found = set()
+            try:
+                for item in iter_history_details(user_id, reading_ids):
+                    found.add(int(item["id"]))
+                    yield json.dumps(_to_detail_response(item), ensure_ascii=False) + "\n"
+            except Exception:
+                traceback.print_exc()
+                yield json.dumps({"error": "server_error"}) + "\n"
+                return
+            missing = [rid for rid in dict.fromkeys(reading_ids) if rid not in found]
+            yield json.dumps({"missing": missing}) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    try:
+        items = [_to_detail_response(item) for item in iter_history_details(user_id, reading_ids)]
+    except Exception:
+        traceback.print_exc()
+        return jsonify({"error": "server_error"}), 500
+    found = {item["reading_id"] for item in items}
+    missing = [rid for rid in dict.fromkeys(reading_ids) if rid not in found]
+    return jsonify({"items": items, "missing": missing})
+
+
+@history_bp.route("/export", methods=["GET"])
+@require_auth
+def history_export():
+    user_id = current_user_id()
+
+    compress = (request.args.get("gzip") or "").strip().lower() in {"1", "true", "yes"}
+    filename = "history.ndjson.gz" if compress else "history.ndjson"
+
+    def generate():
+        try:
+            yield from iter_export_chunks(user_id, compress=compress)
+        except Exception:
+            # Headers are already sent; a truncated body is the only signal left.
+            traceback.print_exc()
+
+    resp = Response(
+        stream_with_context(generate()),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+    )
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    resp.headers["Cache-Control"] = "private, no-store"
+    return resp
+
+
 @history_bp.route("/pin", methods=["POST"])
+@require_auth
 def history_pin():
-    user_id, err_resp, code = _get_user_from_auth()
-    if not user_id:
-        return err_resp, code
+    user_id = current_user_id()
 
     data = request.get_json(silent=True) or {}
     reading_id = data.get("reading_id")
@@ -148,42 +328,93 @@ def history_pin():
         return jsonify({"error": "server_error"}), 500
 
 
+def _parse_sync_record(rec):
+    if not isinstance(rec, dict):
+        return None
+
+    question = rec.get("question", "")
+    hexagram_code = rec.get("hexagram_code", "")
+    result_text = rec.get("result_text", "")
+    changing_lines = rec.get("changing_lines", [])
+    client_record_id = rec.get("client_record_id")
+
+    if not isinstance(question, str) or not question.strip() or len(question) > MAX_SYNC_QUESTION_LENGTH:
+        return None
+    if not isinstance(hexagram_code, str) or not isinstance(result_text, str):
+        return None
+    if client_record_id is not None:
+        if isinstance(client_record_id, bool) or not isinstance(client_record_id, (str, int)):
+            return None
+        client_record_id = str(client_record_id).strip()
+        if not client_record_id or len(client_record_id) > MAX_CLIENT_RECORD_ID_LENGTH:
+            return None
+
+    return {
+        "client_record_id": client_record_id,
+        "sync_key": make_sync_key(client_record_id, question, hexagram_code, changing_lines, result_text),
+        "question": question,
+        "hex_code": hexagram_code,
+        "changing_lines": changing_lines,
+        "full_text": result_text,
+    }
+
+
 @history_bp.route("/sync", methods=["POST"])
+@require_auth
 def history_sync():
-    user_id, err_resp, code = _get_user_from_auth()
-    if not user_id:
-        return err_resp, code
+    user_id = current_user_id()
 
     data = request.get_json(silent=True) or {}
     records = data.get("records", [])
     if not isinstance(records, list):
         return jsonify({"error": "invalid_records"}), 400
+    if len(records) > MAX_SYNC_RECORDS:
+        return jsonify({"error": "too_many_records", "max_records": MAX_SYNC_RECORDS}), 400
+
+    results = []
+    to_insert = []
+    seen_keys = set()
+    for index, rec in enumerate(records):
+        parsed = _parse_sync_record(rec)
+        client_record_id = rec.get("client_record_id") if isinstance(rec, dict) else None
+        results.append({"index": index, "client_record_id": client_record_id, "status": "invalid", "reading_id": None})
+        if not parsed:
+            continue
+        results[-1]["sync_key"] = parsed["sync_key"]
+        if parsed["sync_key"] not in seen_keys:
+            seen_keys.add(parsed["sync_key"])
+            to_insert.append(parsed)
 
-    saved_ids = []
-    for rec in records:
-        try:
-            rid = record_reading(
-                user_id=user_id,
-                question=rec.get("question", ""),
-                hex_code=rec.get("hexagram_code", ""),
-                changing_lines_list=rec.get("changing_lines", []),
-                full_text=rec.get("result_text", ""),
-                derived_from=None,
-                is_pinned=False,
-            )
-            if rid:
-                saved_ids.append(rid)
-        except Exception:
-            traceback.print_exc()
+    try:
+        stored = record_readings_bulk(user_id, to_insert)
+    except Exception:
+        traceback.print_exc()
+        return jsonify({"error": "server_error"}), 500
 
-    return jsonify({"ok": True, "saved_count": len(saved_ids), "saved_ids": saved_ids})
+    saved_ids = []
+    first_index_for_key = {}
+    for item in results:
+        sync_key = item.pop("sync_key", None)
+        if not sync_key or sync_key not in stored:
+            continue
+        status, reading_id = stored[sync_key]
+        if sync_key in first_index_for_key:
+            # Same record repeated within one request.
+            status = "duplicate"
+        else:
+            first_index_for_key[sync_key] = item["index"]
+        item["status"] = status
+        item["reading_id"] = reading_id
+        if status == "created":
+            saved_ids.append(reading_id)
+
+    return jsonify({"ok": True, "saved_count": len(saved_ids), "saved_ids": saved_ids, "results": results})
 
 
 @history_bp.route("/delete", methods=["POST"])
+@require_auth
 def history_delete():
-    user_id, err_resp, code = _get_user_from_auth()
-    if not user_id:
-        return err_resp, code
+    user_id = current_user_id()
 
     data = request.get_json(silent=True) or {}
     reading_id = data.get("reading_id")
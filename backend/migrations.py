@@ -0,0 +1,817 @@
+import os
+import sys
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+# Fixed key for pg_advisory_lock: only one runner applies migrations at a time.
+MIGRATION_LOCK_KEY = 73_310_042
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_bool_env(var_name: str, default_value: bool) -> bool:
+    raw = (os.getenv(var_name) or "").strip().lower()
+    if not raw:
+        return default_value
+    return raw in {"1", "true", "yes", "on"}
+
+
+# DDL gives up instead of queueing behind long transactions (and stalling
+# every query queued behind it); rerun the release step if it times out.
+MIGRATION_LOCK_TIMEOUT_MS = _parse_int_env("MIGRATION_LOCK_TIMEOUT_MS", 10000)
+LEGACY_REMAP_BATCH_SIZE = 50000
+RUN_MIGRATIONS_ON_BOOT = _parse_bool_env("RUN_MIGRATIONS_ON_BOOT", False)
+
+
+def get_pg():
+    return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+# =====================
+# users / auth_providers
+# =====================
+def _table_exists(cur, table_name: str) -> bool:
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL AS ok", (f"public.{table_name}",))
+    row = cur.fetchone() or {}
+    return bool(row.get("ok"))
+
+
+def _column_exists(cur, table_name: str, column_name: str) -> bool:
+    cur.execute(
+        """
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_schema='public' AND table_name=%s AND column_name=%s
+        LIMIT 1
+        """,
+        (table_name, column_name),
+    )
+    return bool(cur.fetchone())
+
+
+def _column_data_type(cur, table_name: str, column_name: str) -> str | None:
+    cur.execute(
+        """
+        SELECT data_type
+        FROM information_schema.columns
+        WHERE table_schema='public' AND table_name=%s AND column_name=%s
+        """,
+        (table_name, column_name),
+    )
+    row = cur.fetchone() or {}
+    return row.get("data_type")
+
+
+def _ensure_users_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+          id UUID PRIMARY KEY,
+          email TEXT,
+          display_name TEXT,
+          silver_coins INTEGER NOT NULL DEFAULT 0,
+          plan TEXT NOT NULL DEFAULT 'free',
+          gold INTEGER NOT NULL DEFAULT 0,
+          ask_count INTEGER NOT NULL DEFAULT 0,
+          subscribed_until TIMESTAMP WITH TIME ZONE NULL,
+          last_login_at TIMESTAMP NULL,
+          created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+          updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS email TEXT;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS display_name TEXT;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS silver_coins INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS plan TEXT NOT NULL DEFAULT 'free';")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS gold INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ask_count INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS subscribed_until TIMESTAMP WITH TIME ZONE NULL;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMP NULL;")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT NOW();")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT NOW();")
+
+
+def _ensure_auth_providers_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS auth_providers (
+          id SERIAL PRIMARY KEY,
+          user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+          provider TEXT NOT NULL,
+          provider_uid TEXT NOT NULL,
+          created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+          updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+          UNIQUE(provider, provider_uid),
+          UNIQUE(user_id, provider)
+        );
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_auth_providers_user ON auth_providers (user_id);")
+
+
+def _legacy_column(columns: set, name: str, default_sql: str) -> str:
+    """SQL for users_legacy.<name>, or a default when that legacy schema never had the column."""
+    return f"l.{name}" if name in columns else default_sql
+
+
+def _migrate_legacy_users_if_needed(cur):
+    """Move a pre-UUID users table to users + auth_providers with set-based SQL.
+
+    Old ids are mapped in legacy_user_map (kept afterwards for support
+    lookups): an identity that already has an auth_providers row keeps its
+    user, otherwise it gets a UUID derived from provider and provider uid,
+    so reruns produce the same ids. Dependent tables are only queued in
+    legacy_user_remap here; run_migrations rewrites them afterwards, one
+    committed id range at a time (see _run_legacy_remaps).
+    """
+    if not _table_exists(cur, "users"):
+        return
+
+    has_provider_col = _column_exists(cur, "users", "provider")
+    has_legacy_coins_col = _column_exists(cur, "users", "coins")
+    id_data_type = _column_data_type(cur, "users", "id")
+    is_uuid_pk = id_data_type == "uuid"
+    needs_migration = has_provider_col or has_legacy_coins_col or not is_uuid_pk
+
+    if not needs_migration:
+        return
+
+    if not _table_exists(cur, "users_legacy"):
+        cur.execute("ALTER TABLE users RENAME TO users_legacy;")
+
+    _ensure_users_table(cur)
+    _ensure_auth_providers_table(cur)
+
+    if not _table_exists(cur, "users_legacy"):
+        return
+
+    cur.execute(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema='public' AND table_name='users_legacy'
+        """
+    )
+    columns = {row["column_name"] for row in cur.fetchall() or []}
+    provider_sql = _legacy_column(columns, "provider", "NULL")
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS legacy_user_map (
+          old_id TEXT PRIMARY KEY,
+          provider TEXT NOT NULL,
+          provider_uid TEXT NOT NULL,
+          new_id UUID,
+          is_new BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """
+    )
+    # Same rules as the old per-row code: strip a "<provider>:" prefix,
+    # else anything up to the first ":", and fall back to the whole id.
+    cur.execute(
+        f"""
+        INSERT INTO legacy_user_map (old_id, provider, provider_uid)
+        SELECT old_id, provider,
+               COALESCE(NULLIF(
+                 CASE
+                   WHEN left(old_id, length(provider) + 1) = provider || ':'
+                     THEN substr(old_id, length(provider) + 2)
+                   WHEN strpos(old_id, ':') > 0
+                     THEN substr(old_id, strpos(old_id, ':') + 1)
+                   ELSE old_id
+                 END, ''), old_id)
+        FROM (
+          SELECT trim(l.id::text) AS old_id,
+                 COALESCE(NULLIF(lower(trim({provider_sql}::text)), ''), 'google') AS provider
+          FROM users_legacy l
+        ) src
+        WHERE old_id <> ''
+        ON CONFLICT (old_id) DO NOTHING
+        """
+    )
+    print(f"migrations: legacy users mapped: {cur.rowcount}")
+
+    cur.execute(
+        """
+        UPDATE legacy_user_map m
+        SET new_id = ap.user_id
+        FROM auth_providers ap
+        WHERE m.new_id IS NULL
+          AND ap.provider = m.provider
+          AND ap.provider_uid = m.provider_uid
+        """
+    )
+    print(f"migrations: legacy users matched to existing identities: {cur.rowcount}")
+    cur.execute(
+        """
+        UPDATE legacy_user_map
+        SET new_id = md5('legacy:' || provider || ':' || provider_uid)::uuid,
+            is_new = TRUE
+        WHERE new_id IS NULL
+        """
+    )
+
+    cur.execute(
+        f"""
+        INSERT INTO users (
+          id, email, display_name, silver_coins, plan, gold, ask_count,
+          subscribed_until, last_login_at, created_at, updated_at
+        )
+        SELECT DISTINCT ON (m.new_id)
+               m.new_id,
+               {_legacy_column(columns, "email", "NULL")},
+               {_legacy_column(columns, "display_name", "NULL")},
+               COALESCE({_legacy_column(columns, "coins", "NULL")}, 0),
+               COALESCE(NULLIF({_legacy_column(columns, "plan", "NULL")}::text, ''), 'free'),
+               COALESCE({_legacy_column(columns, "gold", "NULL")}, 0),
+               COALESCE({_legacy_column(columns, "ask_count", "NULL")}, 0),
+               {_legacy_column(columns, "subscribed_until", "NULL")},
+               {_legacy_column(columns, "last_login_at", "NULL")},
+               COALESCE({_legacy_column(columns, "created_at", "NULL")}, NOW()),
+               COALESCE({_legacy_column(columns, "updated_at", "NULL")}, NOW())
+        FROM legacy_user_map m
+        JOIN users_legacy l ON trim(l.id::text) = m.old_id
+        WHERE m.is_new
+        ORDER BY m.new_id, m.old_id
+        ON CONFLICT (id) DO NOTHING
+        """
+    )
+    print(f"migrations: users created from legacy rows: {cur.rowcount}")
+    cur.execute(
+        """
+        INSERT INTO auth_providers (user_id, provider, provider_uid, created_at, updated_at)
+        SELECT DISTINCT new_id, provider, provider_uid, NOW(), NOW()
+        FROM legacy_user_map
+        WHERE is_new
+        ON CONFLICT (provider, provider_uid)
+        DO UPDATE SET updated_at = NOW()
+        """
+    )
+
+    cur.execute(LEGACY_REMAP_DDL)
+    migration_targets = ["readings", "ad_events", "usage_quotas", "billing_events"]
+    for table_name in migration_targets:
+        if not _table_exists(cur, table_name) or not _column_exists(cur, table_name, "user_id"):
+            continue
+        cur.execute(
+            "INSERT INTO legacy_user_remap (table_name) VALUES (%s) ON CONFLICT (table_name) DO NOTHING",
+            (table_name,),
+        )
+
+
+# Rewriting user_id in large tables inside the migration transaction would
+# hold row locks on all of them until the end. Instead each id range is
+# its own transaction and legacy_user_remap records how far each table
+# got, so an interrupted run resumes there. A range is safe to redo: only
+# rows still carrying an old id match the join.
+LEGACY_REMAP_DDL = """
+    CREATE TABLE IF NOT EXISTS legacy_user_remap (
+      table_name TEXT PRIMARY KEY,
+      last_id BIGINT,
+      finished_at TIMESTAMP
+    );
+"""
+
+
+def _remap_user_ids(conn, cur, table_name: str, last_id, batch_size: int = LEGACY_REMAP_BATCH_SIZE):
+    cur.execute(f"SELECT COALESCE(MIN(id), 0) AS lo, COALESCE(MAX(id), 0) AS hi FROM {table_name}")
+    bounds = cur.fetchone() or {}
+    conn.commit()
+    if last_id is None:
+        last_id = int(bounds.get("lo") or 0) - 1
+    max_id = int(bounds.get("hi") or 0)
+    total = 0
+    while last_id < max_id:
+        upper = min(last_id + batch_size, max_id)
+        cur.execute("SET LOCAL lock_timeout = %s", (f"{MIGRATION_LOCK_TIMEOUT_MS}ms",))
+        cur.execute(
+            f"""
+            UPDATE {table_name} t
+            SET user_id = m.new_id::text
+            FROM legacy_user_map m
+            WHERE t.user_id = m.old_id
+              AND t.id > %s AND t.id <= %s
+            """,
+            (last_id, upper),
+        )
+        total += cur.rowcount
+        cur.execute("UPDATE legacy_user_remap SET last_id=%s WHERE table_name=%s", (upper, table_name))
+        conn.commit()
+        last_id = upper
+        print(f"migrations: {table_name} user ids remapped up to id {last_id}/{max_id} ({total} rows)")
+    cur.execute("UPDATE legacy_user_remap SET finished_at=NOW() WHERE table_name=%s", (table_name,))
+    conn.commit()
+
+
+def _pending_legacy_remaps(cur) -> list:
+    if not _table_exists(cur, "legacy_user_remap"):
+        return []
+    cur.execute("SELECT table_name, last_id FROM legacy_user_remap WHERE finished_at IS NULL ORDER BY table_name")
+    return [dict(r) for r in cur.fetchall() or []]
+
+
+def _run_legacy_remaps(conn, cur):
+    pending = _pending_legacy_remaps(cur)
+    conn.commit()
+    for row in pending:
+        last_id = int(row["last_id"]) if row["last_id"] is not None else None
+        _remap_user_ids(conn, cur, row["table_name"], last_id)
+        if row["table_name"] == "readings" and _table_exists(cur, "reading_counts"):
+            # The counter is keyed by user_id, which the remap just rewrote.
+            cur.execute("SET LOCAL lock_timeout = %s", (f"{MIGRATION_LOCK_TIMEOUT_MS}ms",))
+            _reseed_reading_counts(cur)
+            conn.commit()
+
+
+def _migration_001_users(cur):
+    _migrate_legacy_users_if_needed(cur)
+    _ensure_users_table(cur)
+    _ensure_auth_providers_table(cur)
+
+
+# =====================
+# billing
+# =====================
+BILLING_DDL = """
+    CREATE TABLE IF NOT EXISTS ad_events (
+      id SERIAL PRIMARY KEY,
+      user_id TEXT NOT NULL,
+      ad_network TEXT,
+      earned_coins INTEGER NOT NULL,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_ad_events_user_created
+      ON ad_events (user_id, created_at);
+
+    CREATE TABLE IF NOT EXISTS ad_daily_counters (
+      user_id TEXT NOT NULL,
+      reward_date DATE NOT NULL,
+      granted_count INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (user_id, reward_date)
+    );
+
+    CREATE TABLE IF NOT EXISTS usage_quotas (
+      id SERIAL PRIMARY KEY,
+      user_id TEXT NOT NULL,
+      usage_date DATE NOT NULL,
+      used_count INTEGER NOT NULL DEFAULT 0,
+      UNIQUE(user_id, usage_date)
+    );
+
+    CREATE TABLE IF NOT EXISTS billing_events (
+      id SERIAL PRIMARY KEY,
+      user_id TEXT NOT NULL,
+      platform TEXT,
+      product_id TEXT,
+      purchase_token TEXT,
+      event_type TEXT,
+      amount INTEGER,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+
+
+def _migration_002_billing(cur):
+    cur.execute("SELECT to_regclass('public.ad_daily_counters') IS NOT NULL AS ok")
+    had_counters = bool((cur.fetchone() or {}).get("ok"))
+    cur.execute(BILLING_DDL)
+    if not had_counters:
+        # Seed today's counters so a mid-day deploy does not reset the ad limit.
+        today = datetime.now(timezone.utc).date()
+        cur.execute(
+            """
+            INSERT INTO ad_daily_counters (user_id, reward_date, granted_count)
+            SELECT user_id, %s, COUNT(*)
+            FROM ad_events
+            WHERE created_at >= %s AND created_at < %s + INTERVAL '1 day'
+            GROUP BY user_id
+            ON CONFLICT (user_id, reward_date) DO NOTHING
+            """,
+            (today, today, today),
+        )
+
+
+# =====================
+# readings
+# =====================
+READINGS_DDL = """
+    CREATE TABLE IF NOT EXISTS readings (
+      id SERIAL PRIMARY KEY,
+      user_id TEXT,
+      question TEXT NOT NULL,
+      hexagram_code TEXT NOT NULL,
+      changing_lines JSONB,
+      result_summary TEXT,
+      result_full BYTEA,
+      derived_from INTEGER,
+      is_pinned BOOLEAN NOT NULL DEFAULT FALSE,
+      expires_at TIMESTAMP NULL,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_readings_user_created
+      ON readings (user_id, created_at DESC);
+
+    CREATE INDEX IF NOT EXISTS idx_readings_user_expires
+      ON readings (user_id, expires_at);
+
+    ALTER TABLE readings
+      ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+    CREATE TABLE IF NOT EXISTS reading_tombstones (
+      reading_id INTEGER PRIMARY KEY,
+      user_id TEXT NOT NULL,
+      deleted_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_reading_tombstones_user_deleted
+      ON reading_tombstones (user_id, deleted_at, reading_id);
+
+    ALTER TABLE readings
+      ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+    CREATE TABLE IF NOT EXISTS reading_sync_keys (
+      user_id TEXT NOT NULL,
+      sync_key TEXT NOT NULL,
+      reading_id INTEGER NOT NULL,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+      PRIMARY KEY (user_id, sync_key)
+    );
+"""
+
+
+def _migration_003_readings(cur):
+    cur.execute(READINGS_DDL)
+
+
+# =====================
+# compression dictionaries
+# =====================
+CODEC_DDL = """
+    CREATE TABLE IF NOT EXISTS compression_dictionaries (
+      version SERIAL PRIMARY KEY,
+      codec TEXT NOT NULL DEFAULT 'zstd',
+      dict_data BYTEA NOT NULL,
+      sample_count INTEGER NOT NULL DEFAULT 0,
+      created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+
+
+def _migration_004_compression_dictionaries(cur):
+    cur.execute(CODEC_DDL)
+
+
+# =====================
+# session revocations
+# =====================
+# One row per revocation, never per issued token. A row with a jti revokes
+# that session; a row without one revokes every session of user_id issued
+# up to revoked_at. Rows are useless once exp has passed.
+JWT_TOKENS_DDL = """
+    CREATE TABLE IF NOT EXISTS jwt_tokens (
+      id BIGSERIAL PRIMARY KEY,
+      user_id TEXT NOT NULL,
+      jti TEXT,
+      exp TIMESTAMP NOT NULL,
+      is_valid BOOLEAN NOT NULL DEFAULT FALSE,
+      revoked_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jwt_tokens_jti ON jwt_tokens (jti) WHERE jti IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_jwt_tokens_revoked_at ON jwt_tokens (revoked_at);
+"""
+
+
+def _migration_005_jwt_tokens(cur):
+    if _table_exists(cur, "jwt_tokens") and not _column_exists(cur, "jwt_tokens", "jti"):
+        # Left over from the old SQLAlchemy models (db.py): integer user ids
+        # and raw tokens, never read by this backend. Keep it aside.
+        cur.execute("ALTER TABLE jwt_tokens RENAME TO jwt_tokens_legacy")
+        cur.execute("ALTER INDEX IF EXISTS jwt_tokens_pkey RENAME TO jwt_tokens_legacy_pkey")
+    cur.execute(JWT_TOKENS_DDL)
+
+
+# =====================
+# sync key cleanup
+# =====================
+# Sync keys are aged out by created_at only. They outlive their readings on
+# purpose: a retried sync of a deleted reading must stay a duplicate.
+SYNC_KEYS_INDEX_DDL = """
+    CREATE INDEX IF NOT EXISTS idx_reading_sync_keys_reading
+      ON reading_sync_keys (reading_id);
+    CREATE INDEX IF NOT EXISTS idx_reading_sync_keys_created
+      ON reading_sync_keys (created_at);
+"""
+
+
+def _migration_006_sync_key_indexes(cur):
+    cur.execute(SYNC_KEYS_INDEX_DDL)
+
+
+# =====================
+# reading counts
+# =====================
+# Per-user number of stored readings, kept by history_repo in the same
+# transaction as each insert and delete (BUMP_READING_COUNT_SQL), so the
+# history total is a primary-key lookup.
+READING_COUNTS_DDL = """
+    CREATE TABLE IF NOT EXISTS reading_counts (
+      user_id TEXT PRIMARY KEY,
+      total BIGINT NOT NULL DEFAULT 0,
+      updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+
+
+def _reseed_reading_counts(cur):
+    # Writers bump the counter after their insert or delete, so with the
+    # counter table locked first every write is either in the COUNT below
+    # or waits and is added on top of it.
+    cur.execute("LOCK TABLE reading_counts IN EXCLUSIVE MODE")
+    cur.execute("DELETE FROM reading_counts")
+    cur.execute(
+        """
+        INSERT INTO reading_counts (user_id, total, updated_at)
+        SELECT user_id, COUNT(*), NOW()
+        FROM readings
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        """
+    )
+
+
+def _migration_007_reading_counts(cur):
+    cur.execute(READING_COUNTS_DDL)
+    _reseed_reading_counts(cur)
+
+
+# =====================
+# change feed positions
+# =====================
+# change_xid is the id of the transaction that last wrote the row; the
+# change feed compares it with the snapshot a cursor was read under
+# (pg_visible_in_snapshot, PostgreSQL 13+). Existing rows keep NULL: any
+# snapshot taken after this migration already sees them. The column is
+# added without a default so the table is not rewritten.
+CHANGE_XID_DDL = """
+    ALTER TABLE readings ADD COLUMN IF NOT EXISTS change_xid XID8;
+    ALTER TABLE reading_tombstones ADD COLUMN IF NOT EXISTS change_xid XID8;
+    ALTER TABLE reading_tombstones ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+"""
+
+# Also run by readings_partitions after it swaps in the partitioned table.
+READINGS_CHANGE_XID_TRIGGER_DDL = """
+    CREATE OR REPLACE FUNCTION readings_stamp_change_xid() RETURNS trigger AS $$
+    BEGIN
+      NEW.change_xid := pg_current_xact_id();
+      RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS readings_stamp_change_xid ON readings;
+    CREATE TRIGGER readings_stamp_change_xid
+      BEFORE INSERT OR UPDATE ON readings
+      FOR EACH ROW EXECUTE FUNCTION readings_stamp_change_xid();
+"""
+
+
+def _migration_008_change_xid(cur):
+    cur.execute(CHANGE_XID_DDL)
+    cur.execute(READINGS_CHANGE_XID_TRIGGER_DDL)
+
+
+# =====================
+# concurrent indexes
+# =====================
+# Indexes on tables that are large and written all the time. They are not
+# part of any migration transaction: run_migrations builds them afterwards
+# with CREATE INDEX CONCURRENTLY, which never blocks writes. A failed
+# concurrent build leaves an INVALID index behind; it is dropped and the
+# build retried. Each entry is (index, table, columns and predicate), and
+# the table must exist once the migrations above have run.
+CONCURRENT_INDEXES = [
+    (
+        "idx_readings_user_pinned_created",
+        "readings",
+        "(user_id, is_pinned DESC, created_at DESC, id DESC)",
+    ),
+    (
+        "idx_readings_expiry_pending",
+        "readings",
+        "(expires_at) WHERE is_pinned = FALSE AND expires_at IS NOT NULL",
+    ),
+    ("idx_readings_user_updated", "readings", "(user_id, updated_at, id)"),
+    ("idx_readings_search", "readings", "USING GIN (search_vector)"),
+    ("idx_readings_user_change_xid", "readings", "(user_id, change_xid)"),
+    ("idx_reading_tombstones_user_change_xid", "reading_tombstones", "(user_id, change_xid)"),
+]
+INDEX_BUILD_ATTEMPTS = 3
+
+
+def _index_state(cur, index_name: str):
+    """None when the index does not exist, else whether it is valid."""
+    cur.execute(
+        """
+        SELECT i.indisvalid
+        FROM pg_index i
+        WHERE i.indexrelid = to_regclass(%s)
+        """,
+        (f"public.{index_name}",),
+    )
+    row = cur.fetchone()
+    return None if row is None else bool(row["indisvalid"])
+
+
+def _is_partitioned(cur, table_name: str) -> bool:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (f"public.{table_name}",))
+    row = cur.fetchone() or {}
+    return row.get("relkind") == "p"
+
+
+def _build_partitioned_index(cur, index_name: str, table_name: str, spec: str):
+    # CONCURRENTLY is not supported on a partitioned parent: create the
+    # parent index on the parent only (no data, invalid), build each
+    # partition's concurrently and attach it; the parent turns valid once
+    # every partition is attached.
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON ONLY {table_name} {spec}")
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname
+        """,
+        (f"public.{table_name}",),
+    )
+    for row in cur.fetchall() or []:
+        partition_index = f"{row['relname']}_{index_name}"[:63]
+        if _index_state(cur, partition_index) is False:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {partition_index}")
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {row['relname']} {spec}")
+        cur.execute(f"ALTER INDEX {index_name} ATTACH PARTITION {partition_index}")
+
+
+def _build_concurrent_indexes(conn, cur):
+    conn.autocommit = True
+    try:
+        cur.execute("SET lock_timeout = %s", (f"{MIGRATION_LOCK_TIMEOUT_MS}ms",))
+        for index_name, table_name, spec in CONCURRENT_INDEXES:
+            partitioned = _is_partitioned(cur, table_name)
+            for attempt in range(1, INDEX_BUILD_ATTEMPTS + 1):
+                state = _index_state(cur, index_name)
+                if state is True:
+                    break
+                if state is False and not partitioned:
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+                try:
+                    if partitioned:
+                        _build_partitioned_index(cur, index_name, table_name, spec)
+                    else:
+                        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table_name} {spec}")
+                    print(f"migrations: built index {index_name}")
+                    break
+                except psycopg2.Error as exc:
+                    if attempt == INDEX_BUILD_ATTEMPTS:
+                        raise
+                    print(f"migrations: building index {index_name} failed ({exc}); retrying")
+        cur.execute("RESET lock_timeout")
+    finally:
+        conn.autocommit = False
+
+
+# Append only. Version 1-4 are the schema the app used to create at boot;
+# every statement is idempotent, so they also apply cleanly to databases
+# created that way.
+MIGRATIONS = [
+    (1, "users_and_auth_providers", _migration_001_users),
+    (2, "billing_tables", _migration_002_billing),
+    (3, "readings", _migration_003_readings),
+    (4, "compression_dictionaries", _migration_004_compression_dictionaries),
+    (5, "jwt_tokens_revocations", _migration_005_jwt_tokens),
+    (6, "reading_sync_key_indexes", _migration_006_sync_key_indexes),
+    (7, "reading_counts", _migration_007_reading_counts),
+    (8, "change_xid", _migration_008_change_xid),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+          version INTEGER PRIMARY KEY,
+          name TEXT NOT NULL,
+          applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+
+
+def run_migrations() -> list:
+    """Apply pending migrations in order, each in its own transaction.
+
+    Holds a session advisory lock for the whole run, so concurrent release
+    steps (or booting workers with RUN_MIGRATIONS_ON_BOOT) wait for each
+    other instead of racing. Legacy user id rewrites queued by migration 1
+    run last, in committed batches, and are resumed by the next run if
+    interrupted. Indexes in CONCURRENT_INDEXES are built in between,
+    outside any transaction.
+    """
+    applied_now = []
+    conn = get_pg()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            try:
+                _ensure_version_table(cur)
+                conn.commit()
+                cur.execute("SELECT version FROM schema_version")
+                applied = {int(r["version"]) for r in cur.fetchall() or []}
+                conn.commit()
+
+                for version, name, migrate in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    cur.execute("SET LOCAL lock_timeout = %s", (f"{MIGRATION_LOCK_TIMEOUT_MS}ms",))
+                    migrate(cur)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                        (version, name),
+                    )
+                    conn.commit()
+                    applied_now.append(version)
+                    print(f"migrations: applied {version:03d} {name}")
+
+                _build_concurrent_indexes(conn, cur)
+                _run_legacy_remaps(conn, cur)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+                conn.commit()
+    finally:
+        conn.close()
+
+    if not applied_now:
+        print(f"migrations: schema is up to date (version {LATEST_SCHEMA_VERSION}).")
+    return applied_now
+
+
+def current_schema_version() -> int:
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.schema_version') IS NOT NULL AS ok")
+        if not (cur.fetchone() or {}).get("ok"):
+            return 0
+        cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version")
+        return int((cur.fetchone() or {}).get("version") or 0)
+
+
+def check_schema_version() -> bool:
+    """Cheap boot-time check for workers: one query, no DDL.
+
+    Returns True when the database is at LATEST_SCHEMA_VERSION. With
+    RUN_MIGRATIONS_ON_BOOT (local development) pending migrations are
+    applied instead of just reported.
+    """
+    version = current_schema_version()
+    if version >= LATEST_SCHEMA_VERSION:
+        return True
+    if RUN_MIGRATIONS_ON_BOOT:
+        run_migrations()
+        return True
+    print(
+        f"migrations: database schema is at version {version}, code expects {LATEST_SCHEMA_VERSION}. "
+        "Run `python migrations.py` (the release step)."
+    )
+    return False
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        run_migrations()
+    elif command == "status":
+        print(f"schema version {current_schema_version()} (latest {LATEST_SCHEMA_VERSION})")
+        with get_pg() as conn, conn.cursor() as cur:
+            for row in _pending_legacy_remaps(cur):
+                print(f"legacy user id remap pending for {row['table_name']} (after id {row['last_id']})")
+    else:
+        print("usage: python migrations.py [migrate|status]")
+        sys.exit(1)
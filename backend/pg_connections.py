@@ -0,0 +1,102 @@
+import os
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+# Upper bound on PostgreSQL connections open at once in one process,
+# primary and replicas together. A gevent worker may run
+# WEB_WORKER_CONNECTIONS (500) requests at a time, far more than the
+# server's max_connections (100 by default), so connections are handed out
+# through a semaphore and a request waits for a free slot instead of
+# failing with "too many clients". Keep
+# WEB_CONCURRENCY * DB_MAX_CONNECTIONS (plus the release step, any
+# scripts and the retention worker's lock session) below max_connections.
+#
+# Code holding a connection must not wait for a second one: with every slot
+# held by a request doing the same, none would ever be released. Pass the
+# open connection down instead (see reading_codec).
+#
+# threading.BoundedSemaphore is gevent's own once the gevent worker has
+# patched the standard library, so a waiting greenlet yields to the others.
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_float_env(var_name: str, default_value: float) -> float:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return float(raw)
+    except ValueError:
+        return default_value
+
+
+DB_MAX_CONNECTIONS = _parse_int_env("DB_MAX_CONNECTIONS", 20)
+DB_CONNECTION_WAIT_SECONDS = _parse_float_env("DB_CONNECTION_WAIT_SECONDS", 10.0)
+
+_slots = threading.BoundedSemaphore(max(1, DB_MAX_CONNECTIONS))
+
+
+class ConnectionLimitError(psycopg2.OperationalError):
+    """No connection slot freed up in time; the server itself was not contacted."""
+
+
+class LimitedConnection(psycopg2.extensions.connection):
+    """Connection that holds one slot until it is closed.
+
+    Leaving `with conn:` commits or rolls back as usual and then closes the
+    connection, so the `with get_pg() as conn` blocks used across the
+    backend give their slot back as soon as they end.
+    """
+
+    _holds_slot = False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._release()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            return super().__exit__(exc_type, exc_value, tb)
+        finally:
+            self.close()
+
+    def __del__(self):
+        self._release()
+
+    def _release(self):
+        if self._holds_slot:
+            self._holds_slot = False
+            _slots.release()
+
+
+def connect(dsn, **kwargs):
+    """psycopg2.connect within the per-process DB_MAX_CONNECTIONS limit.
+
+    Raises ConnectionLimitError (an OperationalError) when no slot frees up
+    within DB_CONNECTION_WAIT_SECONDS.
+    """
+    if not _slots.acquire(timeout=DB_CONNECTION_WAIT_SECONDS):
+        raise ConnectionLimitError(
+            f"db_connection_limit: no free connection slot within {DB_CONNECTION_WAIT_SECONDS}s "
+            f"(DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS})"
+        )
+    try:
+        conn = psycopg2.connect(dsn, connection_factory=LimitedConnection, **kwargs)
+    except BaseException:
+        _slots.release()
+        raise
+    conn._holds_slot = True
+    return conn
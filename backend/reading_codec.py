@@ -0,0 +1,299 @@
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+from pg_connections import connect as pg_connect
+
+try:
+    import zstandard
+except ImportError:  # zlib keeps working without the optional dependency
+    zstandard = None
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# First byte of a stored blob. Legacy rows are raw zlib streams, whose first
+# byte is 0x78 for the default window, so the two never collide.
+FORMAT_ZSTD = 0x01
+FORMAT_ZSTD_DICT = 0x02
+DICT_HEADER = struct.Struct(">BI")
+
+# zlib until every host that may read the rows has zstandard installed (and
+# a rollback is no longer on the table); READING_CODEC=zstd opts in.
+DEFAULT_CODEC = "zlib"
+DEFAULT_ZSTD_LEVEL = 9
+DEFAULT_DICT_SIZE = 112 * 1024
+DEFAULT_TRAIN_SAMPLE_SIZE = 2000
+DICT_REFRESH_SECONDS = 300
+
+
+class ZstdUnavailableError(RuntimeError):
+    """A zstd blob was read on a host without the zstandard package."""
+
+
+def get_pg():
+    return pg_connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+def _fetch_one(conn, sql, params=()):
+    # Callers that already hold a connection pass it in: waiting for a
+    # second slot while holding one can deadlock once every slot is held
+    # by a request doing the same.
+    if conn is not None:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(sql, params)
+            return cur.fetchone()
+    with get_pg() as own, own.cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchone()
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+READING_CODEC = (os.getenv("READING_CODEC") or DEFAULT_CODEC).strip().lower()
+READING_ZSTD_LEVEL = _parse_int_env("READING_ZSTD_LEVEL", DEFAULT_ZSTD_LEVEL)
+
+
+ACTIVE_DICTIONARY_SQL = "SELECT MAX(version) AS version FROM compression_dictionaries WHERE codec='zstd'"
+
+
+class _DictionaryCache:
+    """Per-process cache of zstd dictionaries keyed by version.
+
+    Lookups run on the caller's connection when one is given (`conn`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dicts = {}
+        self._active_version = None
+        self._checked_at = 0.0
+        self._local = threading.local()
+
+    def active(self, conn=None):
+        now = time.monotonic()
+        if now - self._checked_at >= DICT_REFRESH_SECONDS:
+            with self._lock:
+                if now - self._checked_at >= DICT_REFRESH_SECONDS:
+                    self._checked_at = now
+                    if conn is None:
+                        try:
+                            row = _fetch_one(None, ACTIVE_DICTIONARY_SQL) or {}
+                        except Exception:
+                            # No table yet or DB hiccup: keep the last known version.
+                            row = {"version": self._active_version}
+                    else:
+                        # An error here aborts the caller's transaction, so it
+                        # is not swallowed.
+                        row = _fetch_one(conn, ACTIVE_DICTIONARY_SQL) or {}
+                    self._active_version = row.get("version")
+        version = self._active_version
+        if version is None:
+            return None, None
+        return version, self.get(version, conn)
+
+    def get(self, version: int, conn=None):
+        cached = self._dicts.get(version)
+        if cached is not None:
+            return cached
+        row = _fetch_one(conn, "SELECT dict_data FROM compression_dictionaries WHERE version=%s", (version,))
+        if not row:
+            raise KeyError(f"unknown_compression_dictionary:{version}")
+        loaded = zstandard.ZstdCompressionDict(bytes(row["dict_data"]))
+        with self._lock:
+            self._dicts[version] = loaded
+        return loaded
+
+    def compressor(self, version, dictionary):
+        # zstandard compressors are not thread-safe, so keep one per thread.
+        compressors = getattr(self._local, "compressors", None)
+        if compressors is None:
+            compressors = self._local.compressors = {}
+        key = (version, READING_ZSTD_LEVEL)
+        if key not in compressors:
+            compressors[key] = zstandard.ZstdCompressor(level=READING_ZSTD_LEVEL, dict_data=dictionary)
+        return compressors[key]
+
+    def decompressor(self, version, dictionary):
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        if version not in decompressors:
+            decompressors[version] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return decompressors[version]
+
+
+_DICTIONARIES = _DictionaryCache()
+
+
+def encode_text(text: str, codec: str | None = None, conn=None) -> bytes | None:
+    if not text:
+        return None
+    raw = text.encode("utf-8")
+    codec = codec or READING_CODEC
+    if codec != "zstd" or zstandard is None:
+        return zlib.compress(raw)
+
+    version, dictionary = _DICTIONARIES.active(conn)
+    if dictionary is None:
+        return bytes([FORMAT_ZSTD]) + _DICTIONARIES.compressor(None, None).compress(raw)
+    return DICT_HEADER.pack(FORMAT_ZSTD_DICT, version) + _DICTIONARIES.compressor(version, dictionary).compress(raw)
+
+
+def decode_text(blob, conn=None) -> str:
+    if not blob:
+        return ""
+    data = bytes(blob)
+    fmt = data[0]
+    if fmt in (FORMAT_ZSTD, FORMAT_ZSTD_DICT) and zstandard is None:
+        raise ZstdUnavailableError(
+            "reading is zstd-compressed but the zstandard package is not installed; "
+            "install it (requirements.txt) to read these rows"
+        )
+    if fmt == FORMAT_ZSTD:
+        return _DICTIONARIES.decompressor(None, None).decompress(data[1:]).decode("utf-8")
+    if fmt == FORMAT_ZSTD_DICT:
+        _, version = DICT_HEADER.unpack_from(data)
+        dictionary = _DICTIONARIES.get(version, conn)
+        return _DICTIONARIES.decompressor(version, dictionary).decompress(data[DICT_HEADER.size:]).decode("utf-8")
+    return zlib.decompress(data).decode("utf-8")
+
+
+def blob_format(blob) -> str:
+    if not blob:
+        return "empty"
+    fmt = bytes(blob[:1])[0]
+    if fmt == FORMAT_ZSTD:
+        return "zstd"
+    if fmt == FORMAT_ZSTD_DICT:
+        return f"zstd_dict:{DICT_HEADER.unpack_from(bytes(blob[:DICT_HEADER.size]))[1]}"
+    return "zlib"
+
+
+def _sample_texts(sample_size: int) -> list[str]:
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT result_full FROM readings
+            WHERE result_full IS NOT NULL
+            ORDER BY id DESC
+            LIMIT %s
+            """,
+            (sample_size,),
+        )
+        rows = cur.fetchall() or []
+    texts = []
+    for row in rows:
+        try:
+            text = decode_text(row["result_full"])
+        except Exception:
+            continue
+        if text:
+            texts.append(text)
+    return texts
+
+
+def train_dictionary(sample_size: int = DEFAULT_TRAIN_SAMPLE_SIZE, dict_size: int = DEFAULT_DICT_SIZE) -> int:
+    """Train a zstd dictionary on recent readings and store it as the new active version."""
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed")
+    texts = _sample_texts(sample_size)
+    if len(texts) < 10:
+        raise RuntimeError("not_enough_readings_to_train")
+    trained = zstandard.train_dictionary(dict_size, [t.encode("utf-8") for t in texts])
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO compression_dictionaries (codec, dict_data, sample_count)
+            VALUES ('zstd', %s, %s)
+            RETURNING version
+            """,
+            (psycopg2.Binary(trained.as_bytes()), len(texts)),
+        )
+        version = int(cur.fetchone()["version"])
+        conn.commit()
+    print(f"trained zstd dictionary v{version} from {len(texts)} readings ({len(trained.as_bytes())} bytes)")
+    return version
+
+
+def benchmark(sample_size: int = DEFAULT_TRAIN_SAMPLE_SIZE, rounds: int = 3) -> list[dict]:
+    """Compare size ratio and encode/decode throughput of zlib, zstd and zstd+dict."""
+    texts = [t.encode("utf-8") for t in _sample_texts(sample_size)]
+    if not texts:
+        raise RuntimeError("no_readings_to_benchmark")
+    raw_bytes = sum(len(t) for t in texts)
+
+    codecs = [("zlib", zlib.compress, zlib.decompress)]
+    if zstandard is not None:
+        plain_c = zstandard.ZstdCompressor(level=READING_ZSTD_LEVEL)
+        plain_d = zstandard.ZstdDecompressor()
+        codecs.append(("zstd", plain_c.compress, plain_d.decompress))
+        # Train on half, measure on the other half, so the ratio is not flattered.
+        train_half, test_half = texts[::2], texts[1::2]
+        if len(train_half) >= 10 and test_half:
+            dictionary = zstandard.train_dictionary(DEFAULT_DICT_SIZE, train_half)
+            dict_c = zstandard.ZstdCompressor(level=READING_ZSTD_LEVEL, dict_data=dictionary)
+            dict_d = zstandard.ZstdDecompressor(dict_data=dictionary)
+            codecs.append(("zstd_dict", dict_c.compress, dict_d.decompress))
+
+    results = []
+    for name, compress, decompress in codecs:
+        corpus = test_half if name == "zstd_dict" else texts
+        corpus_bytes = sum(len(t) for t in corpus)
+        encoded = [compress(t) for t in corpus]
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for t in corpus:
+                compress(t)
+        encode_seconds = (time.perf_counter() - started) / rounds
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for blob in encoded:
+                decompress(blob)
+        decode_seconds = (time.perf_counter() - started) / rounds
+
+        results.append(
+            {
+                "codec": name,
+                "documents": len(corpus),
+                "ratio": round(corpus_bytes / max(1, sum(len(b) for b in encoded)), 2),
+                "encode_mb_s": round(corpus_bytes / 1e6 / max(encode_seconds, 1e-9), 1),
+                "decode_mb_s": round(corpus_bytes / 1e6 / max(decode_seconds, 1e-9), 1),
+            }
+        )
+    print(f"sampled {len(texts)} readings, {raw_bytes} bytes")
+    for row in results:
+        print(
+            f"{row['codec']:>10}  ratio {row['ratio']:>5}x  "
+            f"encode {row['encode_mb_s']:>7} MB/s  decode {row['decode_mb_s']:>7} MB/s"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "train":
+        train_dictionary()
+    elif command == "bench":
+        benchmark()
+    else:
+        print("usage: python reading_codec.py [train|bench]")
+        sys.exit(1)
@@ -0,0 +1,300 @@
+import argparse
+import multiprocessing
+import sys
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from history_repo import HISTORY_SEARCH_FULL_TEXT, _make_summary, get_pg, search_documents
+from reading_codec import READING_CODEC, blob_format, decode_text, encode_text
+
+DEFAULT_RANGE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ROWS_PER_SEC = 2000
+DEFAULT_BATCH_PAUSE_MS = 50
+
+
+def init_backfill_schema():
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+              job TEXT PRIMARY KEY,
+              last_id INTEGER NOT NULL DEFAULT 0,
+              processed BIGINT NOT NULL DEFAULT 0,
+              updated BIGINT NOT NULL DEFAULT 0,
+              updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            );
+            ALTER TABLE backfill_checkpoints ADD COLUMN IF NOT EXISTS skipped BIGINT NOT NULL DEFAULT 0;
+            """
+        )
+        conn.commit()
+
+
+# ---- jobs: transform functions run in worker processes ----
+# Each returns (results, skipped): results are (reading_id, value) pairs to
+# write back, skipped are (reading_id, error) for rows that could not be
+# decoded and are left untouched.
+def _decode(reading_id, blob, skipped):
+    try:
+        return decode_text(blob)
+    except Exception as exc:
+        skipped.append((reading_id, f"{type(exc).__name__}: {exc}"))
+        return None
+
+
+def _recompress_rows(rows):
+    out, skipped = [], []
+    for reading_id, blob, _summary, _question in rows:
+        if not blob:
+            continue
+        text = _decode(reading_id, blob, skipped)
+        if text is None:
+            continue
+        new_blob = encode_text(text)
+        if new_blob is not None and blob_format(new_blob) != blob_format(blob):
+            out.append((reading_id, new_blob))
+    return out, skipped
+
+
+def _summary_rows(rows):
+    out, skipped = [], []
+    for reading_id, blob, summary, _question in rows:
+        text = _decode(reading_id, blob, skipped) if blob else ""
+        if text is None:
+            continue
+        new_summary = _make_summary(text)
+        if new_summary != (summary or ""):
+            out.append((reading_id, new_summary))
+    return out, skipped
+
+
+def _search_rows(rows):
+    out, skipped = [], []
+    for reading_id, blob, summary, question in rows:
+        # Only pay for decompression when the full text is indexed.
+        text = _decode(reading_id, blob, skipped) if blob and HISTORY_SEARCH_FULL_TEXT else ""
+        if text is None:
+            continue
+        out.append((reading_id, search_documents(question, summary, text)))
+    return out, skipped
+
+
+JOBS = {
+    "recompress": {
+        "transform": _recompress_rows,
+        "update_sql": """
+            UPDATE readings SET result_full = v.result_full
+            FROM (VALUES %s) AS v(id, result_full)
+            WHERE readings.id = v.id
+        """,
+        "template": "(%s, %s::bytea)",
+        "wrap": lambda value: (psycopg2.Binary(value),),
+    },
+    "summary": {
+        "transform": _summary_rows,
+        "update_sql": """
+            UPDATE readings SET result_summary = v.result_summary
+            FROM (VALUES %s) AS v(id, result_summary)
+            WHERE readings.id = v.id
+        """,
+        "template": "(%s, %s::text)",
+        "wrap": lambda value: (value,),
+    },
+    "search": {
+        "transform": _search_rows,
+        "update_sql": """
+            UPDATE readings SET search_vector =
+                setweight(to_tsvector('simple', v.question_doc), 'A')
+                || setweight(to_tsvector('simple', v.summary_doc), 'B')
+                || setweight(to_tsvector('simple', v.full_doc), 'C')
+            FROM (VALUES %s) AS v(id, question_doc, summary_doc, full_doc)
+            WHERE readings.id = v.id
+        """,
+        "template": "(%s, %s::text, %s::text, %s::text)",
+        "wrap": lambda value: value,
+    },
+}
+
+
+def _load_checkpoint(job: str, restart: bool) -> dict:
+    with get_pg() as conn, conn.cursor() as cur:
+        if restart:
+            cur.execute("DELETE FROM backfill_checkpoints WHERE job=%s", (job,))
+        cur.execute(
+            """
+            INSERT INTO backfill_checkpoints (job) VALUES (%s)
+            ON CONFLICT (job) DO NOTHING
+            """,
+            (job,),
+        )
+        cur.execute("SELECT last_id, processed, updated, skipped FROM backfill_checkpoints WHERE job=%s", (job,))
+        row = dict(cur.fetchone())
+        conn.commit()
+        return row
+
+
+def _iter_range_batches(lo: int, hi: int, batch_size: int):
+    """Stream rows of one id range through a server-side cursor, closed before the next range."""
+    conn = get_pg()
+    try:
+        with conn.cursor(name="readings_backfill", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = batch_size
+            cur.execute(
+                """
+                SELECT id, result_full, result_summary, question
+                FROM readings
+                WHERE id > %s AND id <= %s
+                ORDER BY id
+                """,
+                (lo, hi),
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                # memoryview does not pickle; workers get plain bytes.
+                yield [(r[0], bytes(r[1]) if r[1] is not None else None, r[2], r[3]) for r in rows]
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _write_back(conn, job_spec: dict, results: list):
+    if not results:
+        return 0
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            job_spec["update_sql"],
+            [(reading_id, *job_spec["wrap"](value)) for reading_id, value in results],
+            template=job_spec["template"],
+            page_size=len(results),
+        )
+    return len(results)
+
+
+def run_backfill(
+    job: str,
+    range_size: int = DEFAULT_RANGE_SIZE,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = DEFAULT_WORKERS,
+    max_rows_per_sec: int = DEFAULT_MAX_ROWS_PER_SEC,
+    batch_pause_ms: int = DEFAULT_BATCH_PAUSE_MS,
+    restart: bool = False,
+):
+    """Walk readings by primary-key range, transform rows in a process pool and write back in batches.
+
+    Progress is checkpointed after every committed batch, so an interrupted
+    run resumes where it stopped. Throughput is capped at `max_rows_per_sec`.
+    Batches are read from the database only as workers free up, so at most
+    two per worker are held in memory. Rows whose blob cannot be decoded
+    are logged, counted as skipped and left as they are.
+    """
+    job_spec = JOBS[job]
+    init_backfill_schema()
+    checkpoint = _load_checkpoint(job, restart)
+    last_id = int(checkpoint["last_id"])
+    processed = int(checkpoint["processed"])
+    updated = int(checkpoint["updated"])
+    skipped = int(checkpoint["skipped"])
+
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM readings")
+        max_id = int(cur.fetchone()["max_id"])
+
+    print(f"backfill {job}: resuming after id {last_id} of {max_id} (codec={READING_CODEC})")
+    started = time.monotonic()
+    run_processed = 0
+    max_in_flight = 2 * max(1, workers)
+    write_conn = get_pg()
+
+    def finish_batch(batch, pending_result):
+        nonlocal processed, updated, skipped, run_processed
+        results, batch_skipped = pending_result.get()
+        for reading_id, error in batch_skipped:
+            print(f"backfill {job}: skipped reading {reading_id}: {error}")
+        changed = _write_back(write_conn, job_spec, results)
+        with write_conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE backfill_checkpoints
+                SET last_id=%s, processed=processed + %s, updated=updated + %s,
+                    skipped=skipped + %s, updated_at=NOW()
+                WHERE job=%s
+                """,
+                (batch[-1][0], len(batch), changed, len(batch_skipped), job),
+            )
+        write_conn.commit()
+
+        processed += len(batch)
+        updated += changed
+        skipped += len(batch_skipped)
+        run_processed += len(batch)
+
+        # Throttle to the configured rate, plus a short pause for replicas and vacuum.
+        min_elapsed = run_processed / max(1, max_rows_per_sec)
+        elapsed = time.monotonic() - started
+        time.sleep(max(min_elapsed - elapsed, 0) + batch_pause_ms / 1000.0)
+
+    try:
+        with multiprocessing.Pool(processes=max(1, workers)) as pool:
+            while last_id < max_id:
+                range_hi = min(last_id + range_size, max_id)
+                # Results are written back in order, so the checkpoint
+                # never moves past a batch that is still being transformed.
+                pending = deque()
+                for batch in _iter_range_batches(last_id, range_hi, batch_size):
+                    pending.append((batch, pool.apply_async(job_spec["transform"], (batch,))))
+                    if len(pending) >= max_in_flight:
+                        finish_batch(*pending.popleft())
+                while pending:
+                    finish_batch(*pending.popleft())
+
+                last_id = range_hi
+                with write_conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE backfill_checkpoints SET last_id=%s, updated_at=NOW() WHERE job=%s",
+                        (last_id, job),
+                    )
+                write_conn.commit()
+                elapsed = time.monotonic() - started
+                rate = run_processed / elapsed if elapsed > 0 else 0.0
+                print(
+                    f"backfill {job}: id {last_id}/{max_id}, processed {processed}, "
+                    f"updated {updated}, skipped {skipped}, {rate:.0f} rows/s"
+                )
+    finally:
+        write_conn.close()
+
+    print(f"backfill {job}: done, processed {processed}, updated {updated}, skipped {skipped}")
+    return {"processed": processed, "updated": updated, "skipped": skipped, "last_id": last_id}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resumable batch jobs over the readings table.")
+    parser.add_argument("job", choices=sorted(JOBS))
+    parser.add_argument("--range-size", type=int, default=DEFAULT_RANGE_SIZE)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--max-rows-per-sec", type=int, default=DEFAULT_MAX_ROWS_PER_SEC)
+    parser.add_argument("--batch-pause-ms", type=int, default=DEFAULT_BATCH_PAUSE_MS)
+    parser.add_argument("--restart", action="store_true", help="ignore the stored checkpoint")
+    args = parser.parse_args(argv)
+    run_backfill(
+        args.job,
+        range_size=args.range_size,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        max_rows_per_sec=args.max_rows_per_sec,
+        batch_pause_ms=args.batch_pause_ms,
+        restart=args.restart,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
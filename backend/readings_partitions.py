@@ -0,0 +1,351 @@
+import os
+import re
+import sys
+from datetime import date, datetime, timezone
+
+import psycopg2.errors
+from dotenv import load_dotenv
+
+from history_repo import get_pg
+from migrations import READINGS_CHANGE_XID_TRIGGER_DDL
+
+load_dotenv()
+
+DEFAULT_MONTHS_AHEAD = 3
+DEFAULT_COPY_BATCH_SIZE = 5000
+PARTITION_NAME_RE = re.compile(r"^readings_p(\d{4})(\d{2})$")
+DEFAULT_PARTITION_NAME = "readings_pdefault"
+STAGING_TABLE = "readings_partitioned"
+LEGACY_TABLE = "readings_unpartitioned"
+CHANGE_LOG_TABLE = "readings_migration_log"
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+READINGS_PARTITION_MONTHS_AHEAD = _parse_int_env("READINGS_PARTITION_MONTHS_AHEAD", DEFAULT_MONTHS_AHEAD)
+# Exclusive locks on readings give up after this long instead of queueing
+# (and stalling every query queued behind them) behind a long transaction.
+READINGS_PARTITION_LOCK_TIMEOUT_MS = _parse_int_env("READINGS_PARTITION_LOCK_TIMEOUT_MS", 5000)
+
+
+def _month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _add_months(value: date, months: int) -> date:
+    index = value.year * 12 + (value.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month: date) -> str:
+    return f"readings_p{month.year:04d}{month.month:02d}"
+
+
+def is_readings_partitioned(cur) -> bool:
+    cur.execute(
+        """
+        SELECT c.relkind
+        FROM pg_class c
+        WHERE c.oid = to_regclass('public.readings')
+        """
+    )
+    row = cur.fetchone() or {}
+    return row.get("relkind") == "p"
+
+
+def _create_month_partitions(cur, parent: str, first_month: date, last_month: date):
+    month = first_month
+    while month <= last_month:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {_partition_name(month)}
+            PARTITION OF {parent}
+            FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')
+            """
+        )
+        month = _add_months(month, 1)
+
+
+def ensure_readings_partitions(months_ahead: int = READINGS_PARTITION_MONTHS_AHEAD) -> bool:
+    """Create monthly partitions up to `months_ahead` months from now. No-op on a plain table."""
+    this_month = _month_start(datetime.now(timezone.utc))
+    with get_pg() as conn, conn.cursor() as cur:
+        if not is_readings_partitioned(cur):
+            return False
+        _create_month_partitions(cur, "readings", this_month, _add_months(this_month, months_ahead))
+        conn.commit()
+    return True
+
+
+def _list_month_partitions(cur) -> list[tuple[str, date]]:
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.readings'::regclass
+        """
+    )
+    out = []
+    for row in cur.fetchall() or []:
+        match = PARTITION_NAME_RE.match(row["relname"])
+        if match:
+            out.append((row["relname"], date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(out, key=lambda item: item[1])
+
+
+def _has_live_rows(cur, name: str, now) -> bool:
+    cur.execute(
+        f"""
+        SELECT 1 FROM {name}
+        WHERE is_pinned = TRUE OR expires_at IS NULL OR expires_at >= %s
+        LIMIT 1
+        """,
+        (now,),
+    )
+    return cur.fetchone() is not None
+
+
+def drop_expired_partitions() -> list[str]:
+    """Detach and drop past-month partitions in which every row has expired.
+
+    A partition is only dropped when it holds no pinned rows, no rows without
+    an expiry and no rows that are still visible; otherwise those months keep
+    relying on row-level expiry.
+    """
+    now = datetime.now(timezone.utc)
+    this_month = _month_start(now)
+    dropped = []
+    with get_pg() as conn, conn.cursor() as cur:
+        if not is_readings_partitioned(cur):
+            return dropped
+        candidates = [name for name, month in _list_month_partitions(cur) if month < this_month]
+        conn.commit()
+
+    for name in candidates:
+        with get_pg() as conn, conn.cursor() as cur:
+            # Unlocked first pass, so months that still hold live rows are
+            # skipped without taking any lock.
+            live = _has_live_rows(cur, name, now)
+            conn.commit()
+        if live:
+            continue
+
+        with get_pg() as conn, conn.cursor() as cur:
+            # Parent before partition, like every writer, and the ACCESS
+            # EXCLUSIVE that DETACH needs taken up front rather than upgraded
+            # to. Until commit no row can be inserted or un-expired between
+            # the check and the DROP.
+            cur.execute("SET LOCAL lock_timeout = %s", (f"{READINGS_PARTITION_LOCK_TIMEOUT_MS}ms",))
+            try:
+                cur.execute("LOCK TABLE readings IN ACCESS EXCLUSIVE MODE")
+            except psycopg2.errors.LockNotAvailable:
+                conn.rollback()
+                print(f"readings partitions: {name} skipped, readings is busy; retrying next pass")
+                continue
+            if _has_live_rows(cur, name, now):
+                conn.rollback()
+                continue
+            # Change-feed clients still need to hear about the dropped rows.
+            cur.execute(
+                f"""
+                INSERT INTO reading_tombstones (reading_id, user_id)
+                SELECT id, user_id FROM {name} WHERE user_id IS NOT NULL
+                ON CONFLICT (reading_id) DO NOTHING
+                """
+            )
+            cur.execute(
+                f"""
+                INSERT INTO reading_counts (user_id, total, updated_at)
+                SELECT user_id, -COUNT(*), NOW() FROM {name}
+                WHERE user_id IS NOT NULL
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE
+                SET total = GREATEST(reading_counts.total + EXCLUDED.total, 0), updated_at = NOW()
+                """
+            )
+            cur.execute(f"ALTER TABLE readings DETACH PARTITION {name}")
+            cur.execute(f"DROP TABLE {name}")
+            conn.commit()
+            dropped.append(name)
+            print(f"readings partitions: dropped {name}")
+    return dropped
+
+
+def maintain_readings_partitions() -> dict:
+    created = ensure_readings_partitions()
+    dropped = drop_expired_partitions() if created else []
+    return {"partitioned": created, "dropped": dropped}
+
+
+def _install_change_log(cur):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (id INTEGER PRIMARY KEY)")
+    cur.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION readings_migration_track() RETURNS trigger AS $$
+        BEGIN
+          INSERT INTO {CHANGE_LOG_TABLE} (id)
+          VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END)
+          ON CONFLICT DO NOTHING;
+          RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    cur.execute("DROP TRIGGER IF EXISTS readings_migration_track ON readings")
+    cur.execute(
+        """
+        CREATE TRIGGER readings_migration_track
+        AFTER INSERT OR UPDATE OR DELETE ON readings
+        FOR EACH ROW EXECUTE FUNCTION readings_migration_track()
+        """
+    )
+
+
+def _copy_existing_rows(max_id: int, batch_size: int):
+    last_id = 0
+    while last_id < max_id:
+        upper = min(last_id + batch_size, max_id)
+        with get_pg() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"""
+                INSERT INTO {STAGING_TABLE}
+                SELECT * FROM readings WHERE id > %s AND id <= %s
+                """,
+                (last_id, upper),
+            )
+            conn.commit()
+        last_id = upper
+        print(f"readings partitions: copied ids up to {last_id}/{max_id}")
+
+
+def _build_staging_indexes(cur) -> list[str]:
+    cur.execute(
+        """
+        SELECT i.indexname, i.indexdef
+        FROM pg_indexes i
+        WHERE i.schemaname = 'public'
+          AND i.tablename = 'readings'
+          AND i.indexname NOT IN (
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = 'public.readings'::regclass AND contype = 'p'
+          )
+        """
+    )
+    built = []
+    for row in cur.fetchall() or []:
+        name = row["indexname"]
+        indexdef = row["indexdef"].replace(
+            f" {name} ON public.readings ",
+            f" {name}_p ON public.{STAGING_TABLE} ",
+            1,
+        )
+        cur.execute("SAVEPOINT build_index")
+        try:
+            cur.execute(indexdef)
+            cur.execute("RELEASE SAVEPOINT build_index")
+            built.append(name)
+        except Exception as exc:
+            # Unique indexes must include created_at on a partitioned table.
+            cur.execute("ROLLBACK TO SAVEPOINT build_index")
+            print(f"readings partitions: skipped index {name}: {exc}")
+    return built
+
+
+def migrate_readings_to_partitioned(
+    batch_size: int = DEFAULT_COPY_BATCH_SIZE,
+    months_ahead: int = READINGS_PARTITION_MONTHS_AHEAD,
+):
+    """Convert `readings` into a table range-partitioned by created_at month.
+
+    Rows are copied in id ranges while a trigger records ids changed in the
+    meantime; those are re-copied under a short exclusive lock before the
+    tables are swapped. The old heap is kept as readings_unpartitioned.
+    """
+    with get_pg() as conn, conn.cursor() as cur:
+        if is_readings_partitioned(cur):
+            print("readings partitions: readings is already partitioned.")
+            return False
+
+        # Committed before reading MAX(id): CREATE TRIGGER waits for in-flight
+        # writes, so every later change is either copied or logged.
+        _install_change_log(cur)
+        conn.commit()
+
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute("SELECT MIN(created_at) AS first_at, COALESCE(MAX(id), 0) AS max_id FROM readings")
+        bounds = cur.fetchone() or {}
+        first_month = _month_start(bounds.get("first_at") or datetime.now(timezone.utc))
+        max_id = int(bounds.get("max_id") or 0)
+
+        cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE} CASCADE")
+        cur.execute(
+            f"""
+            CREATE TABLE {STAGING_TABLE}
+              (LIKE readings INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+              PARTITION BY RANGE (created_at)
+            """
+        )
+        cur.execute(f"ALTER TABLE {STAGING_TABLE} ADD PRIMARY KEY (id, created_at)")
+        this_month = _month_start(datetime.now(timezone.utc))
+        _create_month_partitions(cur, STAGING_TABLE, first_month, _add_months(this_month, months_ahead))
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION_NAME} PARTITION OF {STAGING_TABLE} DEFAULT")
+        conn.commit()
+
+    _copy_existing_rows(max_id, batch_size)
+
+    with get_pg() as conn, conn.cursor() as cur:
+        index_names = _build_staging_indexes(cur)
+        conn.commit()
+
+    with get_pg() as conn, conn.cursor() as cur:
+        # On timeout nothing is swapped; rerun the migration.
+        cur.execute("SET LOCAL lock_timeout = %s", (f"{READINGS_PARTITION_LOCK_TIMEOUT_MS}ms",))
+        cur.execute("LOCK TABLE readings IN ACCESS EXCLUSIVE MODE")
+        cur.execute(f"DELETE FROM {STAGING_TABLE} WHERE id IN (SELECT id FROM {CHANGE_LOG_TABLE})")
+        cur.execute(
+            f"""
+            INSERT INTO {STAGING_TABLE}
+            SELECT * FROM readings WHERE id IN (SELECT id FROM {CHANGE_LOG_TABLE})
+            """
+        )
+        cur.execute("SELECT pg_get_serial_sequence('readings', 'id') AS seq")
+        sequence_name = (cur.fetchone() or {}).get("seq")
+
+        cur.execute("DROP TRIGGER IF EXISTS readings_migration_track ON readings")
+        cur.execute("DROP TRIGGER IF EXISTS readings_stamp_change_xid ON readings")
+        cur.execute(f"ALTER TABLE readings RENAME TO {LEGACY_TABLE}")
+        cur.execute(f"ALTER TABLE {STAGING_TABLE} RENAME TO readings")
+        cur.execute(f"ALTER INDEX IF EXISTS readings_pkey RENAME TO {LEGACY_TABLE}_pkey")
+        cur.execute(f"ALTER INDEX IF EXISTS {STAGING_TABLE}_pkey RENAME TO readings_pkey")
+        for name in index_names:
+            cur.execute(f"ALTER INDEX {name} RENAME TO {name}_unpartitioned")
+            cur.execute(f"ALTER INDEX {name}_p RENAME TO {name}")
+        if sequence_name:
+            cur.execute(f"ALTER SEQUENCE {sequence_name} OWNED BY readings.id")
+        cur.execute(READINGS_CHANGE_XID_TRIGGER_DDL)
+        cur.execute(f"DROP TABLE IF EXISTS {CHANGE_LOG_TABLE}")
+        cur.execute("DROP FUNCTION IF EXISTS readings_migration_track()")
+        conn.commit()
+
+    print(f"readings partitions: migration done; drop {LEGACY_TABLE} once verified.")
+    return True
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "maintain"
+    if command == "migrate":
+        migrate_readings_to_partitioned()
+    elif command == "maintain":
+        print(maintain_readings_partitions())
+    else:
+        print("usage: python readings_partitions.py [migrate|maintain]")
+        sys.exit(1)
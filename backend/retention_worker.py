@@ -0,0 +1,170 @@
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+from history_repo import (
+    DATABASE_URL,
+    delete_expired,
+    list_counted_user_ids,
+    prune_sync_keys,
+    prune_tombstones,
+    recount_history_total,
+)
+from readings_partitions import maintain_readings_partitions
+from token_revocation import prune_expired_revocations
+
+load_dotenv()
+
+# Arbitrary app-wide key for pg_try_advisory_lock; only one process in the fleet runs expiry.
+RETENTION_ADVISORY_LOCK_KEY = 73_310_031
+DEFAULT_INTERVAL_SECONDS = 3600
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_PAUSE_MS = 100
+INTERVAL_JITTER_RATIO = 0.2
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_bool_env(var_name: str, default_value: bool) -> bool:
+    raw = (os.getenv(var_name) or "").strip().lower()
+    if not raw:
+        return default_value
+    return raw in {"1", "true", "yes", "on"}
+
+
+RETENTION_WORKER_ENABLED = _parse_bool_env("RETENTION_WORKER_ENABLED", True)
+RETENTION_INTERVAL_SECONDS = _parse_int_env("RETENTION_INTERVAL_SECONDS", DEFAULT_INTERVAL_SECONDS)
+RETENTION_BATCH_SIZE = _parse_int_env("RETENTION_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+RETENTION_BATCH_PAUSE_MS = _parse_int_env("RETENTION_BATCH_PAUSE_MS", DEFAULT_BATCH_PAUSE_MS)
+
+_worker_lock = threading.Lock()
+_worker_thread: threading.Thread | None = None
+
+
+def run_expiry_pass(batch_size: int = RETENTION_BATCH_SIZE, pause_ms: int = RETENTION_BATCH_PAUSE_MS) -> dict:
+    """Delete expired readings batch by batch while holding the fleet-wide advisory lock."""
+    # The lock session sits idle for the whole pass while the steps below
+    # take their own connections. It is opened outside the per-process
+    # DB_MAX_CONNECTIONS slots (pg_connections.py): holding a slot here
+    # would make the pass need two at once.
+    lock_conn = psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+    lock_conn.autocommit = True
+    try:
+        with lock_conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (RETENTION_ADVISORY_LOCK_KEY,))
+            if not (cur.fetchone() or {}).get("locked"):
+                return {"skipped": True, "deleted": 0, "batches": 0, "seconds": 0.0, "rows_per_sec": 0.0}
+
+        started = time.monotonic()
+        deleted = 0
+        batches = 0
+        try:
+            try:
+                # On a partitioned table whole expired months go first; rows
+                # left in mixed months fall through to batched deletes.
+                maintain_readings_partitions()
+            except Exception:
+                traceback.print_exc()
+            while True:
+                count = delete_expired(limit=batch_size)
+                deleted += count
+                batches += 1
+                if count < batch_size:
+                    break
+                # Yield between batches so autovacuum and live traffic keep up.
+                time.sleep(pause_ms / 1000.0)
+            for prune in (prune_tombstones, prune_sync_keys, prune_expired_revocations):
+                try:
+                    prune()
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            with lock_conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_ADVISORY_LOCK_KEY,))
+
+        elapsed = time.monotonic() - started
+        stats = {
+            "skipped": False,
+            "deleted": deleted,
+            "batches": batches,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(deleted / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+        print(
+            f"readings expiry: deleted {deleted} rows in {batches} batches, "
+            f"{stats['seconds']}s ({stats['rows_per_sec']} rows/s)"
+        )
+        return stats
+    finally:
+        lock_conn.close()
+
+
+def _next_delay(interval_seconds: int) -> float:
+    jitter = interval_seconds * INTERVAL_JITTER_RATIO
+    return max(1.0, interval_seconds + random.uniform(-jitter, jitter))
+
+
+def _worker_loop(interval_seconds: int):
+    while True:
+        time.sleep(_next_delay(interval_seconds))
+        try:
+            run_expiry_pass()
+        except Exception:
+            traceback.print_exc()
+
+
+def start_retention_worker(interval_seconds: int = RETENTION_INTERVAL_SECONDS):
+    """Start the jittered background expiry loop once per process."""
+    global _worker_thread
+    if not RETENTION_WORKER_ENABLED:
+        return None
+    with _worker_lock:
+        if _worker_thread and _worker_thread.is_alive():
+            return _worker_thread
+        _worker_thread = threading.Thread(
+            target=_worker_loop,
+            args=(interval_seconds,),
+            name="readings-retention",
+            daemon=True,
+        )
+        _worker_thread.start()
+        return _worker_thread
+
+
+def recount_history_totals(user_ids=None) -> int:
+    """Rebuild reading_counts rows, e.g. after a rollout during which the
+    previous release wrote readings without bumping the counter."""
+    recounted = 0
+    for user_id in user_ids or list_counted_user_ids():
+        recount_history_total(user_id)
+        recounted += 1
+    print(f"reading counts: recounted {recounted} users")
+    return recounted
+
+
+if __name__ == "__main__":
+    # One-off pass, e.g. from a scheduler: python retention_worker.py
+    # Counter repair: python retention_worker.py recount-history [user_id ...]
+    command = sys.argv[1] if len(sys.argv) > 1 else "expire"
+    if command == "expire":
+        run_expiry_pass()
+    elif command == "recount-history":
+        recount_history_totals(sys.argv[2:])
+    else:
+        print("usage: python retention_worker.py [expire|recount-history [user_id ...]]")
+        sys.exit(1)
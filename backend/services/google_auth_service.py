@@ -0,0 +1,154 @@
+import base64
+import json
+import os
+import re
+import threading
+import time
+import traceback
+
+import requests
+from google.auth import jwt as google_jwt
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = {"accounts.google.com", "https://accounts.google.com"}
+CERT_FETCH_TIMEOUT_SECONDS = 5
+DEFAULT_CERT_MAX_AGE_SECONDS = 3600
+# Refresh when this share of max-age has passed, well before the certs go stale.
+REFRESH_AHEAD_RATIO = 0.8
+MIN_REFRESH_INTERVAL_SECONDS = 60
+RETRY_INTERVAL_SECONDS = 30
+# An unknown key id forces a refetch (key rotation), but not more often than this.
+FORCED_REFRESH_MIN_INTERVAL_SECONDS = 30
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class GoogleAuthError(RuntimeError):
+    pass
+
+
+def _cache_lifetime(response) -> int:
+    match = MAX_AGE_RE.search(response.headers.get("Cache-Control") or "")
+    max_age = int(match.group(1)) if match else DEFAULT_CERT_MAX_AGE_SECONDS
+    try:
+        max_age -= int(response.headers.get("Age") or 0)
+    except ValueError:
+        pass
+    return max(max_age, 0)
+
+
+def _token_key_id(token: str):
+    try:
+        header = token.split(".", 1)[0]
+        padded = header + "=" * (-len(header) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode("ascii"))).get("kid")
+    except Exception:
+        return None
+
+
+class GoogleCertCache:
+    """Google's ID-token signing certs, kept fresh by a background thread.
+
+    Certs are fetched over one pooled requests.Session and kept for the
+    max-age Google sends; the refresher replaces them before they expire.
+    A failed refresh keeps the previous set, even past its max-age, and
+    requests do not retry the fetch more than once per
+    RETRY_INTERVAL_SECONDS. With a warm cache, verification needs no
+    network at all.
+    """
+
+    def __init__(self, certs_url: str = GOOGLE_CERTS_URL):
+        self.certs_url = certs_url
+        self._session = requests.Session()
+        self._certs = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._failed_at = float("-inf")
+        self._lock = threading.Lock()
+        self._thread = None
+        self._owner_pid = None
+
+    def certs(self, key_id=None) -> dict:
+        certs = self._certs
+        now = time.monotonic()
+        if self._needs_refresh(certs, key_id, now):
+            try:
+                certs = self._refresh(key_id)
+            except Exception:
+                if not self._certs:
+                    raise
+                # Google unreachable: expired certs are still better than
+                # refusing every login; the refresher keeps retrying.
+                traceback.print_exc()
+                certs = self._certs
+        self.start_refresher()
+        return certs
+
+    def _needs_refresh(self, certs: dict, key_id, now: float) -> bool:
+        if certs and now - self._failed_at < RETRY_INTERVAL_SECONDS:
+            return False
+        if not certs or now >= self._expires_at:
+            return True
+        return bool(key_id) and key_id not in certs and now - self._fetched_at >= FORCED_REFRESH_MIN_INTERVAL_SECONDS
+
+    def _refresh(self, key_id=None, force: bool = False) -> dict:
+        with self._lock:
+            # Another thread may have refreshed while this one waited.
+            if not force and not self._needs_refresh(self._certs, key_id, time.monotonic()):
+                return self._certs
+            try:
+                response = self._session.get(self.certs_url, timeout=CERT_FETCH_TIMEOUT_SECONDS)
+                response.raise_for_status()
+                certs = response.json()
+            except Exception:
+                self._failed_at = time.monotonic()
+                raise
+            now = time.monotonic()
+            self._certs = certs
+            self._fetched_at = now
+            self._expires_at = now + _cache_lifetime(response)
+            self._failed_at = float("-inf")
+            return certs
+
+    def start_refresher(self):
+        pid = os.getpid()
+        if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+                return
+            # Threads do not survive a fork (gunicorn pre-fork), so start one per process.
+            self._owner_pid = pid
+            self._thread = threading.Thread(target=self._run, name="google-cert-refresher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            if self._certs:
+                lifetime = self._expires_at - self._fetched_at
+                refresh_at = self._fetched_at + max(lifetime * REFRESH_AHEAD_RATIO, MIN_REFRESH_INTERVAL_SECONDS)
+                time.sleep(max(refresh_at - time.monotonic(), 0))
+            try:
+                self._refresh(force=True)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(RETRY_INTERVAL_SECONDS)
+
+
+_CERT_CACHE = GoogleCertCache()
+
+
+def start_google_cert_refresher():
+    """Fetch the certs in the background so the first login of a worker is already offline."""
+    _CERT_CACHE.start_refresher()
+
+
+def verify_google_id_token(id_token_str: str, audience: str) -> dict:
+    """Verify a Google ID token against the cached certs; returns its claims or raises."""
+    try:
+        certs = _CERT_CACHE.certs(_token_key_id(id_token_str))
+    except Exception as exc:
+        raise GoogleAuthError("google_certs_unavailable") from exc
+    claims = google_jwt.decode(id_token_str, certs=certs, audience=audience)
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise GoogleAuthError("invalid_issuer")
+    return claims
@@ -8,7 +8,7 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL") or "https://generativelanguage.googleapis.com/v1beta/models"
 DEFAULT_GEMINI_MODEL = "gemini-2.5-flash-lite"
 #DEFAULT_GEMINI_MODEL = "gemini-2.5-Pro"
 DEFAULT_FALLBACK_MODELS = ("gemini-2.5-flash", "gemini-3-flash-preview")
@@ -0,0 +1,253 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from event_queue import WriteBehindQueue
+
+load_dotenv()
+
+DEFAULT_SAMPLE_RATE = 0.0
+DEFAULT_LOG_FORMAT = "jsonl"
+DEFAULT_MAX_FILE_BYTES = 10 * 1024 * 1024
+DEFAULT_RETENTION_DAYS = 7
+DEFAULT_QUEUE_SIZE = 1000
+PRUNE_INTERVAL_SECONDS = 3600
+SUPPORTED_LOG_FORMATS = {"jsonl", "markdown"}
+
+
+def _parse_float_env(var_name: str, default_value: float) -> float:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return float(raw)
+    except ValueError:
+        return default_value
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+def _resolve_log_format() -> str:
+    raw = (os.getenv("DEBUG_PROMPT_LOG_FORMAT") or DEFAULT_LOG_FORMAT).strip().lower()
+    return raw if raw in SUPPORTED_LOG_FORMATS else DEFAULT_LOG_FORMAT
+
+
+def safe_filename_component(value, default):
+    raw = str(value or "").strip()
+    if not raw:
+        return default
+    sanitized = "".join(ch if (ch.isalnum() or ch in {"-", "_"}) else "_" for ch in raw)
+    sanitized = sanitized.strip("_")
+    if not sanitized:
+        return default
+    return sanitized[:60]
+
+
+def _format_iso(ts: datetime) -> str:
+    return ts.isoformat().replace("+00:00", "Z")
+
+
+def render_markdown(record: dict) -> str:
+    """Render one logged record in the original per-request markdown layout."""
+    changing_lines_json = json.dumps(record.get("changing_lines") or [], ensure_ascii=False)
+    question_text = (record.get("question") or "").strip()
+    is_image = record.get("kind") == "image"
+
+    lines = [
+        "# Ad Card Image Prompt Debug Log\n\n" if is_image else "# Ask Prompt Debug Log\n\n",
+        f"- created_at_utc: `{record.get('created_at_utc') or ''}`\n",
+        f"- user_id: `{record.get('user_id') or ''}`\n",
+        f"- hexagram_code: `{record.get('hexagram_code') or ''}`\n",
+        f"- changing_lines: `{changing_lines_json}`\n",
+    ]
+    if is_image:
+        lines.append(f"- image_model: `{record.get('image_model') or ''}`\n")
+    lines.append(f"- question: `{question_text}`\n\n")
+
+    if is_image:
+        lines.extend(["## Image Prompt\n\n", "```text\n", f"{record.get('image_prompt') or ''}\n", "```\n"])
+    else:
+        lines.extend(["## System Prompt\n\n", "```text\n", f"{record.get('system_prompt') or ''}\n", "```\n\n"])
+        lines.extend(["## User Prompt\n\n", "```text\n", f"{record.get('user_prompt') or ''}\n", "```\n"])
+    return "".join(lines)
+
+
+def _markdown_filename(record: dict) -> str:
+    try:
+        ts = datetime.fromisoformat(str(record.get("created_at_utc") or "").replace("Z", "+00:00"))
+    except ValueError:
+        ts = datetime.now(timezone.utc)
+    parts = [
+        ts.strftime("%Y%m%d_%H%M%S_%f"),
+        safe_filename_component(record.get("user_id"), "anonymous"),
+        safe_filename_component(record.get("hexagram_code"), "unknown_hex"),
+    ]
+    if record.get("kind") == "image":
+        parts.append(safe_filename_component(record.get("image_model"), "unknown_model"))
+    return "_".join(parts) + ".md"
+
+
+class PromptLogSink:
+    """Sampled, rotating prompt log written from a background thread.
+
+    Records are appended to `<prefix>-<YYYYMMDD>-<n>.jsonl` files that rotate
+    at `max_file_bytes`; files older than `retention_days` are removed when a
+    new file is opened. With DEBUG_PROMPT_LOG_FORMAT=markdown each record is
+    written as its own markdown file instead.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        file_prefix: str,
+        sample_rate: float | None = None,
+        log_format: str | None = None,
+        max_file_bytes: int | None = None,
+        retention_days: int | None = None,
+        queue_size: int | None = None,
+    ):
+        self.directory = directory
+        self.file_prefix = file_prefix
+        self.sample_rate = (
+            sample_rate if sample_rate is not None else _parse_float_env("DEBUG_PROMPT_LOG_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)
+        )
+        self.log_format = log_format or _resolve_log_format()
+        self.max_file_bytes = max_file_bytes or _parse_int_env("DEBUG_PROMPT_LOG_MAX_BYTES", DEFAULT_MAX_FILE_BYTES)
+        self.retention_days = (
+            retention_days
+            if retention_days is not None
+            else _parse_int_env("DEBUG_PROMPT_LOG_RETENTION_DAYS", DEFAULT_RETENTION_DAYS)
+        )
+        self._dir_ready = False
+        self._current_path = None
+        self._last_prune_at = 0.0
+        self._write_lock = threading.Lock()
+        self._queue = WriteBehindQueue(
+            f"prompt-log-{file_prefix}",
+            self._write_records,
+            max_size=queue_size or _parse_int_env("DEBUG_PROMPT_LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE),
+            enabled=True,
+            overflow="drop",
+        )
+
+    def log(self, record: dict) -> bool:
+        """Queue a record if it is sampled in. Never blocks on file I/O."""
+        if self.sample_rate <= 0:
+            return False
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        record = dict(record)
+        record.setdefault("created_at_utc", _format_iso(datetime.now(timezone.utc)))
+        return self._queue.submit(record)
+
+    def _ensure_dir(self):
+        if not self._dir_ready:
+            os.makedirs(self.directory, exist_ok=True)
+            self._dir_ready = True
+
+    def _write_records(self, records: list):
+        with self._write_lock:
+            self._ensure_dir()
+            if self.log_format == "markdown":
+                for record in records:
+                    path = os.path.join(self.directory, _markdown_filename(record))
+                    with open(path, "w", encoding="utf-8") as file:
+                        file.write(render_markdown(record))
+                self._prune_old_files()
+                return
+
+            path = self._resolve_jsonl_path()
+            # Every gunicorn worker appends to the same file. One write() per
+            # record on an O_APPEND descriptor lands each line whole at the
+            # end of the file; a buffered file object may split it into
+            # several writes that interleave with another worker's.
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                for record in records:
+                    os.write(fd, (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            finally:
+                os.close(fd)
+
+    def _resolve_jsonl_path(self) -> str:
+        day = datetime.now(timezone.utc).strftime("%Y%m%d")
+        path = self._current_path
+        if path and os.path.basename(path).startswith(f"{self.file_prefix}-{day}-"):
+            try:
+                if os.path.getsize(path) < self.max_file_bytes:
+                    return path
+            except OSError:
+                return path
+
+        seq = 0
+        while True:
+            candidate = os.path.join(self.directory, f"{self.file_prefix}-{day}-{seq}.jsonl")
+            if not os.path.exists(candidate) or os.path.getsize(candidate) < self.max_file_bytes:
+                break
+            seq += 1
+        self._current_path = candidate
+        self._prune_old_files()
+        return candidate
+
+    def _prune_old_files(self):
+        now = time.time()
+        if self.retention_days <= 0 or now - self._last_prune_at < PRUNE_INTERVAL_SECONDS:
+            return
+        self._last_prune_at = now
+        cutoff = now - self.retention_days * 86400
+        try:
+            entries = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in entries:
+            if not (name.endswith(".jsonl") or name.endswith(".md")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                traceback.print_exc()
+
+
+def render_jsonl_file(jsonl_path: str, output_dir: str) -> int:
+    """Expand a JSONL prompt log into one markdown file per record."""
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    with open(jsonl_path, "r", encoding="utf-8") as src:
+        for line in src:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            with open(os.path.join(output_dir, _markdown_filename(record)), "w", encoding="utf-8") as dst:
+                dst.write(render_markdown(record))
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python -m services.prompt_log_service <log.jsonl> [output_dir]")
+        sys.exit(1)
+    source = sys.argv[1]
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(source)[0]
+    written = render_jsonl_file(source, target)
+    print(f"rendered {written} records to {target}")
@@ -2,7 +2,7 @@ import datetime
 
 from flask import Blueprint, jsonify, request
 
-from auth_route import decode_session_token
+from auth_middleware import current_user_id, require_auth
 from billing_repo import record_billing_event
 from users_repo import add_user_gold, get_user_by_id, update_user_coins, update_user_subscription
 
@@ -10,22 +10,10 @@ store_bp = Blueprint("store", __name__, url_prefix="/store")
 ONE_USD_SILVER_REWARD = 2
 
 
-def _get_user_id():
-    auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
-        return None
-    token = auth_header.split(" ", 1)[1].strip()
-    payload = decode_session_token(token)
-    if not payload:
-        return None
-    return payload.get("sub")
-
-
 @store_bp.route("/verify", methods=["POST"])
+@require_auth
 def verify_purchase():
-    user_id = _get_user_id()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     data = request.get_json(silent=True) or {}
     platform = data.get("platform")
@@ -64,10 +52,9 @@ def verify_purchase():
 
 
 @store_bp.route("/status", methods=["GET"])
+@require_auth
 def get_subscription_status():
-    user_id = _get_user_id()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     user = get_user_by_id(user_id)
     if not user:
@@ -87,10 +74,9 @@ def get_subscription_status():
 
 
 @store_bp.route("/coins", methods=["POST"])
+@require_auth
 def purchase_coins():
-    user_id = _get_user_id()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     data = request.get_json(silent=True) or {}
     platform = data.get("platform")
@@ -130,10 +116,9 @@ def purchase_coins():
 
 
 @store_bp.route("/pay-usd", methods=["POST"])
+@require_auth
 def pay_one_usd_for_silver():
-    user_id = _get_user_id()
-    if not user_id:
-        return jsonify({"error": "invalid_or_expired_token"}), 401
+    user_id = current_user_id()
 
     data = request.get_json(silent=True) or {}
     provider = str(data.get("provider") or "mock").strip() or "mock"
@@ -0,0 +1,439 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from pg_connections import DB_MAX_CONNECTIONS
+from stream_coalescer import STREAM_COALESCE_BYTES, STREAM_COALESCE_MS
+
+# Streaming benchmarks. A fake Gemini upstream trickles SSE chunks for
+# --stream-seconds; gunicorn (gunicorn.conf.py) serves the real `app:app`,
+# and N clients POST /api/divination at once as one bench user, so every
+# stream also authenticates, charges a coin, looks up the hexagram and
+# saves the reading through the DB_MAX_CONNECTIONS limit.
+#
+# Needs DATABASE_URL pointing at a migrated development database: the
+# user "bench:stream-bench" is created there and topped up with coins, and
+# its readings are deleted afterwards. A JWT_SECRET is generated when none
+# is set.
+#
+# --mode concurrency: mid-stream, samples how many streams are actually
+# being served and the RSS of the whole gunicorn process tree.
+#   python stream_bench.py --worker-class sync --workers 4 --streams 200
+#   python stream_bench.py --worker-class gevent --workers 1 --streams 200
+#
+# --mode coalesce: runs the same tiny-fragment stream with coalescing off
+# and on, and compares WSGI writes, client socket reads (wakeups), TCP
+# segments and server CPU per stream.
+#   python stream_bench.py --mode coalesce --fragment-chars 3 --chunks 400
+
+DEFAULT_STREAMS = 200
+DEFAULT_STREAM_SECONDS = 20
+DEFAULT_CHUNKS = 40
+DEFAULT_FRAGMENT_CHARS = 40
+FRAGMENT_SOURCE = "潛龍勿用，陽在下也。見龍在田，德施普也。"
+SERVER_START_TIMEOUT_SECONDS = 20
+
+BENCH_PROVIDER = "bench"
+BENCH_PROVIDER_UID = "stream-bench"
+BENCH_PAYLOAD = json.dumps({"question": "bench", "throws": [7, 8, 9, 6, 7, 8]})
+STATS_PATH = "/__bench/stats"
+
+
+def _counted(body, counter: dict):
+    try:
+        for chunk in body:
+            if chunk:
+                counter["writes"] += 1
+            yield chunk
+    finally:
+        close = getattr(body, "close", None)
+        if close:
+            close()
+
+
+def create_bench_app():
+    """`app:app` plus a count of the body writes of /api/divination responses.
+
+    Loaded by gunicorn as `stream_bench:create_bench_app()`, so the app is
+    imported in each worker after gevent has patched it.
+    """
+    from app import app
+
+    counter = {"writes": 0}
+
+    def bench_app(environ, start_response):
+        path = environ.get("PATH_INFO")
+        if path == STATS_PATH:
+            body = json.dumps(counter).encode("utf-8")
+            start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+            return [body]
+        result = app(environ, start_response)
+        return _counted(result, counter) if path == "/api/divination" else result
+
+    return bench_app
+
+
+def _prepare_bench_user(asks: int) -> tuple:
+    """Bench user with coins for `asks` divinations; returns (user_id, session token)."""
+    if not os.getenv("JWT_SECRET"):
+        os.environ["JWT_SECRET"] = os.urandom(32).hex()
+    from auth_middleware import create_session_token
+    from users_repo import get_or_create_user_by_provider, get_pg
+
+    user = get_or_create_user_by_provider(BENCH_PROVIDER, BENCH_PROVIDER_UID, None, "Stream bench")
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE users SET silver_coins = %s WHERE id = %s", (asks, user["id"]))
+        conn.commit()
+    token, _ = create_session_token(user["id"])
+    return user["id"], token
+
+
+def _cleanup_bench_user(user_id: str):
+    from users_repo import get_pg
+
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM reading_sync_keys WHERE user_id = %s", (user_id,))
+        cur.execute("DELETE FROM readings WHERE user_id = %s", (user_id,))
+        cur.execute("UPDATE reading_counts SET total = 0 WHERE user_id = %s", (user_id,))
+        conn.commit()
+
+
+class _FakeGeminiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunks = self.server.chunks
+        delay = self.server.stream_seconds / chunks
+        text = (FRAGMENT_SOURCE * (self.server.fragment_chars // len(FRAGMENT_SOURCE) + 1))[: self.server.fragment_chars]
+        data = json.dumps({"candidates": [{"content": {"parts": [{"text": text}]}}]}, ensure_ascii=False)
+        try:
+            for _ in range(chunks):
+                self.wfile.write(f"data: {data}\r\n\r\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"gunicorn did not listen on {port} within {timeout}s")
+
+
+def _process_tree(root_pid: int) -> list:
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                stat = file.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        parents.setdefault(ppid, []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(parents.get(pid, []))
+    return pids
+
+
+def _rss_bytes(pids: list) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def _cpu_seconds(pids: list) -> float:
+    ticks = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _tcp_out_segments() -> int:
+    with open("/proc/net/snmp") as file:
+        rows = [line.split() for line in file if line.startswith("Tcp:")]
+    return int(rows[1][rows[0].index("OutSegs")])
+
+
+def _raw_client(port: int, token: str, results: list, lock: threading.Lock, timeout: float):
+    # Plain socket so every recv() that returns data is counted: one
+    # client wakeup, roughly one segment on a quiet loopback.
+    started = time.monotonic()
+    first_byte = None
+    reads = 0
+    body = BENCH_PAYLOAD.encode("utf-8")
+    head = (
+        "POST /api/divination HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+        f"Authorization: Bearer {token}\r\nAccept: text/plain\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+    )
+    with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+        sock.sendall(head.encode("ascii") + body)
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            reads += 1
+            if first_byte is None:
+                first_byte = time.monotonic() - started
+    with lock:
+        results.append((first_byte or 0.0, reads))
+
+
+def _client(url: str, token: str, state: dict, lock: threading.Lock, timeout: float):
+    started = time.monotonic()
+    first_byte = None
+    headers = {"Authorization": f"Bearer {token}", "Accept": "text/plain", "Content-Type": "application/json"}
+    try:
+        with requests.post(url, data=BENCH_PAYLOAD, headers=headers, stream=True, timeout=timeout) as response:
+            for chunk in response.iter_content(chunk_size=None):
+                if chunk and first_byte is None:
+                    first_byte = time.monotonic() - started
+                    with lock:
+                        state["active"] += 1
+            ok = response.ok
+    except requests.RequestException:
+        ok = False
+    with lock:
+        if first_byte is not None:
+            state["active"] -= 1
+            state["first_byte"].append(first_byte)
+        state["done" if ok else "failed"] += 1
+
+
+def _start_upstream(stream_seconds: float, chunks: int, fragment_chars: int) -> _FakeGeminiServer:
+    upstream = _FakeGeminiServer(("127.0.0.1", _free_port()), _FakeGeminiHandler)
+    upstream.stream_seconds = stream_seconds
+    upstream.chunks = chunks
+    upstream.fragment_chars = fragment_chars
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    return upstream
+
+
+def _start_gunicorn(upstream: _FakeGeminiServer, worker_class: str, workers: int, connections: int, **extra_env):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        WEB_WORKER_CLASS=worker_class,
+        WEB_CONCURRENCY=str(workers),
+        WEB_WORKER_CONNECTIONS=str(max(connections, 1)),
+        GEMINI_BASE_URL=f"http://127.0.0.1:{upstream.server_address[1]}/v1beta/models",
+        GEMINI_API_KEY="bench",
+        RETENTION_WORKER_ENABLED="false",
+        **{k: str(v) for k, v in extra_env.items()},
+    )
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}", "stream_bench:create_bench_app()",
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    try:
+        _wait_for_port(port, SERVER_START_TIMEOUT_SECONDS)
+    except Exception:
+        server.terminate()
+        server.wait()
+        raise
+    return server, port
+
+
+def run_bench(worker_class: str, workers: int, streams: int, stream_seconds: float, chunks: int,
+              fragment_chars: int = DEFAULT_FRAGMENT_CHARS) -> dict:
+    user_id, token = _prepare_bench_user(streams)
+    upstream = _start_upstream(stream_seconds, chunks, fragment_chars)
+    server, port = _start_gunicorn(upstream, worker_class, workers, streams)
+    try:
+        idle_rss = _rss_bytes(_process_tree(server.pid))
+
+        state = {"active": 0, "done": 0, "failed": 0, "first_byte": []}
+        lock = threading.Lock()
+        url = f"http://127.0.0.1:{port}/api/divination"
+        clients = [
+            threading.Thread(target=_client, args=(url, token, state, lock, stream_seconds * 20), daemon=True)
+            for _ in range(streams)
+        ]
+        started = time.monotonic()
+        for thread in clients:
+            thread.start()
+
+        # Sample in the middle of the first wave, when every stream that
+        # can be served concurrently is mid-generation.
+        time.sleep(stream_seconds * 0.6)
+        with lock:
+            active = state["active"]
+        peak_rss = _rss_bytes(_process_tree(server.pid))
+
+        for thread in clients:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.shutdown()
+        _cleanup_bench_user(user_id)
+
+    first_byte = sorted(state["first_byte"]) or [0.0]
+    return {
+        "worker_class": worker_class,
+        "workers": workers,
+        "db_max_connections": DB_MAX_CONNECTIONS,
+        "streams": streams,
+        "concurrent_streams": active,
+        "rss_idle_mb": round(idle_rss / 2**20, 1),
+        "rss_peak_mb": round(peak_rss / 2**20, 1),
+        "streams_per_gb": round(active / (peak_rss / 2**30), 1) if peak_rss else 0.0,
+        "first_byte_p50_s": round(first_byte[len(first_byte) // 2], 2),
+        "first_byte_max_s": round(first_byte[-1], 2),
+        "completed": state["done"],
+        "failed": state["failed"],
+        "elapsed_s": round(elapsed, 1),
+    }
+
+
+def _run_coalesce_pass(token: str, streams: int, stream_seconds: float, chunks: int, fragment_chars: int,
+                       max_bytes: int, max_delay_ms: int) -> dict:
+    upstream = _start_upstream(stream_seconds, chunks, fragment_chars)
+    server, port = _start_gunicorn(
+        upstream, "gevent", 1, streams, STREAM_COALESCE_BYTES=max_bytes, STREAM_COALESCE_MS=max_delay_ms
+    )
+    try:
+        pids = _process_tree(server.pid)
+        cpu_before = _cpu_seconds(pids)
+        segments_before = _tcp_out_segments()
+        results = []
+        lock = threading.Lock()
+        clients = [
+            threading.Thread(target=_raw_client, args=(port, token, results, lock, stream_seconds * 20), daemon=True)
+            for _ in range(streams)
+        ]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        segments = _tcp_out_segments() - segments_before
+        cpu = _cpu_seconds(pids) - cpu_before
+        writes = requests.get(f"http://127.0.0.1:{port}{STATS_PATH}", timeout=5).json()["writes"]
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.shutdown()
+
+    first_byte = sorted(r[0] for r in results) or [0.0]
+    return {
+        "coalesce_bytes": max_bytes,
+        "coalesce_ms": max_delay_ms,
+        "wsgi_writes_per_stream": round(writes / streams, 1),
+        "client_reads_per_stream": round(sum(r[1] for r in results) / streams, 1),
+        "tcp_segments_per_stream": round(segments / streams, 1),
+        "server_cpu_ms_per_stream": round(cpu * 1000 / streams, 1),
+        "first_byte_p50_s": round(first_byte[len(first_byte) // 2], 3),
+    }
+
+
+def run_coalesce_bench(streams: int, stream_seconds: float, chunks: int, fragment_chars: int,
+                       max_bytes: int = STREAM_COALESCE_BYTES, max_delay_ms: int = STREAM_COALESCE_MS) -> dict:
+    """Same stream with coalescing off and on; segment counts are system-wide
+    loopback OutSegs, so they include the (identical) upstream traffic."""
+    user_id, token = _prepare_bench_user(2 * streams)
+    try:
+        off = _run_coalesce_pass(token, streams, stream_seconds, chunks, fragment_chars, 0, 0)
+        on = _run_coalesce_pass(token, streams, stream_seconds, chunks, fragment_chars, max_bytes, max_delay_ms)
+    finally:
+        _cleanup_bench_user(user_id)
+
+    def reduction(key):
+        return round(1 - on[key] / off[key], 3) if off[key] else 0.0
+
+    return {
+        "streams": streams,
+        "fragments_per_stream": chunks,
+        "fragment_chars": fragment_chars,
+        "off": off,
+        "on": on,
+        "write_reduction": reduction("wsgi_writes_per_stream"),
+        "client_read_reduction": reduction("client_reads_per_stream"),
+        "tcp_segment_reduction": reduction("tcp_segments_per_stream"),
+        "server_cpu_reduction": reduction("server_cpu_ms_per_stream"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming benchmarks for the divination endpoint.")
+    parser.add_argument("--mode", default="concurrency", choices=["concurrency", "coalesce"])
+    parser.add_argument("--worker-class", default="gevent", choices=["sync", "gevent"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--streams", type=int, default=None)
+    parser.add_argument("--stream-seconds", type=float, default=DEFAULT_STREAM_SECONDS)
+    parser.add_argument("--chunks", type=int, default=DEFAULT_CHUNKS)
+    parser.add_argument("--fragment-chars", type=int, default=DEFAULT_FRAGMENT_CHARS)
+    parser.add_argument("--coalesce-bytes", type=int, default=STREAM_COALESCE_BYTES)
+    parser.add_argument("--coalesce-ms", type=int, default=STREAM_COALESCE_MS)
+    args = parser.parse_args()
+    if args.mode == "coalesce":
+        result = run_coalesce_bench(
+            args.streams or 20,
+            args.stream_seconds,
+            args.chunks,
+            args.fragment_chars,
+            args.coalesce_bytes,
+            args.coalesce_ms,
+        )
+    else:
+        result = run_bench(
+            args.worker_class,
+            args.workers,
+            args.streams or DEFAULT_STREAMS,
+            args.stream_seconds,
+            args.chunks,
+            args.fragment_chars,
+        )
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+# Streamed text is sent once this many bytes are buffered, or once this
+# long has passed since the previous send, whichever comes first. The first
+# piece always goes out at once. 0 for both sends every fragment as is.
+STREAM_COALESCE_BYTES = _parse_int_env("STREAM_COALESCE_BYTES", 512)
+STREAM_COALESCE_MS = _parse_int_env("STREAM_COALESCE_MS", 100)
+
+
+def coalescing_enabled(max_bytes: int = STREAM_COALESCE_BYTES, max_delay_ms: int = STREAM_COALESCE_MS) -> bool:
+    return max_bytes > 0 or max_delay_ms > 0
+
+
+def coalesce_chunks(chunks, max_bytes: int = STREAM_COALESCE_BYTES, max_delay_ms: int = STREAM_COALESCE_MS):
+    """Regroup an iterator of small text chunks into fewer, larger ones.
+
+    A helper thread drains `chunks` so buffered text can be flushed on the
+    timer even while the source is blocked waiting for its next fragment.
+    When the consumer is closed (client went away), the source is closed
+    on the helper thread as soon as it yields again, so its own cleanup
+    (saving, refunds) still runs.
+    """
+    if not coalescing_enabled(max_bytes, max_delay_ms):
+        yield from chunks
+        return
+
+    max_delay = max_delay_ms / 1000.0
+    cond = threading.Condition()
+    state = {"parts": [], "size": 0, "done": False, "error": None, "stop": False}
+
+    def pump():
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                with cond:
+                    if state["stop"]:
+                        break
+                    state["parts"].append(chunk)
+                    state["size"] += len(chunk.encode("utf-8"))
+                    cond.notify_all()
+        except BaseException as exc:
+            state["error"] = exc
+        finally:
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+            with cond:
+                state["done"] = True
+                cond.notify_all()
+
+    threading.Thread(target=pump, name="stream-coalescer", daemon=True).start()
+
+    last_flush = None
+    try:
+        while True:
+            with cond:
+                while not state["parts"] and not state["done"]:
+                    cond.wait()
+                if last_flush is not None:
+                    deadline = last_flush + max_delay
+                    while not state["done"] and (max_bytes <= 0 or state["size"] < max_bytes):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        cond.wait(remaining)
+                out = "".join(state["parts"])
+                state["parts"] = []
+                state["size"] = 0
+                done = state["done"]
+                error = state["error"]
+            if out:
+                yield out
+                last_flush = time.monotonic()
+            if done:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        with cond:
+            state["stop"] = True
@@ -0,0 +1,152 @@
+"""Requests holding a connection slot must never wait for a second one.
+
+With DB_MAX_CONNECTIONS=N, N+1 concurrent requests that each look up a
+zstd dictionary while holding their connection must all finish, and a
+retention pass must run with a single slot.
+
+Needs a disposable PostgreSQL 13+ database and zstandard: set DATABASE_URL
+and run from backend/ with `python -m unittest discover tests`. Skipped
+otherwise.
+"""
+import os
+import sys
+import threading
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SLOTS = 3
+WAIT_SECONDS = 5.0
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@unittest.skipUnless(os.getenv("DATABASE_URL"), "DATABASE_URL is not set")
+@unittest.skipIf(zstandard is None, "zstandard is not installed")
+class ConnectionSlotTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from migrations import run_migrations
+
+        run_migrations()
+
+    def setUp(self):
+        import pg_connections
+        import reading_codec
+
+        self.user_ids = [str(uuid.uuid4()) for _ in range(SLOTS + 1)]
+        self._saved = (
+            pg_connections._slots,
+            pg_connections.DB_CONNECTION_WAIT_SECONDS,
+            reading_codec.READING_CODEC,
+            reading_codec._DICTIONARIES,
+        )
+        with reading_codec.get_pg() as conn, conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO compression_dictionaries (codec, dict_data) VALUES ('zstd', %s) RETURNING version",
+                (b"hexagram changing lines reading summary " * 64,),
+            )
+            self.dict_version = int(cur.fetchone()["version"])
+            conn.commit()
+
+        pg_connections._slots = threading.BoundedSemaphore(SLOTS)
+        pg_connections.DB_CONNECTION_WAIT_SECONDS = WAIT_SECONDS
+        reading_codec.READING_CODEC = "zstd"
+        self._cold_dictionary_cache()
+
+    def tearDown(self):
+        import pg_connections
+        import reading_codec
+
+        (
+            pg_connections._slots,
+            pg_connections.DB_CONNECTION_WAIT_SECONDS,
+            reading_codec.READING_CODEC,
+            reading_codec._DICTIONARIES,
+        ) = self._saved
+        with reading_codec.get_pg() as conn, conn.cursor() as cur:
+            for table in ("readings", "reading_sync_keys", "reading_counts"):
+                cur.execute(f"DELETE FROM {table} WHERE user_id = ANY(%s)", (self.user_ids,))
+            cur.execute("DELETE FROM compression_dictionaries WHERE version=%s", (self.dict_version,))
+            conn.commit()
+
+    def _cold_dictionary_cache(self):
+        import reading_codec
+
+        reading_codec._DICTIONARIES = reading_codec._DictionaryCache()
+
+    def _run_concurrently(self, target):
+        barrier = threading.Barrier(len(self.user_ids))
+        errors = []
+        lock = threading.Lock()
+
+        def run(user_id):
+            try:
+                barrier.wait()
+                target(user_id)
+            except Exception as exc:
+                with lock:
+                    errors.append(exc)
+
+        threads = [threading.Thread(target=run, args=(user_id,)) for user_id in self.user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+        self.assertEqual(errors, [])
+
+    def test_nested_dictionary_lookups_do_not_deadlock(self):
+        from history_export import iter_export_records
+        from history_repo import record_readings_bulk
+        from reading_codec import blob_format
+
+        def record(user_id):
+            record_readings_bulk(
+                user_id,
+                [
+                    {
+                        "sync_key": f"slots-{i}",
+                        "question": "q",
+                        "hex_code": "111111",
+                        "changing_lines": [],
+                        "full_text": f"hexagram reading {i} " * 20,
+                    }
+                    for i in range(3)
+                ],
+            )
+
+        self._run_concurrently(record)
+
+        from history_repo import get_pg
+
+        with get_pg() as conn, conn.cursor() as cur:
+            cur.execute("SELECT result_full FROM readings WHERE user_id = ANY(%s)", (self.user_ids,))
+            formats = {blob_format(r["result_full"]) for r in cur.fetchall()}
+        self.assertEqual(formats, {f"zstd_dict:{self.dict_version}"})
+
+        self._cold_dictionary_cache()
+        exported = {}
+
+        def export(user_id):
+            exported[user_id] = [r["content"] for r in iter_export_records(user_id)]
+
+        self._run_concurrently(export)
+        for user_id in self.user_ids:
+            self.assertEqual(len(exported[user_id]), 3)
+            self.assertTrue(all(text.startswith("hexagram reading") for text in exported[user_id]))
+
+    def test_expiry_pass_runs_with_one_slot(self):
+        import pg_connections
+        from retention_worker import run_expiry_pass
+
+        pg_connections._slots = threading.BoundedSemaphore(1)
+        stats = run_expiry_pass()
+        self.assertFalse(stats["skipped"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""An open transaction must not hold back another user's change feed.
+
+Needs a disposable PostgreSQL 13+ database: set DATABASE_URL and run from
+backend/ with `python -m unittest discover tests`. Skipped otherwise.
+"""
+import os
+import sys
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@unittest.skipUnless(os.getenv("DATABASE_URL"), "DATABASE_URL is not set")
+class ChangeFeedTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from migrations import run_migrations
+
+        run_migrations()
+
+    def setUp(self):
+        self.user_a = str(uuid.uuid4())
+        self.user_b = str(uuid.uuid4())
+        self.open_conns = []
+
+    def tearDown(self):
+        from history_repo import get_pg
+
+        for conn in self.open_conns:
+            conn.rollback()
+            conn.close()
+        with get_pg() as conn, conn.cursor() as cur:
+            for table in ("readings", "reading_tombstones", "reading_sync_keys", "reading_counts"):
+                cur.execute(f"DELETE FROM {table} WHERE user_id IN (%s, %s)", (self.user_a, self.user_b))
+            conn.commit()
+
+    def _open_transaction(self, sql, params=()):
+        from history_repo import get_pg
+
+        conn = get_pg()
+        self.open_conns.append(conn)
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+        return conn
+
+    def _insert_reading(self, cur, user_id):
+        cur.execute(
+            """
+            INSERT INTO readings (user_id, question, hexagram_code, changing_lines, result_summary)
+            VALUES (%s, 'q', '111111', '[]', 's')
+            RETURNING id
+            """,
+            (user_id,),
+        )
+        return int(cur.fetchone()["id"])
+
+    def _drain(self, user_id, cursor):
+        from history_repo import list_history_changes
+
+        changed, deleted = [], []
+        while True:
+            page = list_history_changes(user_id, cursor=cursor, limit=2)
+            changed += [int(r["id"]) for r in page["changed"]]
+            deleted += page["deleted"]
+            cursor = page["next_cursor"]
+            if not page["has_more"]:
+                return changed, deleted, cursor
+
+    def test_open_transactions_do_not_stall_other_users(self):
+        from history_repo import delete_reading, get_pg
+
+        _, _, cursor = self._drain(self.user_a, None)
+
+        # An idle-in-transaction reader (like a long export) and an
+        # uncommitted write by someone else, both older than A's writes.
+        self._open_transaction("SELECT 1")
+        self._open_transaction(
+            "INSERT INTO readings (user_id, question, hexagram_code) VALUES (%s, 'q', '111111')",
+            (self.user_b,),
+        )
+
+        with get_pg() as conn, conn.cursor() as cur:
+            ids = [self._insert_reading(cur, self.user_a) for _ in range(3)]
+            conn.commit()
+
+        changed, deleted, cursor = self._drain(self.user_a, cursor)
+        self.assertEqual(sorted(changed), ids)
+        self.assertEqual(deleted, [])
+
+        delete_reading(self.user_a, ids[0])
+        changed, deleted, cursor = self._drain(self.user_a, cursor)
+        self.assertEqual(changed, [])
+        self.assertEqual(deleted, [ids[0]])
+
+    def test_write_committing_late_is_not_skipped(self):
+        from history_repo import get_pg
+
+        writer = self._open_transaction("SELECT 1")
+        with writer.cursor() as cur:
+            late_id = self._insert_reading(cur, self.user_b)
+
+        with get_pg() as conn, conn.cursor() as cur:
+            early_id = self._insert_reading(cur, self.user_b)
+            conn.commit()
+
+        changed, _, cursor = self._drain(self.user_b, None)
+        self.assertEqual(changed, [early_id])
+
+        writer.commit()
+        changed, _, _ = self._drain(self.user_b, cursor)
+        self.assertEqual(changed, [late_id])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Concurrent first logins must create exactly one user.
+
+Needs a disposable PostgreSQL database: set DATABASE_URL and run from
+backend/ with `python -m unittest discover tests`. Skipped otherwise.
+"""
+import os
+import sys
+import threading
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RACERS = 8
+
+
+@unittest.skipUnless(os.getenv("DATABASE_URL"), "DATABASE_URL is not set")
+class GetOrCreateUserRaceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from migrations import run_migrations
+
+        run_migrations()
+
+    def setUp(self):
+        self.provider_uid = f"race-{uuid.uuid4().hex}"
+        self.email = f"{self.provider_uid}@example.test"
+
+    def tearDown(self):
+        from users_repo import get_pg
+
+        with get_pg() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM auth_providers WHERE provider='google' AND provider_uid=%s",
+                (self.provider_uid,),
+            )
+            cur.execute("DELETE FROM users WHERE email=%s", (self.email,))
+            conn.commit()
+
+    def test_racing_first_logins_create_one_user(self):
+        from users_repo import get_or_create_user_by_provider, get_pg
+
+        barrier = threading.Barrier(RACERS)
+        results = []
+        errors = []
+        lock = threading.Lock()
+
+        def login():
+            try:
+                barrier.wait()
+                user = get_or_create_user_by_provider("google", self.provider_uid, self.email, "Racer")
+                with lock:
+                    results.append(user["id"])
+            except Exception as exc:
+                with lock:
+                    errors.append(exc)
+
+        threads = [threading.Thread(target=login) for _ in range(RACERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), RACERS)
+        self.assertEqual(len(set(results)), 1)
+
+        with get_pg() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT user_id::text AS user_id FROM auth_providers WHERE provider='google' AND provider_uid=%s",
+                (self.provider_uid,),
+            )
+            provider_rows = cur.fetchall()
+            cur.execute("SELECT id::text AS id FROM users WHERE email=%s", (self.email,))
+            user_rows = cur.fetchall()
+            conn.commit()
+
+        self.assertEqual([r["user_id"] for r in provider_rows], [results[0]])
+        self.assertEqual([r["id"] for r in user_rows], [results[0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
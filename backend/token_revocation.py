@@ -0,0 +1,280 @@
+import datetime
+import hashlib
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+from pg_connections import connect as pg_connect
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+REVOCATION_BLOOM_FP_RATE = 0.01
+# Incremental refreshes re-read this far behind the watermark, so a
+# revocation committed late by another worker is still picked up.
+REVOCATION_REFRESH_OVERLAP_SECONDS = 60
+
+
+def _parse_int_env(var_name: str, default_value: int) -> int:
+    raw = (os.getenv(var_name) or "").strip()
+    if not raw:
+        return default_value
+    try:
+        return int(raw)
+    except ValueError:
+        return default_value
+
+
+REVOCATION_REFRESH_SECONDS = _parse_int_env("REVOCATION_REFRESH_SECONDS", 5)
+REVOCATION_FULL_RELOAD_SECONDS = _parse_int_env("REVOCATION_FULL_RELOAD_SECONDS", 600)
+REVOCATION_BLOOM_CAPACITY = _parse_int_env("REVOCATION_BLOOM_CAPACITY", 10000)
+
+
+def get_pg():
+    return pg_connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+class BloomFilter:
+    """Fixed-size bit array with k hash positions per key (double hashing)."""
+
+    def __init__(self, capacity: int, fp_rate: float = REVOCATION_BLOOM_FP_RATE):
+        capacity = max(1, int(capacity))
+        self.size_bits = max(8, math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.size_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size_bits for i in range(self.hash_count)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def _epoch(value: datetime.datetime) -> float:
+    # jwt_tokens timestamps are naive UTC, like the iat/exp of session tokens.
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class RevocationFilter:
+    """Per-process view of jwt_tokens, checked without touching the database.
+
+    Revoked jtis go into a Bloom filter backed by the exact set: a Bloom
+    miss (almost every request) answers "valid" immediately, and a hit is
+    confirmed against the set so a false positive never logs anyone out.
+    User-wide revocations are kept as user_id -> cutoff time and apply to
+    tokens issued at or before the cutoff, by their millisecond `iat_ms`
+    claim (a session issued in the same millisecond is revoked too). Older
+    tokens only carry a whole-second `iat` and are all issued before any
+    cutoff that could be in the same second, so `iat <= cutoff` is exact
+    for them.
+
+    A daemon thread per process pulls rows added since the last refresh
+    every REVOCATION_REFRESH_SECONDS, and rebuilds everything from the
+    unexpired rows every REVOCATION_FULL_RELOAD_SECONDS, which drops
+    expired entries and resizes the filter. Revocations made by this
+    process apply immediately; others within one refresh interval.
+    """
+
+    def __init__(self):
+        self._state = (BloomFilter(REVOCATION_BLOOM_CAPACITY), set(), {})
+        self._watermark = None
+        self._loaded_at = 0.0
+        self._loaded = False
+        self._load_attempted = False
+        self._load_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._owner_pid = None
+
+    def is_revoked(self, payload: dict) -> bool:
+        self._ensure_loaded()
+        bloom, jtis, user_cutoffs = self._state
+        jti = payload.get("jti")
+        if jti and jti in bloom and jti in jtis:
+            return True
+        if user_cutoffs:
+            cutoff = user_cutoffs.get(str(payload.get("sub")))
+            if cutoff is not None:
+                try:
+                    if payload.get("iat_ms") is not None:
+                        return int(payload["iat_ms"]) / 1000.0 <= cutoff
+                    return float(payload.get("iat")) <= cutoff
+                except (TypeError, ValueError):
+                    return True
+        return False
+
+    def revoke(self, user_id: str, jti: str | None, expires_at: datetime.datetime):
+        """Record a revocation; `jti=None` revokes every current session of the user."""
+        revoked_at = datetime.datetime.utcnow()
+        with get_pg() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO jwt_tokens (user_id, jti, exp, is_valid, revoked_at)
+                VALUES (%s, %s, %s, FALSE, %s)
+                ON CONFLICT (jti) WHERE jti IS NOT NULL DO NOTHING
+                """,
+                (str(user_id), jti, expires_at, revoked_at),
+            )
+            conn.commit()
+        with self._lock:
+            self._add(self._state, str(user_id), jti, revoked_at)
+
+    @staticmethod
+    def _add(state, user_id: str, jti, revoked_at: datetime.datetime):
+        bloom, jtis, user_cutoffs = state
+        if jti:
+            bloom.add(jti)
+            jtis.add(jti)
+            return
+        cutoff = _epoch(revoked_at)
+        if cutoff > user_cutoffs.get(user_id, 0.0):
+            user_cutoffs[user_id] = cutoff
+
+    def _ensure_loaded(self):
+        if not self._load_attempted:
+            with self._load_lock:
+                if not self._load_attempted:
+                    self._load_attempted = True
+                    try:
+                        self._full_reload()
+                    except Exception:
+                        # Fail open and leave the retries to the refresher:
+                        # refusing every session (or hitting the database
+                        # on every request) while it is unreachable is worse.
+                        traceback.print_exc()
+        self.start_refresher()
+
+    def _fetch(self, since):
+        now = datetime.datetime.utcnow()
+        with get_pg() as conn, conn.cursor() as cur:
+            if since is None:
+                cur.execute(
+                    """
+                    SELECT user_id, jti, revoked_at
+                    FROM jwt_tokens
+                    WHERE is_valid = FALSE AND exp > %s
+                    """,
+                    (now,),
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT user_id, jti, revoked_at
+                    FROM jwt_tokens
+                    WHERE is_valid = FALSE AND exp > %s AND revoked_at > %s
+                    """,
+                    (now, since - datetime.timedelta(seconds=REVOCATION_REFRESH_OVERLAP_SECONDS)),
+                )
+            rows = cur.fetchall() or []
+            conn.commit()
+        return rows
+
+    def _full_reload(self):
+        rows = self._fetch(None)
+        jti_count = sum(1 for r in rows if r.get("jti"))
+        state = (BloomFilter(max(REVOCATION_BLOOM_CAPACITY, 2 * jti_count)), set(), {})
+        for row in rows:
+            self._add(state, str(row["user_id"]), row.get("jti"), row["revoked_at"])
+        with self._lock:
+            self._state = state
+            self._watermark = max((r["revoked_at"] for r in rows), default=datetime.datetime.utcnow())
+            self._loaded_at = time.monotonic()
+            self._loaded = True
+
+    def _refresh(self):
+        rows = self._fetch(self._watermark)
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                self._add(self._state, str(row["user_id"]), row.get("jti"), row["revoked_at"])
+            self._watermark = max(self._watermark, max(r["revoked_at"] for r in rows))
+
+    def start_refresher(self):
+        pid = os.getpid()
+        if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._owner_pid == pid:
+                return
+            # Threads do not survive a fork (gunicorn pre-fork), so start one per process.
+            self._owner_pid = pid
+            self._thread = threading.Thread(target=self._run, name="token-revocation-refresher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(max(1, REVOCATION_REFRESH_SECONDS))
+            try:
+                if not self._loaded or time.monotonic() - self._loaded_at >= REVOCATION_FULL_RELOAD_SECONDS:
+                    self._full_reload()
+                else:
+                    self._refresh()
+            except Exception:
+                traceback.print_exc()
+
+
+_FILTER = RevocationFilter()
+
+
+def is_token_revoked(payload: dict) -> bool:
+    return _FILTER.is_revoked(payload)
+
+
+def revoke_token(user_id: str, jti: str, expires_at: datetime.datetime):
+    _FILTER.revoke(user_id, jti, expires_at)
+
+
+def revoke_user_tokens(user_id: str, expires_at: datetime.datetime):
+    """Revoke every session of a user issued so far (ban, "log out everywhere")."""
+    _FILTER.revoke(user_id, None, expires_at)
+
+
+def start_revocation_refresher():
+    _FILTER.start_refresher()
+
+
+def prune_expired_revocations() -> int:
+    """Delete revocations of tokens that have expired anyway."""
+    with get_pg() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM jwt_tokens WHERE exp < %s", (datetime.datetime.utcnow(),))
+        pruned = cur.rowcount
+        conn.commit()
+        return pruned
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "revoke-user":
+        from auth_middleware import SESSION_TOKEN_TTL
+
+        revoke_user_tokens(sys.argv[2], datetime.datetime.utcnow() + SESSION_TOKEN_TTL)
+        print(f"revoked all sessions of {sys.argv[2]}")
+    elif len(sys.argv) == 2 and sys.argv[1] == "bench":
+        bloom = BloomFilter(REVOCATION_BLOOM_CAPACITY)
+        for i in range(REVOCATION_BLOOM_CAPACITY):
+            bloom.add(f"revoked-{i}")
+        probes = 100000
+        started = time.perf_counter()
+        hits = sum(1 for i in range(probes) if f"valid-{i}" in bloom)
+        elapsed = time.perf_counter() - started
+        print(
+            f"bloom: {bloom.size_bits // 8} bytes, k={bloom.hash_count}, "
+            f"false positive rate {hits / probes:.4f}, {elapsed / probes * 1e6:.2f} us per lookup"
+        )
+    else:
+        print("usage: python token_revocation.py [revoke-user <user_id>|bench]")
+        sys.exit(1)
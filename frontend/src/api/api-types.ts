@@ -190,7 +190,7 @@ export interface paths {
                     };
                     content?: never;
                 };
-                /** @description invalid_ad_proof */
+                /** @description invalid_or_expired_token */
                 401: {
                     headers: {
                         [name: string]: unknown;
@@ -56,19 +56,14 @@ const Achievements: React.FC<AchievementsProps> = ({ user }) => {
 
   const loadCloudHistory = useCallback(async (): Promise<HistoryListItem[]> => {
     const limit = 200;
-    let offset = 0;
-    let total = Number.POSITIVE_INFINITY;
+    let cursor: string | null = null;
     const all: HistoryListItem[] = [];
 
-    while (all.length < total) {
-      const res = await api.getHistory(limit, offset);
+    do {
+      const res = await api.getHistory(limit, 0, cursor);
       all.push(...res.items);
-      total = Number(res.total || 0);
-      if (res.items.length === 0) {
-        break;
-      }
-      offset += res.items.length;
-    }
+      cursor = res.next_cursor;
+    } while (cursor);
 
     return all;
   }, []);
@@ -8,7 +8,10 @@ import {
   AdCardRequest,
   AdCardResponse,
   HistoryListResponse,
+  HistoryChangesResponse,
+  HistorySearchResponse,
   HistoryDetailResponse,
+  HistoryDetailBatchResponse,
   TokenUsage
 } from '../types';
 
@@ -419,15 +422,64 @@ class ApiService {
     });
   }
 
-  async getHistory(limit = 20, offset = 0): Promise<HistoryListResponse> {
+  async getHistory(limit = 20, offset = 0, cursor?: string | null): Promise<HistoryListResponse> {
     const params = new URLSearchParams({ limit: limit.toString(), offset: offset.toString() });
+    if (cursor) {
+      params.set('cursor', cursor);
+    }
     return this.request<HistoryListResponse>(`/history/list?${params.toString()}`);
   }
 
+  async getHistoryChanges(since?: string | null, limit = 200): Promise<HistoryChangesResponse> {
+    const params = new URLSearchParams({ limit: limit.toString() });
+    if (since) {
+      params.set('since', since);
+    }
+    return this.request<HistoryChangesResponse>(`/history/changes?${params.toString()}`);
+  }
+
+  async searchHistory(query: string, limit = 20, offset = 0): Promise<HistorySearchResponse> {
+    const params = new URLSearchParams({ q: query, limit: limit.toString(), offset: offset.toString() });
+    return this.request<HistorySearchResponse>(`/history/search?${params.toString()}`);
+  }
+
   async getHistoryDetail(readingId: number): Promise<HistoryDetailResponse> {
     return this.request<HistoryDetailResponse>(`/history/detail/${readingId}`);
   }
 
+  async getHistoryDetails(readingIds: number[]): Promise<HistoryDetailBatchResponse> {
+    const headers = new Headers({ 'Content-Type': 'application/json' });
+    if (this.token) {
+      headers.set('Authorization', `Bearer ${this.token}`);
+    }
+    const response = await fetch(`${BASE_URL}/history/detail/batch`, {
+      method: 'POST',
+      headers,
+      body: JSON.stringify({ reading_ids: readingIds }),
+    });
+    if (!response.ok) {
+      const error = await response.text();
+      throw new Error(error || response.statusText);
+    }
+    if (!(response.headers.get('Content-Type') || '').includes('application/x-ndjson')) {
+      return response.json() as Promise<HistoryDetailBatchResponse>;
+    }
+
+    // Large batches arrive as one JSON object per line, ending with a { missing } line.
+    const result: HistoryDetailBatchResponse = { items: [], missing: [] };
+    for (const line of (await response.text()).split('\n')) {
+      if (!line.trim()) continue;
+      const parsed = JSON.parse(line);
+      if (parsed.error) throw new Error(parsed.error);
+      if (Array.isArray(parsed.missing)) {
+        result.missing = parsed.missing;
+      } else {
+        result.items.push(parsed as HistoryDetailResponse);
+      }
+    }
+    return result;
+  }
+
   async pinHistory(readingId: number, isPinned: boolean): Promise<PinHistoryResponse> {
     return this.request<PinHistoryResponse>('/history/pin', {
       method: 'POST',
@@ -89,7 +89,29 @@ export interface HistoryListItem {
 
 export interface HistoryListResponse {
   items: HistoryListItem[];
-  total: number;
+  total: number | null;
+  next_cursor: string | null;
+}
+
+export interface HistoryChangedItem extends HistoryListItem {
+  updated_at: string;
+}
+
+export interface HistorySearchItem extends HistoryListItem {
+  summary: string;
+  rank: number;
+}
+
+export interface HistorySearchResponse {
+  items: HistorySearchItem[];
+  next_offset: number | null;
+}
+
+export interface HistoryChangesResponse {
+  changed: HistoryChangedItem[];
+  deleted: number[];
+  next_cursor: string;
+  has_more: boolean;
 }
 
 export interface HistoryDetailResponse {
@@ -101,3 +123,8 @@ export interface HistoryDetailResponse {
   created_at: string;
   is_pinned: boolean;
 }
+
+export interface HistoryDetailBatchResponse {
+  items: HistoryDetailResponse[];
+  missing: number[];
+}
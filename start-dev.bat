@@ -14,7 +14,7 @@ if not exist "%ROOT%frontend\node_modules" (
   exit /b 1
 )
 
-start "Backend" cmd /k "cd /d ""%ROOT%backend"" && call venv\Scripts\activate.bat && python app.py"
+start "Backend" cmd /k "cd /d ""%ROOT%backend"" && call venv\Scripts\activate.bat && python migrations.py && python app.py"
 start "Frontend" cmd /k "cd /d ""%ROOT%frontend"" && npm run dev"
 
 endlocal